@@ -0,0 +1,306 @@
+"""Benchmark the bakery's pipelines offline and track them across commits.
+
+`run` runs the pipelines (see pipelines.py) with stubbed cloud, packer and
+docker backends and appends the per-stage measurements to a JSON history,
+under the commit they were taken at. `compare` then flags the stages that
+got slower, or that read, wrote or needed more scratch, between two
+commits:
+
+    python bench.py run --repeat 3
+    python bench.py compare              # the last two commits in history
+    python bench.py compare 3f2c1a0 HEAD
+    python bench.py show
+
+With --repeat, the median of each measurement is kept. A difference is only
+a regression if it is both beyond --threshold (relative) and above a floor
+(0.25s, 1MB), so noise on tiny stages does not fail the comparison.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+import traceback
+
+import pipelines
+from measure import METRICS, Recorder
+
+HISTORY_VERSION = 1
+DEFAULT_HISTORY = 'bench-history.json'
+DEFAULT_THRESHOLD = 0.1
+FLOORS = {
+    'wall': 0.25,
+    'cpu': 0.25,
+    'read_bytes': 1024 * 1024,
+    'written_bytes': 1024 * 1024,
+    'peak_scratch_bytes': 1024 * 1024,
+}
+
+
+def _git(*args):
+    return subprocess.check_output(
+        ('git', '-C', pipelines.REPO) + args).decode('utf-8').strip()
+
+
+def current_commit():
+    """The checked out commit, marked `-dirty` with uncommitted changes."""
+    try:
+        commit = _git('rev-parse', '--short', 'HEAD')
+        if _git('status', '--porcelain', '--untracked-files=no'):
+            commit += '-dirty'
+        return commit
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return {'version': HISTORY_VERSION, 'runs': []}
+    with open(path) as history_file:
+        history = json.load(history_file)
+    if history.get('version') != HISTORY_VERSION:
+        raise RuntimeError('Unsupported history version {0} in {1}'.format(
+            history.get('version'), path))
+    return history
+
+
+def save_history(history, path):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as history_file:
+        json.dump(history, history_file, indent=1, sort_keys=True)
+    os.rename(temp_path, path)
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def median_stages(repeats):
+    """Merge the stages of repeated runs of a pipeline into their medians."""
+    merged = []
+    for stages in zip(*repeats):
+        first = stages[0]
+        if 'skipped' in first or 'error' in first:
+            merged.append(first)
+            continue
+        stage = {'stage': first['stage']}
+        for metric in METRICS:
+            stage[metric] = _median([s[metric] for s in stages])
+        merged.append(stage)
+    return merged
+
+
+def run_pipeline(name, options):
+    workdir = tempfile.mkdtemp(prefix='bench-{0}-'.format(name),
+                               dir=options.scratch_dir)
+    recorder = Recorder(workdir)
+    try:
+        pipelines.PIPELINES[name](recorder, workdir, options)
+    except Exception as e:
+        traceback.print_exc()
+        recorder.stages.append({'stage': 'error', 'error': str(e)})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return recorder.stages
+
+
+def run(options):
+    names = options.pipelines or list(pipelines.PIPELINES)
+    results = {}
+    for name in names:
+        repeats = []
+        for repeat in range(options.repeat):
+            print('{0} ({1}/{2})'.format(name, repeat + 1, options.repeat))
+            repeats.append(run_pipeline(name, options))
+        if any(len(stages) != len(repeats[0]) for stages in repeats):
+            # A repeat failed part way: keep the last one as it is
+            results[name] = repeats[-1]
+        else:
+            results[name] = median_stages(repeats)
+
+    history = load_history(options.history)
+    entry = {
+        'commit': current_commit(),
+        'label': options.label,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+        'options': {
+            'size_mb': options.size_mb,
+            'workers': options.workers,
+            'loop': options.loop,
+            'repeat': options.repeat,
+        },
+        'pipelines': results,
+    }
+    history['runs'].append(entry)
+    save_history(history, options.history)
+    print('Recorded run {0} of {1} in {2}'.format(
+        len(history['runs']), entry['commit'], options.history))
+    failed = [name for name, stages in results.items()
+              if any('error' in stage for stage in stages)]
+    return 1 if failed else 0
+
+
+def find_run(history, ref):
+    """The latest run of the commit `ref` names, or the run numbered `ref`.
+    """
+    runs = history['runs']
+    if ref.isdigit() and 0 < int(ref) <= len(runs):
+        return runs[int(ref) - 1]
+    if ref == 'HEAD':
+        ref = current_commit()
+    else:
+        try:
+            ref = _git('rev-parse', '--short', ref)
+        except (OSError, subprocess.CalledProcessError):
+            pass
+    for entry in reversed(runs):
+        if entry['commit'].startswith(ref) or ref.startswith(
+                entry['commit'].split('-')[0]):
+            return entry
+    raise RuntimeError('No run of {0} in the history'.format(ref))
+
+
+def _format(metric, value):
+    if metric.endswith('bytes'):
+        return '{0:.1f}MB'.format(value / 1048576.0)
+    return '{0:.2f}s'.format(value)
+
+
+def compare_runs(base, head, threshold=DEFAULT_THRESHOLD):
+    """Print how every stage changed; return the regressions."""
+    regressions = []
+    for name, head_stages in sorted(head['pipelines'].items()):
+        base_stages = dict((stage['stage'], stage)
+                           for stage in base['pipelines'].get(name, []))
+        for stage in head_stages:
+            label = '{0}/{1}'.format(name, stage['stage'])
+            if 'error' in stage:
+                print('{0:<36} failed: {1}'.format(label, stage['error']))
+                regressions.append((label, 'error'))
+                continue
+            before = base_stages.get(stage['stage'])
+            if 'skipped' in stage or before is None or 'skipped' in before \
+                    or 'error' in before:
+                continue
+            for metric in METRICS:
+                old, new = before[metric], stage[metric]
+                change = (new - old) / float(old) if old else 0.0
+                regressed = (new - old > FLOORS[metric] and
+                             (not old or change > threshold))
+                if regressed or abs(change) > threshold:
+                    print('{0:<36} {1:<18} {2:>9} -> {3:>9} {4:>+7.0%}{5}'
+                          .format(label, metric, _format(metric, old),
+                                  _format(metric, new), change,
+                                  '  REGRESSION' if regressed else ''))
+                if regressed:
+                    regressions.append((label, metric))
+    return regressions
+
+
+def compare(options):
+    history = load_history(options.history)
+    runs = history['runs']
+    if not runs:
+        raise RuntimeError('{0} has no runs yet'.format(options.history))
+    head = find_run(history, options.head) if options.head else runs[-1]
+    if options.base:
+        base = find_run(history, options.base)
+    else:
+        earlier = [entry for entry in runs
+                   if entry['commit'] != head['commit']]
+        if not earlier:
+            raise RuntimeError('No run of another commit to compare with')
+        base = earlier[-1]
+    print('Comparing {0} ({1}) with {2} ({3})'.format(
+        head['commit'], head['time'], base['commit'], base['time']))
+    options_used = [dict((name, value)
+                         for name, value in entry['options'].items()
+                         if name != 'repeat') for entry in (base, head)]
+    if options_used[0] != options_used[1]:
+        print('Warning: the runs used different options: {0} and {1}'.format(
+            *options_used))
+    regressions = compare_runs(base, head, options.threshold)
+    print('{0} regression(s)'.format(len(regressions)))
+    return 1 if regressions else 0
+
+
+def show(options):
+    history = load_history(options.history)
+    for number, entry in enumerate(history['runs'], 1):
+        total = sum(stage.get('wall', 0)
+                    for stages in entry['pipelines'].values()
+                    for stage in stages)
+        print('{0:>4}  {1:<16} {2}  {3:>8.1f}s  {4}'.format(
+            number, entry['commit'], entry['time'], total,
+            entry.get('label') or ''))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Offline benchmarks of the image bakery pipelines.')
+    parser.add_argument('--history', default=DEFAULT_HISTORY,
+                        help='JSON history file (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help='Run and record benchmarks')
+    run_parser.add_argument('pipelines', nargs='*', metavar='PIPELINE',
+                            help='One or more of: {0} (default: all)'.format(
+                                ', '.join(pipelines.PIPELINES)))
+    run_parser.add_argument('--repeat', type=int, default=1)
+    run_parser.add_argument('--size-mb', type=int, default=256,
+                            help='Size of the synthetic disk and image')
+    run_parser.add_argument('--workers', type=int, default=4)
+    run_parser.add_argument('--loop', action='store_true',
+                            help='Read the disk through a loop device '
+                                 '(needs root)')
+    run_parser.add_argument('--s3-endpoint',
+                            help='Local S3-compatible server to upload to')
+    run_parser.add_argument('--s3-bucket', default='bench')
+    run_parser.add_argument('--scratch-dir',
+                            help='Where the pipelines run (default: TMPDIR)')
+    run_parser.add_argument('--label', help='Note stored with the run')
+
+    compare_parser = commands.add_parser(
+        'compare', help='Flag regressions between two recorded commits')
+    compare_parser.add_argument('base', nargs='?',
+                                help='Commit or run number (default: the '
+                                     'last run of another commit)')
+    compare_parser.add_argument('head', nargs='?',
+                                help='Commit or run number (default: the '
+                                     'last run)')
+    compare_parser.add_argument('--threshold', type=float,
+                                default=DEFAULT_THRESHOLD,
+                                help='Relative increase flagged '
+                                     '(default: %(default)s)')
+
+    commands.add_parser('show', help='List the recorded runs')
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        unknown = set(args.pipelines) - set(pipelines.PIPELINES)
+        if unknown:
+            parser.error('unknown pipeline(s): ' + ', '.join(sorted(unknown)))
+        return run(args)
+    if args.command == 'compare':
+        return compare(args)
+    if args.command == 'show':
+        return show(args)
+    parser.error('a command is required')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""Per-stage wall time, CPU, I/O and scratch disk of a benchmarked pipeline.
+
+CPU and I/O are the whole process's, children included once they have been
+waited for (the kernel folds them into their parent's counters), so stages
+must not overlap. I/O is what the stage read and wrote through system calls
+(`rchar`/`wchar`), pipes included; scratch is the peak disk usage of the
+pipeline's scratch directory, sampled in the background.
+"""
+from __future__ import print_function
+import os
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+SAMPLE_INTERVAL = 0.05
+METRICS = ['wall', 'cpu', 'read_bytes', 'written_bytes',
+           'peak_scratch_bytes']
+
+
+def disk_usage(path):
+    """Bytes allocated to the files under `path`."""
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.lstat(os.path.join(directory, name))
+            except OSError:
+                # Removed while walking
+                continue
+            total += getattr(stat, 'st_blocks', 0) * 512 or stat.st_size
+    return total
+
+
+def _cpu_seconds():
+    usage = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        rusage = resource.getrusage(who)
+        usage += rusage.ru_utime + rusage.ru_stime
+    return usage
+
+
+def _io_bytes():
+    """(read, written) by this process and its reaped children so far."""
+    counters = {}
+    try:
+        with open('/proc/self/io') as io_file:
+            for line in io_file:
+                name, _, value = line.partition(':')
+                counters[name] = int(value)
+    except (IOError, OSError):
+        # Not Linux: I/O is reported as 0
+        pass
+    return counters.get('rchar', 0), counters.get('wchar', 0)
+
+
+class ScratchSampler(threading.Thread):
+    def __init__(self, path):
+        super(ScratchSampler, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.peak = disk_usage(path)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(SAMPLE_INTERVAL):
+            self.peak = max(self.peak, disk_usage(self.path))
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, disk_usage(self.path))
+        return self.peak
+
+
+class Recorder(object):
+    """Collects the measurements of one pipeline's stages, in order."""
+
+    def __init__(self, scratch):
+        self.scratch = scratch
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        sampler = ScratchSampler(self.scratch)
+        sampler.start()
+        read, written = _io_bytes()
+        cpu = _cpu_seconds()
+        start = time.time()
+        try:
+            yield
+        finally:
+            wall = time.time() - start
+            now_read, now_written = _io_bytes()
+            result = {
+                'stage': name,
+                'wall': round(wall, 3),
+                'cpu': round(_cpu_seconds() - cpu, 3),
+                'read_bytes': now_read - read,
+                'written_bytes': now_written - written,
+                'peak_scratch_bytes': sampler.stop(),
+            }
+            self.stages.append(result)
+            print('  {0:<24} {1:>7.2f}s wall {2:>7.2f}s cpu {3:>8.1f}MB read '
+                  '{4:>8.1f}MB written {5:>8.1f}MB scratch'.format(
+                      name, result['wall'], result['cpu'],
+                      result['read_bytes'] / 1048576.0,
+                      result['written_bytes'] / 1048576.0,
+                      result['peak_scratch_bytes'] / 1048576.0))
+
+    def skip(self, name, reason):
+        self.stages.append({'stage': name, 'skipped': reason})
+        print('  {0:<24} skipped: {1}'.format(name, reason))
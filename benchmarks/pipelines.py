@@ -0,0 +1,238 @@
+"""The bakery's pipelines, runnable offline for benchmarking.
+
+Every pipeline runs the repository's own code on synthetic inputs, in a
+scratch directory of its own. Only the external tools are stubbed: `packer`
+and `docker` resolve to stub_packer.py and stub_docker.py, and the cloud is
+left out. Each stage is measured by a measure.Recorder; stages that need
+something not available offline are recorded as skipped:
+
+- nightly: the packer build, the .box built from the baked disk (a raw
+  image, or a loop device over it) and, given a local S3-compatible
+  endpoint, its upload,
+- bake: the system tests' concurrent packer bakes, and parsing their logs,
+- docker: the manager images' build context and the chunked export and
+  import of an image, first into an empty store and then incrementally.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import shutil
+import hashlib
+import logging
+import tarfile
+import subprocess
+from collections import OrderedDict
+from contextlib import contextmanager
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+for directory in ('quickstart', 'cloudify_docker_image', 'system_tests'):
+    sys.path.insert(0, os.path.join(REPO, directory))
+
+import box_stream  # noqa: E402
+import dockerfiles  # noqa: E402
+import export_image  # noqa: E402
+import packer_events  # noqa: E402
+import bake_scheduler  # noqa: E402
+from variants import VARIANTS  # noqa: E402
+
+MB = 1024 * 1024
+NIGHTLY_BUILDER = 'nightly_virtualbox_build'
+BAKE_BUILDERS = ['aws', 'openstack']
+# Image layers: the first ones stay the same across nightlies, the last
+# one changes
+LAYER_SHARES = [0.5, 0.3, 0.2]
+
+
+def _block(seed=None):
+    """A MB that compresses about as well as a system image does.
+
+    Blocks of the same `seed` are the same; without one, they are random.
+    """
+    if seed is None:
+        noise = os.urandom(MB // 2)
+    else:
+        noise = b''.join(
+            hashlib.sha256('{0}-{1}'.format(seed, index).encode('utf-8'))
+            .digest() for index in range(MB // 2 // 32))
+    text = b'cloudify manager image bakery benchmark data\n'
+    return noise + (text * (MB // 2 // len(text) + 1))[:MB // 2]
+
+
+def _write_data(path, size_mb, used_every=1, seed=None):
+    """Write `size_mb` MB to `path`, every `used_every`th MB of it data."""
+    block = _block(seed)
+    with open(path, 'wb') as data_file:
+        data_file.truncate(size_mb * MB)
+        for mb in range(0, size_mb, used_every):
+            data_file.seek(mb * MB)
+            data_file.write(block)
+
+
+def _fixed_mtime(info):
+    # As in `docker save`, where members are as old as their layer
+    info.mtime = 0
+    return info
+
+
+def _write_image_archive(path, workdir, size_mb, generation):
+    """A `docker save` like archive, of which only the last layer differs
+    between generations."""
+    with tarfile.open(path, 'w') as archive:
+        layers = []
+        for index, share in enumerate(LAYER_SHARES):
+            last = index == len(LAYER_SHARES) - 1
+            name = 'layer{0}-{1}/layer.tar'.format(
+                index, generation if last else 0)
+            layer_path = os.path.join(workdir, 'layer.bin')
+            _write_data(layer_path, max(1, int(size_mb * share)),
+                        seed=name)
+            archive.add(layer_path, name, filter=_fixed_mtime)
+            os.remove(layer_path)
+            layers.append(name)
+        manifest = os.path.join(workdir, 'manifest.json')
+        with open(manifest, 'w') as manifest_file:
+            json.dump([{'Config': 'config.json', 'RepoTags': ['stub:latest'],
+                        'Layers': layers}], manifest_file)
+        archive.add(manifest, 'manifest.json', filter=_fixed_mtime)
+        os.remove(manifest)
+
+
+def _stub(bin_dir, name, script):
+    path = os.path.join(bin_dir, name)
+    with open(path, 'w') as stub:
+        stub.write('#!/bin/sh\nexec "{0}" "{1}" "$@"\n'.format(
+            sys.executable, os.path.join(HERE, script)))
+    os.chmod(path, 0o755)
+    return path
+
+
+@contextmanager
+def stubbed_tools(workdir, **environment):
+    """Put the stub packer and docker first on the PATH."""
+    bin_dir = os.path.join(workdir, 'bin')
+    os.makedirs(bin_dir)
+    _stub(bin_dir, 'packer', 'stub_packer.py')
+    _stub(bin_dir, 'docker', 'stub_docker.py')
+    environment['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+    saved = dict((name, os.environ.get(name)) for name in environment)
+    os.environ.update(environment)
+    try:
+        yield bin_dir
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+@contextmanager
+def _disk(path, loop):
+    """The baked disk: the raw image itself, or a loop device over it."""
+    if not loop:
+        yield path
+        return
+    device = subprocess.check_output(
+        ['losetup', '--find', '--show', '--read-only', path]
+    ).decode('utf-8').strip()
+    try:
+        yield device
+    finally:
+        subprocess.call(['losetup', '--detach', device])
+
+
+def nightly(recorder, workdir, options):
+    with stubbed_tools(workdir,
+                       BENCH_PACKER_SCRATCH_MB=str(options.size_mb // 4)):
+        with recorder.stage('packer build'):
+            returncode, run = packer_events.run_packer(
+                ['packer', 'build', '-machine-readable',
+                 '-only=' + NIGHTLY_BUILDER, 'packerfile.json'],
+                cwd=workdir, echo=False)
+            if returncode != 0 or not run.artifact_ids(NIGHTLY_BUILDER):
+                raise RuntimeError('packer failed: {0}'.format(run.errors))
+
+    recorder.skip('factory instance', 'needs EC2')
+    # Half of the disk is used, as on the baked volume
+    image = os.path.join(workdir, 'disk.img')
+    _write_data(image, options.size_mb, used_every=2)
+    box = os.path.join(workdir, 'cloudify.box')
+    with _disk(image, options.loop) as disk:
+        with recorder.stage('box'):
+            box_stream.build_box(disk, box, workers=options.workers)
+
+    if not options.s3_endpoint:
+        recorder.skip('s3 upload', 'no S3 endpoint given')
+        return
+    import s3_upload
+    with recorder.stage('s3 upload'):
+        s3_upload.upload(box, options.s3_bucket, 'bench/cloudify.box',
+                         part_size=s3_upload.MIN_PART_SIZE,
+                         workers=options.workers,
+                         endpoint=options.s3_endpoint)
+
+
+def bake(recorder, workdir, options):
+    bakes_dir = os.path.join(workdir, 'bakes')
+    os.makedirs(bakes_dir)
+    with stubbed_tools(workdir,
+                       BENCH_PACKER_SCRATCH_MB=str(options.size_mb // 8)):
+        scheduler = bake_scheduler.BakeScheduler(
+            bakes_dir, workdir, 'packer', 'packerfile.json',
+            logging.getLogger('bench'))
+        with recorder.stage('concurrent bakes'):
+            for builder in BAKE_BUILDERS:
+                scheduler.start(builder, {'name': builder})
+            bakes = [scheduler.wait(builder, {'name': builder})
+                     for builder in BAKE_BUILDERS]
+        with recorder.stage('parse bake logs'):
+            for finished in bakes:
+                if not finished.artifact_ids() or not finished.stages():
+                    raise RuntimeError('Nothing parsed from {0}'.format(
+                        finished.log_path))
+        scheduler.shutdown()
+
+
+def docker(recorder, workdir, options):
+    rpm = os.path.join(workdir, dockerfiles.CFY_RPM)
+    _write_data(rpm, options.size_mb // 2)
+    with recorder.stage('build context'):
+        dockerfiles.write_context(
+            os.path.join(workdir, 'context'),
+            [VARIANTS[name] for name in sorted(VARIANTS)], rpm)
+    os.remove(rpm)
+    shutil.rmtree(os.path.join(workdir, 'context'))
+
+    archives = [os.path.join(workdir, 'image-{0}.tar'.format(generation))
+                for generation in (1, 2)]
+    for generation, archive in enumerate(archives, 1):
+        _write_image_archive(archive, workdir, options.size_mb, generation)
+    store = export_image.ChunkStore(os.path.join(workdir, 'store'),
+                                    export_image.Codec('gzip'))
+    manifest = os.path.join(workdir, 'image.json')
+    loaded = os.path.join(workdir, 'loaded.tar')
+    with stubbed_tools(workdir, BENCH_DOCKER_SAVE=archives[0],
+                       BENCH_DOCKER_LOAD=loaded):
+        with recorder.stage('export'):
+            export_image.export(['stub:latest'], store, manifest,
+                                options.workers)
+    with stubbed_tools(os.path.join(workdir, 'incremental'),
+                       BENCH_DOCKER_SAVE=archives[1],
+                       BENCH_DOCKER_LOAD=loaded):
+        with recorder.stage('export incremental'):
+            export_image.export(['stub:latest'], store, manifest,
+                                options.workers)
+        with recorder.stage('import'):
+            export_image.import_images(manifest, store, options.workers)
+        if export_image.image_id('stub:latest') != \
+                'sha256:' + dockerfiles.file_sha256(archives[1]):
+            raise RuntimeError('The imported image differs from the export')
+
+
+PIPELINES = OrderedDict([
+    ('nightly', nightly),
+    ('bake', bake),
+    ('docker', docker),
+])
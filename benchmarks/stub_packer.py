@@ -0,0 +1,68 @@
+"""Stands in for `packer build -machine-readable` in offline benchmarks.
+
+Announces a number of steps for the builder selected with `-only`, each
+followed by lines of provisioner output, fills some scratch space in its
+working directory (the ISO, the exported disk, ...) and reports an artifact
+id, the way a real build does. The shape of a build is set through the
+environment:
+
+    BENCH_PACKER_STEPS          steps to announce (8)
+    BENCH_PACKER_LINES          output lines per step (2000)
+    BENCH_PACKER_STEP_SECONDS   seconds each step takes (0)
+    BENCH_PACKER_SCRATCH_MB     scratch written while building (16)
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+
+MB = 1024 * 1024
+
+
+def _setting(name, default, kind=int):
+    return kind(os.environ.get('BENCH_PACKER_' + name, default))
+
+
+def _emit(target, *fields):
+    print(','.join([str(int(time.time())), target] +
+                   [field.replace(',', '%!(PACKER_COMMA)')
+                    for field in fields]))
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    builder = 'stub'
+    for arg in argv:
+        if arg.lstrip('-').startswith('only='):
+            builder = arg.split('=', 1)[1]
+    steps = _setting('STEPS', 8)
+    lines = _setting('LINES', 2000)
+    step_seconds = _setting('STEP_SECONDS', 0, float)
+    scratch_mb = _setting('SCRATCH_MB', 16)
+
+    scratch = 'stub-packer-{0}-{1}.img'.format(builder, os.getpid())
+    block = os.urandom(MB)
+    try:
+        with open(scratch, 'wb') as scratch_file:
+            for step in range(steps):
+                _emit(builder, 'ui', 'say', '==> {0}: Step {1} of {2}'.format(
+                    builder, step + 1, steps))
+                for line in range(lines):
+                    _emit(builder, 'ui', 'message',
+                          '    {0}: provisioning, line {1}, step {2}'.format(
+                              builder, line, step))
+                for _ in range(scratch_mb * (step + 1) // steps -
+                               scratch_mb * step // steps):
+                    scratch_file.write(block)
+                time.sleep(step_seconds)
+        _emit(builder, 'artifact', '0', 'id', 'eu-west-1:ami-{0:08x}'.format(
+            os.getpid()))
+        _emit(builder, 'artifact', '0', 'end')
+        _emit('', 'ui', 'say', "Build '{0}' finished.".format(builder))
+    finally:
+        os.remove(scratch)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,238 @@
+"""Build several Cloudify Manager image variants side by side.
+
+The RPM is downloaded once and goes into a single multi-stage build context
+(see dockerfiles.py). Its install stage is built first and cached on the
+RPM's checksum; the variants are then built concurrently on top of it, so a
+config-only change just rebuilds the variant's own layers:
+
+    python build_images.py --rpm-url $INSTALL_RPM_URL manager-aio rabbitmq
+
+The all-in-one manager needs systemd for its install, so it is finished in
+its own uniquely named (and labelled) container and committed on top of its
+built stage. Per-variant step timings are printed once every build is done.
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import uuid
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+import dockerfiles
+from variants import VARIANTS
+
+BASE_IMAGE_TAG = 'latest-centos7-base-image'
+RPM_IMAGE = 'cloudify-manager-rpm'
+# Every build container carries this label, with the build id as its value
+BUILD_LABEL = 'cloudify-image-build'
+DOCKER_RUN_FLAGS = [
+    '-d',
+    '-v', '/sys/fs/cgroup:/sys/fs/cgroup:ro',
+    '--tmpfs', '/run',
+    '--tmpfs', '/run/lock',
+    '--security-opt', 'seccomp:unconfined',
+    '--cap-add', 'SYS_ADMIN',
+]
+
+_print_lock = threading.Lock()
+
+
+def log(message):
+    with _print_lock:
+        print(message)
+        sys.stdout.flush()
+
+
+def docker(*args):
+    return subprocess.check_output(('docker',) + args).decode('utf-8').strip()
+
+
+def docker_build(context, target, tag, log_path):
+    """`docker build` one stage, appending its output to `log_path`."""
+    env = dict(os.environ, DOCKER_BUILDKIT='1')
+    with open(log_path, 'a') as build_log:
+        subprocess.check_call(
+            ['docker', 'build', '--progress=plain', '--target', target,
+             '-t', tag, context],
+            env=env,
+            stdout=build_log,
+            stderr=subprocess.STDOUT,
+        )
+
+
+def find_base_image():
+    for line in docker('images', '--format',
+                       '{{.Tag}} {{.ID}}').splitlines():
+        tag, image_id = line.split()
+        if tag == BASE_IMAGE_TAG:
+            return image_id
+    raise RuntimeError('No {0} image found, pull or build it first'.format(
+        BASE_IMAGE_TAG))
+
+
+def fetch_rpm(url, directory):
+    """Download the RPM once for all builds; local paths are used as is."""
+    if os.path.exists(url):
+        return url
+    path = os.path.join(directory, dockerfiles.CFY_RPM)
+    subprocess.check_call(['curl', '--fail', '--silent', '--show-error',
+                           '--location', '--retry', '3', '-o', path, url])
+    return path
+
+
+class VariantBuild(object):
+    def __init__(self, variant, build_id, context, log_dir):
+        self.variant = variant
+        self.build_id = build_id
+        self.context = context
+        self.log_path = os.path.join(log_dir,
+                                     '{0}.log'.format(variant.name))
+        self.container = 'cfy-manager-{0}-{1}'.format(variant.name, build_id)
+        self.timings = []
+        self.error = None
+
+    def _step(self, name, func, *args):
+        log('[{0}] {1}...'.format(self.variant.name, name))
+        start = time.time()
+        result = func(*args)
+        self.timings.append((name, time.time() - start))
+        return result
+
+    def _exec(self, command):
+        with open(self.log_path, 'a') as build_log:
+            build_log.write('$ {0}\n'.format(command))
+            build_log.flush()
+            subprocess.check_call(
+                ['docker', 'exec', self.container, 'sh', '-c', command],
+                stdout=build_log,
+                stderr=subprocess.STDOUT,
+            )
+
+    def _build_stage(self):
+        docker_build(self.context, self.variant.name, self.variant.pub_name,
+                     self.log_path)
+
+    def _start_container(self):
+        docker('run', '--name', self.container,
+               '--label', '{0}={1}'.format(BUILD_LABEL, self.build_id),
+               *(DOCKER_RUN_FLAGS + [self.variant.pub_name]))
+
+    def _install_manager(self):
+        self._exec('{0} && {1}'.format(dockerfiles.SET_CONTAINER_IP,
+                                       self.variant.install_command))
+
+    def _record_boot_state(self):
+        # Lets containers started on another IP skip the full configure
+        self._exec('python {0}/manager_boot.py record --ip $(hostname -i)'
+                   .format(dockerfiles.MANAGER_CONFIG_LOCATION))
+
+    def _commit(self):
+        docker('commit', '-m', 'Install Cloudify relevant components',
+               self.container, self.variant.pub_name)
+
+    def run(self):
+        start = time.time()
+        open(self.log_path, 'w').close()
+        try:
+            self._step('build stage', self._build_stage)
+            if self.variant.full_install:
+                self._step('create container', self._start_container)
+                self._step('install manager', self._install_manager)
+                self._step('record boot state', self._record_boot_state)
+                self._step('commit image', self._commit)
+            docker('tag', self.variant.pub_name,
+                   '{0}:latest'.format(self.variant.hub_name))
+        except Exception as e:
+            self.error = e
+            log('[{0}] build failed: {1}, see {2}'.format(
+                self.variant.name, e, self.log_path))
+        finally:
+            if self.variant.full_install:
+                subprocess.call(
+                    ['docker', 'rm', '-f', '-v', self.container],
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.timings.append(('total', time.time() - start))
+        return self
+
+
+def build(variant_names, rpm_url, base_image=None, workers=None,
+          log_dir='build-logs'):
+    build_id = uuid.uuid4().hex[:8]
+    base_image = base_image or find_base_image()
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    variants = [VARIANTS[name] for name in variant_names]
+    workdir = tempfile.mkdtemp(prefix='cfy-image-build-')
+    try:
+        start = time.time()
+        log('Fetching {0}...'.format(rpm_url))
+        rpm_path = fetch_rpm(rpm_url, workdir)
+        log('Fetched RPM in {0:.0f}s'.format(time.time() - start))
+
+        context = os.path.join(workdir, 'context')
+        rpm_sha256 = dockerfiles.write_context(context, variants, rpm_path,
+                                               base_image)
+        # Every variant builds on this stage: build it once up front rather
+        # than racing concurrent builds to fill the cache
+        rpm_start = time.time()
+        rpm_log = os.path.join(log_dir, 'rpm.log')
+        open(rpm_log, 'w').close()
+        docker_build(context, 'rpm',
+                     '{0}:{1}'.format(RPM_IMAGE, rpm_sha256[:12]), rpm_log)
+        log('Built RPM stage for {0} in {1:.0f}s'.format(
+            rpm_sha256[:12], time.time() - rpm_start))
+
+        builds = [VariantBuild(variant, build_id, context, log_dir)
+                  for variant in variants]
+        pool = ThreadPool(workers or len(builds))
+        try:
+            pool.map(lambda variant_build: variant_build.run(), builds)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for variant_build in builds:
+        log('{0:<16} {1}  {2}'.format(
+            variant_build.variant.name,
+            'FAILED' if variant_build.error else 'ok    ',
+            '  '.join('{0}={1:.0f}s'.format(name, seconds)
+                      for name, seconds in variant_build.timings)))
+    log('Built {0} variant(s) in {1:.0f}s'.format(len(builds),
+                                                  time.time() - start))
+    return builds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Build Cloudify Manager docker images concurrently.')
+    parser.add_argument('variants', nargs='*', metavar='VARIANT',
+                        help='One or more of: {0} (default: all)'.format(
+                            ', '.join(sorted(VARIANTS))))
+    parser.add_argument('--rpm-url', required=True,
+                        help='URL (or local path) of the manager install RPM')
+    parser.add_argument('--base-image',
+                        help='Defaults to the local {0} image'.format(
+                            BASE_IMAGE_TAG))
+    parser.add_argument('--workers', type=int,
+                        help='Concurrent builds, all at once by default')
+    parser.add_argument('--log-dir', default='build-logs',
+                        help='Where each variant writes its build log')
+    args = parser.parse_args(argv)
+    unknown = set(args.variants) - set(VARIANTS)
+    if unknown:
+        parser.error('unknown variant(s): ' + ', '.join(sorted(unknown)))
+
+    builds = build(args.variants or sorted(VARIANTS), args.rpm_url,
+                   args.base_image, args.workers, args.log_dir)
+    return 1 if any(variant_build.error for variant_build in builds) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,21 +1,19 @@
 #!/bin/bash -e -x
 
 sudo systemctl restart docker.service
+# Only clean up what earlier image builds left behind, anything else on the
+# host is none of this job's business
 set +e
-if [[ $(docker ps -a -q) ]];then
-    docker stop $(docker ps -a -q)
-    docker rm -v -f $(docker ps -a -q)
+if [[ $(docker ps -a -q --filter label=cloudify-image-build) ]];then
+    docker rm -v -f $(docker ps -a -q --filter label=cloudify-image-build)
 fi
-if [[ $(docker images -q) ]];then
-    docker rmi -f $(docker images -q)
-fi
-if [[ $(docker images -q) ]];then
-    echo "The following docker images were not deleted: $(docker images -a)"
-    exit
-fi	
 set -e
 
 docker pull $DOCKER_ORGANIZATION/community:latest-centos7-base-image
-bash make_cfy_manager_image.sh $INSTALL_RPM_URL ${IMAGE_TYPE}
+# IMAGE_TYPES may list several variants, which are then built concurrently
+python build_images.py --rpm-url $INSTALL_RPM_URL ${IMAGE_TYPES:-${IMAGE_TYPE}}
 
-docker image save -o cloudify-manager-aio-docker-$CLOUDIFY_TAG.tar cloudify-manager-aio:latest
+# Chunks unchanged since earlier nightlies are already in the store, so only
+# the changed layers are compressed and stored again
+python export_image.py --store ${IMAGE_STORE:-image-store} export cloudify-manager-aio:latest \
+    --manifest cloudify-manager-aio-docker-$CLOUDIFY_TAG.json
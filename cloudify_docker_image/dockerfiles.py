@@ -0,0 +1,146 @@
+"""Generate the multi-stage build context of the manager image variants.
+
+The Dockerfile has three kinds of stages:
+
+- `base`: the CentOS 7 base image,
+- `rpm`: the manager install RPM installed on top of it; its first
+  instruction records the RPM's SHA256, so this stage (the slow one) is only
+  rebuilt when the RPM itself changes,
+- one thin stage per variant, which only adds its config.yaml and runs
+  `cfy_manager install --only-install`.
+
+Changing a variant's config therefore only rebuilds (and later pushes) that
+variant's last layers:
+
+    python dockerfiles.py --rpm cloudify-manager-install.rpm build-context
+    docker build --target rabbitmq -t docker-cfy-rabbitmq build-context
+"""
+from __future__ import print_function
+import os
+import sys
+import shutil
+import hashlib
+import argparse
+
+from variants import CONTAINER_IP_PLACEHOLDER, VARIANTS
+
+CFY_RPM = 'cloudify-manager-install.rpm'
+MANAGER_CONFIG_LOCATION = '/etc/cloudify'
+DEFAULT_BASE_IMAGE = 'cloudifycosmo/community:latest-centos7-base-image'
+HERE = os.path.dirname(os.path.abspath(__file__))
+CHUNK_SIZE = 1024 * 1024
+
+# Replaces the config placeholder with the IP of the container running it
+SET_CONTAINER_IP = 'sed -i "s/{0}/$(hostname -i)/" {1}/config.yaml'.format(
+    CONTAINER_IP_PLACEHOLDER, MANAGER_CONFIG_LOCATION)
+
+BASE_STAGES = """\
+ARG BASE_IMAGE={base_image}
+FROM ${{BASE_IMAGE}} AS base
+
+FROM base AS rpm
+LABEL org.cloudify.rpm-sha256="{rpm_sha256}"
+COPY {rpm} /tmp/{rpm}
+RUN yum install -y /tmp/{rpm} && rm -f /tmp/{rpm} && yum clean all
+# This is required for k8s installations
+COPY k8s_copy_and_install.sh manager_boot.py {config_location}/
+# If we are not installing a manager we won't have that directory and we
+# need the image.info for the usage-collector
+RUN mkdir -p /opt/cfy/ && echo 'docker' > /opt/cfy/image.info
+"""
+
+VARIANT_STAGE = """
+FROM rpm AS {name}
+COPY {name}/config.yaml {config_location}/config.yaml
+"""
+
+# systemd does not run during `docker build`, so only variants that just get
+# their packages installed can finish their install here; the all-in-one
+# manager is installed in a running container (see build_images.py)
+ONLY_INSTALL = """\
+RUN {set_ip} && {install_command}
+"""
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as rpm:
+        for chunk in iter(lambda: rpm.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def dockerfile(variants, rpm_sha256, base_image=DEFAULT_BASE_IMAGE):
+    content = BASE_STAGES.format(
+        base_image=base_image,
+        rpm_sha256=rpm_sha256,
+        rpm=CFY_RPM,
+        config_location=MANAGER_CONFIG_LOCATION,
+    )
+    for variant in variants:
+        content += VARIANT_STAGE.format(
+            name=variant.name,
+            config_location=MANAGER_CONFIG_LOCATION,
+        )
+        if not variant.full_install:
+            content += ONLY_INSTALL.format(
+                set_ip=SET_CONTAINER_IP,
+                install_command=variant.install_command,
+            )
+    return content
+
+
+def write_context(context, variants, rpm_path, base_image=DEFAULT_BASE_IMAGE):
+    """Lay out the build context in `context` and return the RPM's SHA256.
+
+    `rpm_path` is hard linked into the context when possible, so a big RPM
+    is not copied around.
+    """
+    if not os.path.isdir(context):
+        os.makedirs(context)
+    rpm = os.path.join(context, CFY_RPM)
+    if not os.path.exists(rpm) or not os.path.samefile(rpm_path, rpm):
+        if os.path.exists(rpm):
+            os.remove(rpm)
+        try:
+            os.link(rpm_path, rpm)
+        except OSError:
+            shutil.copy(rpm_path, rpm)
+    rpm_sha256 = file_sha256(rpm)
+
+    for name in ('k8s_copy_and_install.sh', 'manager_boot.py'):
+        shutil.copy(os.path.join(HERE, name), context)
+    for variant in variants:
+        variant_dir = os.path.join(context, variant.name)
+        if not os.path.isdir(variant_dir):
+            os.makedirs(variant_dir)
+        with open(os.path.join(variant_dir, 'config.yaml'), 'w') as config:
+            config.write(variant.config(CONTAINER_IP_PLACEHOLDER))
+
+    with open(os.path.join(context, 'Dockerfile'), 'w') as docker_file:
+        docker_file.write(dockerfile(variants, rpm_sha256, base_image))
+    return rpm_sha256
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Write the multi-stage build context of the manager '
+                    'image variants.')
+    parser.add_argument('context', help='Directory to write the context to')
+    parser.add_argument('--rpm', required=True,
+                        help='Path of the manager install RPM')
+    parser.add_argument('--base-image', default=DEFAULT_BASE_IMAGE)
+    args = parser.parse_args(argv)
+
+    rpm_sha256 = write_context(
+        args.context,
+        [VARIANTS[name] for name in sorted(VARIANTS)],
+        args.rpm,
+        args.base_image,
+    )
+    print('Wrote {0} for RPM {1}'.format(args.context, rpm_sha256))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,397 @@
+"""Export docker images as compressed, deduplicated chunks plus a manifest.
+
+`docker save` is streamed, never written out whole, and cut into chunks at
+the boundaries of the tar members it contains. Layers are content
+addressed, so an unchanged layer always yields the same chunks; large
+members are further split into fixed size pieces. Chunks are stored under
+their SHA256 in a shared store, compressed in parallel, and only if the
+store does not have them yet; consecutive nightly exports therefore only add
+the layers that changed:
+
+    python export_image.py export cloudify-manager-aio:latest \\
+        --store image-store --manifest cloudify-manager-aio.json
+    python export_image.py import cloudify-manager-aio.json \\
+        --store https://example.com/image-store --cache image-cache
+
+Importing fetches (and caches) only the chunks missing locally and streams
+them into `docker load`. `roundtrip` exports an image, removes it, imports
+it again and checks it comes back with the same id.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import zlib
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MB = 1024 * 1024
+BLOCK_SIZE = 512
+CHUNK_SIZE = 64 * MB
+# Members at least this big get chunks of their own
+LARGE_MEMBER = 1 * MB
+DEFAULT_WORKERS = 4
+MANIFEST_VERSION = 1
+EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def _member_size(header):
+    """Size of the data following a tar header block, padding included."""
+    field = bytearray(header[124:136])
+    if field[0] & 0x80:
+        # GNU base-256 encoding, for members of 8GB and more
+        size = 0
+        for byte in field[1:]:
+            size = (size << 8) | byte
+    else:
+        text = bytes(field).rstrip(b'\0 ').strip()
+        size = int(text, 8) if text else 0
+    return (size + BLOCK_SIZE - 1) // BLOCK_SIZE * BLOCK_SIZE
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            raise IOError('Unexpected end of tar stream')
+        data += more
+    return data
+
+
+def tar_chunks(stream, chunk_size=CHUNK_SIZE, large_member=LARGE_MEMBER):
+    """Split a tar stream into chunks along its member boundaries."""
+    pending = []
+    pending_size = 0
+    while True:
+        header = stream.read(BLOCK_SIZE)
+        if len(header) < BLOCK_SIZE or not header.strip(b'\0'):
+            # End of archive: zero blocks and whatever padding follows
+            pending.append(header + stream.read())
+            break
+        size = _member_size(header)
+        if size < large_member:
+            pending.append(header + _read_exactly(stream, size))
+            pending_size += BLOCK_SIZE + size
+            if pending_size >= chunk_size:
+                yield b''.join(pending)
+                pending, pending_size = [], 0
+            continue
+        pending.append(header)
+        yield b''.join(pending)
+        pending, pending_size = [], 0
+        while size:
+            piece = min(size, chunk_size)
+            yield _read_exactly(stream, piece)
+            size -= piece
+    tail = b''.join(pending)
+    if tail:
+        yield tail
+
+
+class Codec(object):
+    def __init__(self, name):
+        if name == 'zstd' and zstandard is None:
+            raise RuntimeError('zstd needs the zstandard module')
+        self.name = name
+        self.extension = EXTENSIONS[name]
+
+    def compress(self, data):
+        if self.name == 'zstd':
+            return zstandard.ZstdCompressor(level=3).compress(data)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        if self.name == 'zstd':
+            return zstandard.ZstdDecompressor().decompress(
+                data, max_output_size=CHUNK_SIZE * 2)
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def _write_atomic(path, data):
+    """Write under a temporary name first, so a chunk that exists is whole."""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another worker got there first
+            if not os.path.isdir(directory):
+                raise
+    handle, temp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(handle, 'wb') as chunk:
+        chunk.write(data)
+    os.rename(temp_path, path)
+
+
+class ChunkStore(object):
+    """Compressed chunks keyed by SHA256, in a local directory.
+
+    `remote` is an optional base URL to fetch chunks missing from the
+    directory from, which then acts as a cache.
+    """
+
+    def __init__(self, path, codec, remote=None):
+        self.path = path
+        self.codec = codec
+        self.remote = remote.rstrip('/') if remote else None
+
+    def _relative(self, digest):
+        return '{0}/{1}{2}'.format(digest[:2], digest, self.codec.extension)
+
+    def local_path(self, digest):
+        return os.path.join(self.path, self._relative(digest))
+
+    def put(self, digest, data):
+        """Store a chunk unless present; return the bytes written."""
+        path = self.local_path(digest)
+        if os.path.exists(path):
+            return 0
+        compressed = self.codec.compress(data)
+        _write_atomic(path, compressed)
+        return len(compressed)
+
+    def get(self, digest):
+        """Return a chunk's data (and the bytes fetched for it)."""
+        fetched = 0
+        path = self.local_path(digest)
+        if not os.path.exists(path):
+            if self.remote is None:
+                raise IOError('Chunk {0} is not in {1}'.format(digest,
+                                                               self.path))
+            response = urlopen(
+                '{0}/{1}'.format(self.remote, self._relative(digest)))
+            try:
+                compressed = response.read()
+            finally:
+                response.close()
+            fetched = len(compressed)
+            _write_atomic(path, compressed)
+        with open(path, 'rb') as chunk:
+            data = self.codec.decompress(chunk.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise IOError('Chunk {0} is corrupt'.format(digest))
+        return data, fetched
+
+
+class _Feed(object):
+    """Feeds a pool from `iterable` without reading too far ahead of it.
+
+    The pool takes the items on a thread of its own, which waits for room
+    once `ahead` items are in flight; `done` makes room for one more, and
+    `abandon` wakes the thread up and drops the pool's pending work, so an
+    error does not leave the pool waiting on room that never comes.
+    """
+
+    def __init__(self, iterable, ahead):
+        self.iterable = iterable
+        self.room = threading.Semaphore(ahead)
+        self.stopped = threading.Event()
+
+    def __iter__(self):
+        for item in self.iterable:
+            self.room.acquire()
+            if self.stopped.is_set():
+                return
+            yield item
+
+    def done(self):
+        self.room.release()
+
+    def abandon(self, pool):
+        self.stopped.set()
+        self.room.release()
+        pool.terminate()
+
+
+def export(images, store, manifest_path, workers=DEFAULT_WORKERS):
+    start = time.time()
+    save = subprocess.Popen(['docker', 'save'] + list(images),
+                            stdout=subprocess.PIPE)
+    stream_digest = hashlib.sha256()
+
+    def store_chunk(data):
+        digest = hashlib.sha256(data).hexdigest()
+        return digest, len(data), store.put(digest, data)
+
+    def chunks():
+        for chunk in tar_chunks(save.stdout):
+            stream_digest.update(chunk)
+            yield chunk
+
+    entries = []
+    stored = 0
+    new_chunks = 0
+    feed = _Feed(chunks(), workers * 2)
+    pool = ThreadPool(workers)
+    try:
+        for digest, size, written in pool.imap(store_chunk, feed):
+            feed.done()
+            entries.append({'sha256': digest, 'size': size})
+            stored += written
+            new_chunks += 1 if written else 0
+    except BaseException:
+        feed.abandon(pool)
+        save.kill()
+        save.wait()
+        raise
+    pool.close()
+    pool.join()
+    if save.wait() != 0:
+        raise RuntimeError('docker save failed with {0}'.format(
+            save.returncode))
+
+    total = sum(entry['size'] for entry in entries)
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'images': list(images),
+        'compression': store.codec.name,
+        'size': total,
+        'sha256': stream_digest.hexdigest(),
+        'chunks': entries,
+    }
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    print('Exported {0} ({1:.0f}MB in {2} chunks) in {3:.0f}s; {4} new '
+          'chunks, {5:.1f}MB compressed'.format(
+              ', '.join(images), total / float(MB), len(entries),
+              time.time() - start, new_chunks, stored / float(MB)))
+    return manifest
+
+
+def read_manifest(path):
+    with open(path) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise RuntimeError('Unsupported manifest version {0}'.format(
+            manifest.get('version')))
+    return manifest
+
+
+def stream_chunks(manifest, store, workers=DEFAULT_WORKERS):
+    """Yield the manifest's chunks in order, checking the whole stream."""
+    stream_digest = hashlib.sha256()
+    fetched = [0]
+    feed = _Feed((entry['sha256'] for entry in manifest['chunks']),
+                 workers * 2)
+    pool = ThreadPool(workers)
+    try:
+        for data, fetched_bytes in pool.imap(store.get, feed):
+            feed.done()
+            fetched[0] += fetched_bytes
+            stream_digest.update(data)
+            yield data
+    except BaseException:
+        # Includes the consumer giving up on the stream (GeneratorExit)
+        feed.abandon(pool)
+        raise
+    pool.close()
+    pool.join()
+    if stream_digest.hexdigest() != manifest['sha256']:
+        raise IOError('Reassembled image stream does not match the manifest')
+    print('Fetched {0:.1f}MB of chunks missing from {1}'.format(
+        fetched[0] / float(MB), store.path))
+
+
+def import_images(manifest_path, store, workers=DEFAULT_WORKERS):
+    start = time.time()
+    manifest = read_manifest(manifest_path)
+    load = subprocess.Popen(['docker', 'load'], stdin=subprocess.PIPE)
+    try:
+        for data in stream_chunks(manifest, store, workers):
+            load.stdin.write(data)
+    finally:
+        load.stdin.close()
+    if load.wait() != 0:
+        raise RuntimeError('docker load failed with {0}'.format(
+            load.returncode))
+    print('Imported {0} in {1:.0f}s'.format(
+        ', '.join(manifest['images']), time.time() - start))
+
+
+def image_id(image):
+    return subprocess.check_output(
+        ['docker', 'image', 'inspect', '--format', '{{.Id}}', image],
+    ).decode('utf-8').strip()
+
+
+def roundtrip(image, store, workers=DEFAULT_WORKERS):
+    """Export, remove and re-import `image`; it must keep its id."""
+    original_id = image_id(image)
+    workdir = tempfile.mkdtemp(prefix='image-export-')
+    try:
+        manifest_path = os.path.join(workdir, 'manifest.json')
+        export([image], store, manifest_path, workers)
+        subprocess.check_call(['docker', 'image', 'rm', image])
+        import_images(manifest_path, store, workers)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    imported_id = image_id(image)
+    if imported_id != original_id:
+        raise RuntimeError('{0} came back as {1}, expected {2}'.format(
+            image, imported_id, original_id))
+    print('{0} survived the round trip as {1}'.format(image, imported_id))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Chunked, compressed and deduplicated docker image '
+                    'export and import.')
+    parser.add_argument('--store', required=True,
+                        help='Chunk store directory; for import, also a '
+                             'base URL to fetch missing chunks from')
+    parser.add_argument('--cache', default='image-cache',
+                        help='Where chunks fetched from a URL store are kept')
+    parser.add_argument('--compression', default='gzip',
+                        choices=sorted(EXTENSIONS))
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='Parallel compression/decompression workers')
+    commands = parser.add_subparsers(dest='command')
+    export_parser = commands.add_parser('export')
+    export_parser.add_argument('images', nargs='+')
+    export_parser.add_argument('--manifest', required=True)
+    import_parser = commands.add_parser('import')
+    import_parser.add_argument('manifest')
+    roundtrip_parser = commands.add_parser('roundtrip')
+    roundtrip_parser.add_argument('image')
+    args = parser.parse_args(argv)
+
+    if args.command == 'import':
+        manifest = read_manifest(args.manifest)
+        codec = Codec(manifest['compression'])
+        if '://' in args.store:
+            store = ChunkStore(args.cache, codec, remote=args.store)
+        else:
+            store = ChunkStore(args.store, codec)
+        import_images(args.manifest, store, args.workers)
+        return 0
+
+    store = ChunkStore(args.store, Codec(args.compression))
+    if args.command == 'export':
+        export(args.images, store, args.manifest, args.workers)
+    elif args.command == 'roundtrip':
+        roundtrip(args.image, store, args.workers)
+    else:
+        parser.error('a command is required')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,4 +12,9 @@ src_config_path=$1
 dst_config_path=$2
 
 cp $src_config_path $dst_config_path
-cfy_manager configure --private-ip $POD_IP --public-ip $POD_IP
\ No newline at end of file
+# Only configures what changed since the config was last applied, so a pod
+# restarting with the same config and IP is ready right away. Point
+# BOOT_STATE_PATH at the persistent volume holding the manager's data to keep
+# that state across pods; see manager_boot.py
+python /etc/cloudify/manager_boot.py boot --config $dst_config_path --ip $POD_IP \
+    --state ${BOOT_STATE_PATH:-/etc/cloudify/boot-state.json}
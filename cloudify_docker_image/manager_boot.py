@@ -0,0 +1,427 @@
+"""Configure an already installed manager only as much as needed.
+
+`cfy_manager configure` redoes every configuration step, although a
+container that starts with the config it was built with, on a new IP,
+only needs the steps that depend on the IP. While the image is built,
+`record` notes what those are: the config files that mention the build
+container's IP, whether the certificates carry it, and the services that
+read them. It also keeps a digest of every top level section of the config,
+with the IPs masked.
+
+On start, `boot` compares the config and the IP with what was last applied:
+
+- nothing changed: nothing is done,
+- only the IP changed: the recorded files are rewritten, the certificates
+  regenerated and the affected services restarted,
+- some sections changed: only the services those sections belong to are
+  configured again, through the installer's own `services_to_install`,
+- otherwise, or if any of that fails: a full `cfy_manager configure`.
+
+The state lives in the image, or with `--state`, on a persistent volume
+next to the manager's data, so restarted pods keep it. State describes the
+config files of the container it was written in, though, and a new pod's
+container starts from the image's files again. So each state carries the
+marker that was written next to those files, and a state is only trusted on
+the filesystem holding the same marker; the image's state is used otherwise:
+
+    python manager_boot.py record --ip 172.17.0.2
+    python manager_boot.py boot --ip $POD_IP --state /data/boot-state.json
+
+Runs with the image's own Python, 2 or 3, and the standard library only.
+"""
+from __future__ import print_function
+import os
+import re
+import sys
+import glob
+import json
+import time
+import uuid
+import socket
+import hashlib
+import argparse
+import subprocess
+from collections import OrderedDict
+
+CONFIG_PATH = '/etc/cloudify/config.yaml'
+STATE_PATH = '/etc/cloudify/boot-state.json'
+STATE_VERSION = 3
+# Identifies the container filesystem the state was recorded on
+MARKER_PATH = '/etc/cloudify/boot-marker'
+# Handed to the installer when only some services need configuring
+PARTIAL_CONFIG_PATH = '/etc/cloudify/config-changes.yaml'
+# Where the services' own config is written by `cfy_manager configure`
+CONFIG_ROOTS = [
+    '/etc/cloudify',
+    '/etc/nginx',
+    '/etc/rabbitmq',
+    '/opt/manager',
+    '/opt/mgmtworker',
+    '/opt/amqp_postgres',
+    '/opt/cloudify-stage/conf',
+    # Not the whole of it, that is the database itself
+    '/var/lib/pgsql/*/data/*.conf',
+]
+# The service reading each config root, restarted when a file in it changes
+UNITS = [
+    ('/etc/nginx', 'nginx'),
+    ('/etc/rabbitmq', 'cloudify-rabbitmq'),
+    ('/etc/cloudify/rabbitmq', 'cloudify-rabbitmq'),
+    ('/opt/manager', 'cloudify-restservice'),
+    ('/opt/mgmtworker', 'cloudify-mgmtworker'),
+    ('/opt/amqp_postgres', 'cloudify-amqp-postgres'),
+    ('/opt/cloudify-stage', 'cloudify-stage'),
+    ('/var/lib/pgsql', 'postgresql-9.5'),
+]
+CERTIFICATES = '/etc/cloudify/ssl/*.crt'
+CERTIFICATE_UNITS = ['nginx', 'cloudify-rabbitmq']
+CERTIFICATE_COMMANDS = [
+    'cfy_manager create-internal-certs',
+    'cfy_manager create-external-certs --private-ip {ip} --public-ip {ip}',
+]
+# Updates the IPs the manager keeps in its database, when installed with
+# `set_manager_ip_on_boot`
+IP_SETTER_UNIT = 'cloudify-manager-ip-setter'
+MAX_FILE_SIZE = 1024 * 1024
+IP_KEYS = re.compile(r'^\s*(private_ip|public_ip):.*$', re.MULTILINE)
+SECTION_KEY = re.compile(r'^([A-Za-z_][\w-]*)\s*:')
+SERVICES_KEY = 'services_to_install'
+# The installer's services, and the config sections only they read; any
+# other section is the manager service's
+SERVICES = ['database_service', 'queue_service', 'manager_service']
+SERVICE_SECTIONS = {
+    'postgresql_server': 'database_service',
+    'rabbitmq': 'queue_service',
+}
+# Sections every service reads
+SHARED_SECTIONS = ['', 'manager', SERVICES_KEY]
+
+
+def _ip_pattern(ip):
+    """Match `ip` alone, not as part of a longer address."""
+    return re.compile(r'(?<![\d.]){0}(?![\d])'.format(re.escape(ip)))
+
+
+def config_sections(config):
+    """Split a config.yaml into its top level sections, keyed by name.
+
+    Comments and blank lines belong to the section above them; whatever
+    precedes the first section is keyed by ''. The sections keep their
+    order, so anchors still come before their aliases.
+    """
+    sections = OrderedDict()
+    name = ''
+    for line in config.splitlines(True):
+        key = SECTION_KEY.match(line)
+        if key:
+            name = key.group(1)
+        sections[name] = sections.get(name, '') + line
+    return sections
+
+
+def section_digests(config, ip):
+    """SHA256 of each config.yaml section, with the IPs it uses masked.
+
+    The IPs are given to `cfy_manager configure` on the command line, so
+    they are masked whether or not the config itself sets them.
+    """
+    pattern = _ip_pattern(ip)
+    return dict(
+        (name, hashlib.sha256(pattern.sub('@IP@', IP_KEYS.sub('', text))
+                              .encode('utf-8')).hexdigest())
+        for name, text in config_sections(config).items())
+
+
+def _read_config(path):
+    with open(path) as config:
+        return config.read()
+
+
+def _run(command):
+    print('$ ' + command)
+    sys.stdout.flush()
+    subprocess.check_call(command, shell=True)
+
+
+def _unit_exists(unit):
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call(['systemctl', 'cat', unit], stdout=devnull,
+                               stderr=devnull) == 0
+
+
+def _walk(roots):
+    for root in roots:
+        for match in glob.glob(root):
+            if os.path.isfile(match):
+                yield match
+            for directory, _, files in os.walk(match):
+                for name in files:
+                    yield os.path.join(directory, name)
+
+
+def _text_files(roots):
+    for path in _walk(roots):
+        if (os.path.islink(path) or not os.path.isfile(path) or
+                os.path.getsize(path) > MAX_FILE_SIZE or
+                path.endswith('boot-state.json')):
+            continue
+        with open(path, 'rb') as candidate:
+            data = candidate.read()
+        if b'\0' not in data:
+            yield path, data
+
+
+def _certificates_mention(ip):
+    for certificate in glob.glob(CERTIFICATES):
+        try:
+            text = subprocess.check_output(
+                ['openssl', 'x509', '-noout', '-text', '-in', certificate])
+        except subprocess.CalledProcessError:
+            continue
+        if _ip_pattern(ip).search(text.decode('utf-8', 'replace')):
+            return True
+    return False
+
+
+def _write_marker(marker_path):
+    marker = uuid.uuid4().hex
+    with open(marker_path, 'w') as marker_file:
+        marker_file.write(marker)
+    return marker
+
+
+def _read_marker(marker_path):
+    try:
+        with open(marker_path) as marker_file:
+            return marker_file.read().strip() or None
+    except (IOError, OSError):
+        return None
+
+
+def _save_state(state, state_path):
+    with open(state_path, 'w') as state_file:
+        json.dump(state, state_file, indent=1, sort_keys=True)
+
+
+def record(ip, config_path=CONFIG_PATH, state_path=STATE_PATH,
+           roots=CONFIG_ROOTS, marker_path=MARKER_PATH):
+    """Note which configuration depends on `ip`, for `boot` to redo."""
+    pattern = _ip_pattern(ip)
+    files = sorted(path for path, data in _text_files(roots)
+                   if pattern.search(data.decode('utf-8', 'replace')))
+    certificates = _certificates_mention(ip)
+    units = set(unit for prefix, unit in UNITS
+                if any(path.startswith(prefix + '/') for path in files))
+    if certificates:
+        units.update(CERTIFICATE_UNITS)
+    state = {
+        'version': STATE_VERSION,
+        'marker': _write_marker(marker_path),
+        'ip': ip,
+        'sections': section_digests(_read_config(config_path), ip),
+        'files': files,
+        'certificates': certificates,
+        'ip_setter': _unit_exists(IP_SETTER_UNIT),
+        'units': sorted(unit for unit in units if _unit_exists(unit)),
+    }
+    _save_state(state, state_path)
+    print('Recorded {0} file(s), {1} certificates and {2} service(s) '
+          'depending on {3}'.format(len(files),
+                                    'including' if certificates else 'no',
+                                    len(state['units']), ip))
+    return state
+
+
+def read_state(state_path=STATE_PATH):
+    try:
+        with open(state_path) as state_file:
+            state = json.load(state_file)
+    except (IOError, OSError, ValueError):
+        return None
+    return state if state.get('version') == STATE_VERSION else None
+
+
+def trusted_state(state_path, marker):
+    """The state at `state_path`, if it describes this filesystem."""
+    state = read_state(state_path)
+    if state is None:
+        return None
+    if marker is None or state.get('marker') != marker:
+        print('Ignoring {0}: recorded for another container'.format(
+            state_path))
+        return None
+    return state
+
+
+def _rewrite_files(state, ip):
+    pattern = _ip_pattern(state['ip'])
+    contents = {}
+    for path in state['files']:
+        with open(path) as config_file:
+            contents[path] = config_file.read()
+        if not pattern.search(contents[path]):
+            raise RuntimeError('{0} no longer mentions {1}'.format(
+                path, state['ip']))
+    for path, content in contents.items():
+        with open(path, 'w') as config_file:
+            config_file.write(pattern.sub(ip, content))
+
+
+def _regenerate_certificates(state, ip):
+    for command in CERTIFICATE_COMMANDS:
+        _run(command.format(ip=ip))
+
+
+def _set_manager_ip(state, ip):
+    _run('systemctl restart {0}'.format(IP_SETTER_UNIT))
+
+
+def _restart_units(state, ip):
+    if state['units']:
+        _run('systemctl restart ' + ' '.join(state['units']))
+
+
+def fast_path(state, ip):
+    """Redo only the recorded IP-dependent steps; return their timings."""
+    steps = [('rewrite config files', _rewrite_files)]
+    if state['certificates']:
+        steps.append(('regenerate certificates', _regenerate_certificates))
+    if state['ip_setter']:
+        steps.append(('set manager IP', _set_manager_ip))
+    steps.append(('restart services', _restart_units))
+    timings = []
+    for name, step in steps:
+        start = time.time()
+        step(state, ip)
+        timings.append((name, time.time() - start))
+    return timings
+
+
+def full_configure(ip):
+    _run('cfy_manager configure --private-ip {0} --public-ip {0}'.format(ip))
+
+
+def installed_services(config):
+    listed = config_sections(config).get(SERVICES_KEY, '')
+    services = re.findall(r'^\s*-\s*[\'"]?(\w+)', listed, re.MULTILINE)
+    return services or list(SERVICES)
+
+
+def changed_services(config, changed_sections):
+    """The services to configure again for `changed_sections`, or None
+    when every installed service has to be."""
+    if set(changed_sections) & set(SHARED_SECTIONS):
+        return None
+    installed = installed_services(config)
+    services = set(SERVICE_SECTIONS.get(name, 'manager_service')
+                   for name in changed_sections)
+    if set(installed) <= services:
+        return None
+    return [service for service in installed if service in services]
+
+
+def partial_configure(ip, config, services,
+                      partial_path=PARTIAL_CONFIG_PATH):
+    """Configure only `services`, from the full config otherwise."""
+    sections = config_sections(config)
+    sections[SERVICES_KEY] = '{0}:\n{1}'.format(SERVICES_KEY, ''.join(
+        "  - '{0}'\n".format(service) for service in services))
+    with open(partial_path, 'w') as partial:
+        partial.write(''.join(
+            text if text.endswith('\n') else text + '\n'
+            for text in sections.values()))
+    _run('cfy_manager configure -c {0} --private-ip {1} --public-ip {1}'
+         .format(partial_path, ip))
+
+
+def boot(ip, config_path=CONFIG_PATH, state_path=STATE_PATH,
+         image_state_path=STATE_PATH, marker_path=MARKER_PATH):
+    """Configure the manager for `ip`, as little as its state allows.
+
+    A `state_path` that does not exist yet (a new persistent volume), or
+    that was recorded in another container (a previous pod), is replaced
+    by the state recorded in the image.
+    """
+    start = time.time()
+    marker = _read_marker(marker_path)
+    state = (trusted_state(state_path, marker) or
+             trusted_state(image_state_path, marker))
+    config = _read_config(config_path)
+    sections = section_digests(config, ip)
+    changed = []
+    if state is not None:
+        changed = sorted(
+            name for name in set(sections) | set(state['sections'])
+            if sections.get(name) != state['sections'].get(name))
+    services = changed_services(config, changed) if changed else None
+
+    if state is None:
+        reason = 'no boot state recorded'
+    elif not changed and state['ip'] == ip:
+        print('Config and IP unchanged, nothing to configure')
+        return 'unchanged'
+    elif not changed:
+        try:
+            timings = fast_path(state, ip)
+        except Exception as e:
+            reason = 'the fast path failed: {0}'.format(e)
+        else:
+            state['ip'] = ip
+            # The image's own marker would vouch for this state in any
+            # container started from the image
+            state['marker'] = _write_marker(marker_path)
+            _save_state(state, state_path)
+            print('Reconfigured for {0} in {1:.1f}s ({2})'.format(
+                ip, time.time() - start,
+                '  '.join('{0}={1:.1f}s'.format(name, seconds)
+                          for name, seconds in timings)))
+            return 'fast'
+    elif state['ip'] == ip and services:
+        print('Sections {0} changed, configuring {1}'.format(
+            ', '.join(changed), ', '.join(services)))
+        try:
+            partial_configure(ip, config, services)
+        except (subprocess.CalledProcessError, IOError, OSError) as e:
+            reason = 'configuring {0} failed: {1}'.format(
+                ', '.join(services), e)
+        else:
+            record(ip, config_path, state_path, marker_path=marker_path)
+            print('Configured {0} in {1:.1f}s'.format(
+                ', '.join(services), time.time() - start))
+            return 'partial'
+    else:
+        reason = 'sections {0} changed{1}'.format(
+            ', '.join(changed), '' if state['ip'] == ip else ', and the IP')
+    print('Running a full configure: {0}'.format(reason))
+    full_configure(ip)
+    record(ip, config_path, state_path, marker_path=marker_path)
+    print('Configured for {0} in {1:.1f}s'.format(ip, time.time() - start))
+    return 'full'
+
+
+def _default_ip():
+    return socket.gethostbyname(socket.gethostname())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Record the configuration of an installed manager, or '
+                    'apply only what changed since.')
+    parser.add_argument('command', choices=['record', 'boot'])
+    parser.add_argument('--ip', help='Defaults to the IP of the hostname')
+    parser.add_argument('--config', default=CONFIG_PATH)
+    parser.add_argument('--state', default=STATE_PATH,
+                        help='Put it on a persistent volume to keep it '
+                             'across pods; starts off as the image\'s own')
+    args = parser.parse_args(argv)
+
+    ip = args.ip or _default_ip()
+    if args.command == 'record':
+        record(ip, args.config, args.state)
+    else:
+        boot(ip, args.config, args.state)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,316 @@
+"""Publish a built image to a registry under several tags.
+
+The layers are pushed once, under the first tag. Every other tag is then
+pointed at the very manifest that push produced, concurrently, straight
+through the registry API (a manifest PUT: no layer is sent twice). A PUT
+replaces a tag atomically, so no tag ever disappears from the registry
+while an upload is in flight. The registry is authenticated against once,
+both for `docker push` and for the API:
+
+    python publish_image.py docker-cfy-rabbitmq \\
+        cloudifycosmo/community-cloudify-rabbitmq 5.1-ga latest
+
+Registries on localhost are spoken to over plain HTTP, so a local
+`docker run -d -p 5000:5000 registry:2` stands in for Docker Hub:
+
+    python publish_image.py docker-cfy-rabbitmq \\
+        localhost:5000/cloudify-rabbitmq 5.1-ga latest
+
+The bytes uploaded (layers not already in the registry) and the time taken
+are printed at the end.
+"""
+from __future__ import print_function
+import os
+import re
+import sys
+import json
+import time
+import base64
+import argparse
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+try:
+    from urllib.error import HTTPError
+    from urllib.parse import urlencode
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib import urlencode
+    from urllib2 import HTTPError, Request, urlopen
+
+DOCKER_HUB = 'registry-1.docker.io'
+# Hub is logged in to under this name, not under its registry's host name
+DOCKER_HUB_LOGIN = 'docker.io'
+MANIFEST_TYPES = [
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.oci.image.index.v1+json',
+]
+# `docker push` progress lines, keyed by the first 12 characters of a
+# layer's diff id
+PUSH_PROGRESS = re.compile(r'^([0-9a-f]{12}): (Pushed|Layer already exists|'
+                           r'Mounted from .*)$')
+PUSHED_DIGEST = re.compile(r'digest: (sha256:[0-9a-f]{64}) size: (\d+)')
+MB = 1024 * 1024
+
+_print_lock = threading.Lock()
+
+
+def log(message):
+    with _print_lock:
+        print(message)
+        sys.stdout.flush()
+
+
+def split_repository(repository):
+    """Split `repository` into its registry host and its name there."""
+    parts = repository.split('/', 1)
+    if len(parts) == 2 and ('.' in parts[0] or ':' in parts[0] or
+                            parts[0] == 'localhost'):
+        return parts[0], parts[1]
+    if len(parts) == 1:
+        return DOCKER_HUB, 'library/' + repository
+    return DOCKER_HUB, repository
+
+
+def _parse_challenge(header):
+    """Parse a WWW-Authenticate header into its scheme and parameters."""
+    scheme, _, params = header.partition(' ')
+    return scheme.lower(), dict(re.findall(r'(\w+)="([^"]*)"', params))
+
+
+class Registry(object):
+    """A minimal client of the registry HTTP API (v2), for manifests.
+
+    Authenticates once per instance: the bearer token, when the registry
+    asks for one, is fetched for both pull and push of the repository.
+    """
+
+    def __init__(self, host, name, username=None, password=None):
+        self.host = host
+        self.name = name
+        self.username = username
+        self.password = password
+        local = host.split(':')[0] in ('localhost', '127.0.0.1')
+        self.base_url = '{0}://{1}/v2'.format('http' if local else 'https',
+                                              host)
+        self._authorization = None
+        self._auth_lock = threading.Lock()
+
+    def _basic(self):
+        credentials = '{0}:{1}'.format(self.username, self.password)
+        return 'Basic ' + base64.b64encode(
+            credentials.encode('utf-8')).decode('ascii')
+
+    def _authenticate(self):
+        with self._auth_lock:
+            if self._authorization is not None:
+                return self._authorization
+            try:
+                urlopen(self.base_url + '/').close()
+                self._authorization = ''
+                return self._authorization
+            except HTTPError as e:
+                if e.code != 401:
+                    raise
+                challenge = e.headers.get('WWW-Authenticate', '')
+            scheme, params = _parse_challenge(challenge)
+            if scheme == 'basic':
+                self._authorization = self._basic()
+                return self._authorization
+            query = {
+                'service': params.get('service', ''),
+                'scope': 'repository:{0}:pull,push'.format(self.name),
+            }
+            request = Request('{0}?{1}'.format(params['realm'],
+                                               urlencode(query)))
+            if self.username:
+                request.add_header('Authorization', self._basic())
+            response = urlopen(request)
+            try:
+                body = json.loads(response.read().decode('utf-8'))
+            finally:
+                response.close()
+            self._authorization = 'Bearer ' + (body.get('token') or
+                                               body['access_token'])
+            return self._authorization
+
+    def _request(self, method, path, data=None, headers=None):
+        request = Request(
+            '{0}/{1}/{2}'.format(self.base_url, self.name, path),
+            data=data, headers=headers or {})
+        request.get_method = lambda: method
+        authorization = self._authenticate()
+        if authorization:
+            request.add_header('Authorization', authorization)
+        response = urlopen(request)
+        try:
+            return response.read(), response.headers
+        finally:
+            response.close()
+
+    def get_manifest(self, reference):
+        """Return a manifest's exact bytes and content type."""
+        body, headers = self._request(
+            'GET', 'manifests/' + reference,
+            headers={'Accept': ', '.join(MANIFEST_TYPES)})
+        return body, headers.get('Content-Type')
+
+    def put_manifest(self, tag, body, content_type):
+        self._request('PUT', 'manifests/' + tag, data=body,
+                      headers={'Content-Type': content_type})
+
+    def get_blob(self, digest):
+        return self._request('GET', 'blobs/' + digest)[0]
+
+
+class Publisher(object):
+    def __init__(self, image, repository, tags, username=None,
+                 password=None, workers=None):
+        self.image = image
+        self.repository = repository
+        self.tags = tags
+        self.username = username
+        self.password = password
+        self.workers = workers or len(tags)
+        host, name = split_repository(repository)
+        self.login_host = DOCKER_HUB_LOGIN if host == DOCKER_HUB else host
+        self.registry = Registry(host, name, username, password)
+        self.timings = []
+
+    def _step(self, name, func, *args):
+        start = time.time()
+        result = func(*args)
+        self.timings.append((name, time.time() - start))
+        return result
+
+    def _login(self):
+        login = subprocess.Popen(
+            ['docker', 'login', '--username', self.username,
+             '--password-stdin', self.login_host],
+            stdin=subprocess.PIPE)
+        login.communicate(self.password.encode('utf-8'))
+        if login.returncode != 0:
+            raise RuntimeError('docker login to {0} failed'.format(
+                self.login_host))
+
+    def _push(self, reference):
+        """`docker push` one reference; return its digest and the diff id
+        prefixes of the layers actually uploaded."""
+        subprocess.check_call(['docker', 'tag', self.image, reference])
+        push = subprocess.Popen(['docker', 'push', reference],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        pushed = set()
+        digest = None
+        for line in iter(push.stdout.readline, b''):
+            line = line.decode('utf-8', 'replace').rstrip()
+            log(line)
+            progress = PUSH_PROGRESS.match(line)
+            if progress and progress.group(2) == 'Pushed':
+                pushed.add(progress.group(1))
+            pushed_digest = PUSHED_DIGEST.search(line)
+            if pushed_digest:
+                digest = pushed_digest.group(1)
+        if push.wait() != 0:
+            raise RuntimeError('docker push {0} failed'.format(reference))
+        return digest, pushed
+
+    def _uploaded_bytes(self, manifest, pushed):
+        """Sum the compressed size of the layers `docker push` uploaded.
+
+        Push progress only names layers by their diff id, which the image
+        config lists in the same order as the manifest lists the layers.
+        """
+        manifest = json.loads(manifest.decode('utf-8'))
+        if 'layers' not in manifest:
+            # A multi-platform index: its per-platform manifests are pushed
+            # as they are, and are not worth resolving for a report
+            return None
+        config = json.loads(self.registry.get_blob(
+            manifest['config']['digest']).decode('utf-8'))
+        diff_ids = config['rootfs']['diff_ids']
+        return sum(
+            layer['size']
+            for diff_id, layer in zip(diff_ids, manifest['layers'])
+            if diff_id.split(':', 1)[-1][:12] in pushed)
+
+    def _retag(self, tag, manifest, content_type):
+        start = time.time()
+        self.registry.put_manifest(tag, manifest, content_type)
+        log('Pointed {0}:{1} at the pushed manifest in {2:.1f}s'.format(
+            self.repository, tag, time.time() - start))
+
+    def publish(self):
+        start = time.time()
+        logged_in = bool(self.username)
+        if logged_in:
+            self._step('login', self._login)
+        try:
+            first = '{0}:{1}'.format(self.repository, self.tags[0])
+            digest, pushed = self._step('push', self._push, first)
+        finally:
+            if logged_in:
+                subprocess.call(['docker', 'logout', self.login_host])
+
+        manifest, content_type = self.registry.get_manifest(
+            digest or self.tags[0])
+        uploaded = self._uploaded_bytes(manifest, pushed)
+
+        other_tags = self.tags[1:]
+        if other_tags:
+            pool = ThreadPool(min(self.workers, len(other_tags)))
+            try:
+                self._step('tag', pool.map, lambda tag: self._retag(
+                    tag, manifest, content_type), other_tags)
+            finally:
+                pool.close()
+                pool.join()
+
+        elapsed = time.time() - start
+        log('Published {0} as {1}:{2}'.format(
+            self.image, self.repository, ','.join(self.tags)))
+        log('Uploaded {0} in {1:.0f}s ({2})'.format(
+            'unknown bytes' if uploaded is None else
+            '{0:.1f}MB in {1} layer(s)'.format(uploaded / float(MB),
+                                               len(pushed)),
+            elapsed,
+            '  '.join('{0}={1:.0f}s'.format(name, seconds)
+                      for name, seconds in self.timings)))
+        return uploaded, elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Push an image once and point several tags at it.')
+    parser.add_argument('image', help='The local image to publish')
+    parser.add_argument('repository',
+                        help='Registry repository, e.g. '
+                             'cloudifycosmo/community-cloudify-rabbitmq '
+                             'or localhost:5000/cloudify-rabbitmq')
+    parser.add_argument('tags', nargs='+', metavar='TAG',
+                        help='The layers are pushed under the first one')
+    parser.add_argument('--username',
+                        default=os.environ.get('DOCKER_BUILD_ID'),
+                        help='Defaults to $DOCKER_BUILD_ID; anonymous if '
+                             'not set')
+    parser.add_argument('--password-env', default='DOCKER_BUILD_PASSWORD',
+                        help='Variable holding the password (default: '
+                             '%(default)s)')
+    parser.add_argument('--workers', type=int,
+                        help='Concurrent tag updates, all at once by default')
+    args = parser.parse_args(argv)
+    password = os.environ.get(args.password_env)
+    if args.username and not password:
+        parser.error('${0} must hold the password of {1}'.format(
+            args.password_env, args.username))
+
+    Publisher(args.image, args.repository, args.tags, args.username,
+              password, args.workers).publish()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
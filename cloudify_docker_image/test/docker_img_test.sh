@@ -7,41 +7,13 @@ function validate(){
     fi
 }
 
-function upload_manager(){
-    echo "Uploading Cloudify manager ..."
-    docker-compose up -d
-    sleep 5
-}
-
-function put_manager_in_sanity_mode(){
-    echo "Placing manager in sanity"
-    docker-compose exec -T cloudify_img touch /opt/manager/sanity_mode
-    sleep 15s
-    echo "Manager now in sanity mode"
-}
-
-function test_manager(){
-    echo "Testing Cloudify manager ..."
-    ip_address=$(docker inspect --format='{{range .NetworkSettings.Networks}}{{.IPAddress}}{{end}}' $CONTAINER_NAME)
-    echo "ip_address=$ip_address"
-    echo "docker-compose exec -T cloudify_img cfy_manager sanity-check --private-ip $ip_address"
-    docker-compose exec -T cloudify_img cfy_manager sanity-check --private-ip $ip_address
-    if [ $? -ne 0 ]; then
-        echo "cfy_manager sanity-check failed"
-        docker-compose exec -T cloudify_img cat /var/log/cloudify/manager/cfy_manager.log
-        remove_manager
-        exit 1
-    fi
-}
-
-function remove_manager(){
-    echo "Removing Cloudify manager ..."
-    docker-compose down
-}
-
-
 validate
-upload_manager
-put_manager_in_sanity_mode
-test_manager
-remove_manager
+# Every container runs under a compose project of its own, polled until
+# systemd and the manager's ports are up; see sanity_check.py.
+# IMAGE_NAME checks a single all-in-one image, otherwise the VARIANTS (all of
+# the images build_images.py tags, by default) are checked concurrently
+cd "$(dirname "$0")"
+if [ -n "${IMAGE_NAME}" ]; then
+    exec python sanity_check.py --image manager-aio=${IMAGE_NAME}
+fi
+exec python sanity_check.py ${VARIANTS}
@@ -0,0 +1,293 @@
+"""Sanity check the built manager images, every variant at once.
+
+Each variant is started from docker-compose.yml under a compose project (and
+container name) of its own, so the variants, and concurrent jobs, never
+clash. Rather than sleeping for a fixed time, the harness polls systemd
+inside the container until it has no start-up jobs left, and the variant's
+service ports until they accept connections; the checks then run
+concurrently, so validating every image takes about as long as validating
+the slowest one:
+
+    python sanity_check.py manager-aio rabbitmq
+    python sanity_check.py --image manager-aio=docker-cfy-manager-aio
+
+The all-in-one manager is put in sanity mode and checked with
+`cfy_manager sanity-check`. The other variants only have their packages
+installed at build time, so for them the installed RPM is checked. The logs
+of every variant that fails are collected under `sanity-logs/VARIANT`.
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import uuid
+import argparse
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from variants import VARIANTS  # noqa: E402
+
+COMPOSE_FILE = os.path.join(HERE, 'docker-compose.yml')
+# What the all-in-one manager listens on once it is up: nginx, the internal
+# REST service, RabbitMQ and PostgreSQL
+MANAGER_PORTS = [80, 53333, 5671, 5432]
+STARTUP_TIMEOUT = 600
+POLL_INTERVAL = 2
+PACKAGE_CHECK = 'rpm -q cloudify-manager-install && cfy_manager --help'
+LOG_PATHS = ['/var/log/cloudify', '/etc/cloudify/config.yaml']
+
+_print_lock = threading.Lock()
+
+
+def log(message):
+    with _print_lock:
+        print(message)
+        sys.stdout.flush()
+
+
+class CheckFailed(Exception):
+    pass
+
+
+class VariantCheck(object):
+    def __init__(self, variant, image, run_id, log_dir, timeout):
+        self.variant = variant
+        self.image = image
+        self.project = 'cfy-sanity-{0}-{1}'.format(run_id, variant.name)
+        self.container = self.project
+        self.log_dir = os.path.join(log_dir, variant.name)
+        self.timeout = timeout
+        self.ports = MANAGER_PORTS if variant.full_install else []
+        self.timings = []
+        self.error = None
+
+    def _compose(self, *args, **kwargs):
+        env = dict(os.environ, IMAGE_NAME=self.image,
+                   CONTAINER_NAME=self.container)
+        return subprocess.check_output(
+            ['docker-compose', '-f', COMPOSE_FILE, '-p', self.project] +
+            list(args),
+            env=env, stderr=subprocess.STDOUT, **kwargs).decode('utf-8')
+
+    def _exec(self, command):
+        """Run `command` in the container, return its exit code and output."""
+        process = subprocess.Popen(
+            ['docker', 'exec', self.container, 'bash', '-c', command],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0].decode('utf-8', 'replace')
+        return process.returncode, output.strip()
+
+    def _wait_for(self, description, predicate):
+        deadline = time.time() + self.timeout
+        while True:
+            ready, state = predicate()
+            if ready:
+                return
+            if time.time() > deadline:
+                raise CheckFailed('{0} timed out after {1}s: {2}'.format(
+                    description, self.timeout, state))
+            time.sleep(POLL_INTERVAL)
+
+    def _systemd_settled(self):
+        _, state = self._exec('systemctl is-system-running')
+        if state not in ('running', 'degraded'):
+            return False, state
+        _, jobs = self._exec('systemctl list-jobs --no-legend')
+        if jobs:
+            return False, jobs
+        if state == 'degraded':
+            _, failed = self._exec('systemctl --failed --no-legend')
+            log('[{0}] systemd is degraded:\n{1}'.format(
+                self.variant.name, failed))
+        return True, state
+
+    def _ports_open(self):
+        code, closed = self._exec(
+            'for port in {0}; do (echo > /dev/tcp/127.0.0.1/$port) '
+            '2> /dev/null || echo $port; done'.format(
+                ' '.join(str(port) for port in self.ports)))
+        return code == 0 and not closed, 'closed ports: ' + closed
+
+    def _step(self, name, func, *args):
+        log('[{0}] {1}...'.format(self.variant.name, name))
+        start = time.time()
+        result = func(*args)
+        self.timings.append((name, time.time() - start))
+        return result
+
+    def _start(self):
+        self._compose('up', '-d')
+
+    def _wait_ready(self):
+        self._wait_for('systemd start-up', self._systemd_settled)
+        if self.ports:
+            self._wait_for('service ports', self._ports_open)
+
+    def _unit_starts(self):
+        """When each active cloudify service last (re)started."""
+        _, output = self._exec(
+            'units=$(systemctl list-units --type=service --no-legend '
+            '"cloudify-*" | grep -o "[^ ]*\\.service"); '
+            '[ -z "$units" ] || systemctl show '
+            '-p Id -p ActiveEnterTimestampMonotonic $units')
+        starts = {}
+        unit = None
+        for line in output.splitlines():
+            name, _, value = line.partition('=')
+            if name == 'Id':
+                unit = value
+            elif name == 'ActiveEnterTimestampMonotonic' and unit:
+                starts[unit] = value
+        return starts
+
+    def _restart_seen(self, before):
+        _, jobs = self._exec('systemctl list-jobs --no-legend')
+        if jobs:
+            return True, jobs
+        restarted = [unit for unit, start in self._unit_starts().items()
+                     if start != before.get(unit)]
+        return bool(restarted), 'restarted: {0}'.format(
+            ', '.join(restarted) or 'nothing yet')
+
+    def _enter_sanity_mode(self):
+        before = self._unit_starts()
+        code, output = self._exec('touch /opt/manager/sanity_mode')
+        if code != 0:
+            raise CheckFailed('Could not enter sanity mode: ' + output)
+        # Services restart to pick the mode up. Until the restart has begun
+        # systemd still reports the state settled before the touch, so wait
+        # for it to begin and only then for everything to settle again
+        self._wait_for('service restart',
+                       lambda: self._restart_seen(before))
+        self._wait_ready()
+
+    def _check(self):
+        if self.variant.full_install:
+            ip = subprocess.check_output(
+                ['docker', 'inspect', '--format',
+                 '{{range .NetworkSettings.Networks}}{{.IPAddress}}{{end}}',
+                 self.container]).decode('utf-8').strip()
+            command = 'cfy_manager sanity-check --private-ip ' + ip
+        else:
+            command = PACKAGE_CHECK
+        code, output = self._exec(command)
+        if code != 0:
+            raise CheckFailed('`{0}` failed:\n{1}'.format(command, output))
+
+    def collect_logs(self):
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        commands = {
+            'journal.log': 'journalctl --no-pager',
+            'systemd-failed.log': 'systemctl --failed --no-pager',
+        }
+        for name, command in sorted(commands.items()):
+            output = self._exec(command)[1]
+            with open(os.path.join(self.log_dir, name), 'w') as log_file:
+                log_file.write(output + '\n')
+        with open(os.path.join(self.log_dir, 'container.log'), 'w') as out:
+            subprocess.call(['docker', 'logs', self.container],
+                            stdout=out, stderr=subprocess.STDOUT)
+        for path in LOG_PATHS:
+            subprocess.call(
+                ['docker', 'cp', '{0}:{1}'.format(self.container, path),
+                 self.log_dir],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def run(self, keep=False):
+        start = time.time()
+        try:
+            self._step('start', self._start)
+            self._step('wait for start-up', self._wait_ready)
+            if self.variant.full_install:
+                self._step('enter sanity mode', self._enter_sanity_mode)
+            self._step('sanity check', self._check)
+        except Exception as e:
+            self.error = e
+            log('[{0}] failed: {1}'.format(self.variant.name, e))
+            try:
+                self.collect_logs()
+                log('[{0}] logs collected in {1}'.format(
+                    self.variant.name, self.log_dir))
+            except Exception as log_error:
+                log('[{0}] could not collect logs: {1}'.format(
+                    self.variant.name, log_error))
+        finally:
+            if not keep:
+                try:
+                    self._compose('down', '-v')
+                except subprocess.CalledProcessError as e:
+                    log('[{0}] could not remove {1}: {2}'.format(
+                        self.variant.name, self.project, e.output))
+        self.timings.append(('total', time.time() - start))
+        return self
+
+
+def check(images, log_dir='sanity-logs', timeout=STARTUP_TIMEOUT,
+          keep=False):
+    """Check every (variant, image) pair of `images` concurrently."""
+    run_id = uuid.uuid4().hex[:8]
+    start = time.time()
+    checks = [VariantCheck(VARIANTS[name], image, run_id, log_dir, timeout)
+              for name, image in images]
+    pool = ThreadPool(len(checks))
+    try:
+        pool.map(lambda variant_check: variant_check.run(keep), checks)
+    finally:
+        pool.close()
+        pool.join()
+
+    for variant_check in checks:
+        log('{0:<16} {1}  {2}'.format(
+            variant_check.variant.name,
+            'FAILED' if variant_check.error else 'ok    ',
+            '  '.join('{0}={1:.0f}s'.format(name, seconds)
+                      for name, seconds in variant_check.timings)))
+    log('Checked {0} image(s) in {1:.0f}s'.format(len(checks),
+                                                  time.time() - start))
+    return checks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Sanity check Cloudify Manager docker images '
+                    'concurrently.')
+    parser.add_argument('variants', nargs='*', metavar='VARIANT',
+                        help='One or more of: {0} (default: all)'.format(
+                            ', '.join(sorted(VARIANTS))))
+    parser.add_argument('--image', action='append', default=[],
+                        metavar='VARIANT=IMAGE',
+                        help='Image to check for a variant, instead of the '
+                             'VARIANT_HUB_NAME:latest build_images.py tags')
+    parser.add_argument('--log-dir', default='sanity-logs',
+                        help='Where the logs of failed variants go')
+    parser.add_argument('--timeout', type=int, default=STARTUP_TIMEOUT,
+                        help='Seconds to wait for each readiness condition')
+    parser.add_argument('--keep', action='store_true',
+                        help='Leave the containers running afterwards')
+    args = parser.parse_args(argv)
+
+    overrides = {}
+    for override in args.image:
+        name, _, image = override.partition('=')
+        if not image:
+            parser.error('--image takes VARIANT=IMAGE, not ' + override)
+        overrides[name] = image
+    names = args.variants or sorted(overrides) or sorted(VARIANTS)
+    unknown = (set(names) | set(overrides)) - set(VARIANTS)
+    if unknown:
+        parser.error('unknown variant(s): ' + ', '.join(sorted(unknown)))
+
+    checks = check(
+        [(name, overrides.get(name, '{0}:latest'.format(
+            VARIANTS[name].hub_name))) for name in names],
+        args.log_dir, args.timeout, args.keep)
+    return 1 if any(variant_check.error for variant_check in checks) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
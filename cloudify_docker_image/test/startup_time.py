@@ -0,0 +1,93 @@
+"""Measure how long a manager container takes to be ready on a new IP.
+
+Every run starts the image under a compose project of its own (see
+sanity_check.py), so the container gets an IP on a fresh network, unlike
+the one the image was built on. Once systemd has settled, the container is
+configured the way k8s_copy_and_install.sh configures a pod, and timed
+until its services accept connections again. `full` drops the recorded boot
+state first and so measures a full `cfy_manager configure`; `fast`
+measures the manager_boot.py fast path:
+
+    python startup_time.py --runs 3 docker-cfy-manager-aio
+"""
+from __future__ import print_function
+import sys
+import time
+import uuid
+import argparse
+
+from sanity_check import VariantCheck, VARIANTS, log
+
+CONFIG_LOCATION = '/etc/cloudify'
+MODES = ['full', 'fast']
+
+
+class StartupRun(VariantCheck):
+    def __init__(self, image, mode, run_id, timeout):
+        super(StartupRun, self).__init__(
+            VARIANTS['manager-aio'], image, run_id, 'startup-logs', timeout)
+        self.mode = mode
+        self.project = self.container = '{0}-{1}'.format(self.project, mode)
+
+    def _configure(self):
+        if self.mode == 'full':
+            self._exec('rm -f {0}/boot-state.json'.format(CONFIG_LOCATION))
+        code, output = self._exec(
+            'cp {0}/config.yaml /tmp/config.yaml && '
+            'POD_IP=$(hostname -i) bash {0}/k8s_copy_and_install.sh '
+            '/tmp/config.yaml {0}/config.yaml'.format(CONFIG_LOCATION))
+        if code != 0:
+            raise RuntimeError('Configure failed:\n' + output)
+        log(output)
+
+    def measure(self):
+        """Return the seconds from configure until ready, or None."""
+        try:
+            self._start()
+            self._wait_ready()
+            start = time.time()
+            self._configure()
+            self._wait_ready()
+            return time.time() - start
+        except Exception as e:
+            log('[{0}] failed: {1}'.format(self.mode, e))
+            self.collect_logs()
+            return None
+        finally:
+            self._compose('down', '-v')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time a manager container becoming ready on a new IP, '
+                    'with a full configure and with the fast path.')
+    parser.add_argument('image', help='An all-in-one manager image')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--timeout', type=int, default=900)
+    args = parser.parse_args(argv)
+
+    results = dict((mode, []) for mode in MODES)
+    for run in range(args.runs):
+        for mode in MODES:
+            seconds = StartupRun(args.image, mode, uuid.uuid4().hex[:8],
+                                 args.timeout).measure()
+            log('Run {0} {1}: {2}'.format(
+                run + 1, mode,
+                'failed' if seconds is None else '{0:.1f}s'.format(seconds)))
+            results[mode].append(seconds)
+
+    for mode in MODES:
+        times = sorted(seconds for seconds in results[mode]
+                       if seconds is not None)
+        if times:
+            log('{0:<5} min={1:.1f}s median={2:.1f}s max={3:.1f}s '
+                '({4}/{5} runs)'.format(mode, times[0],
+                                        times[len(times) // 2], times[-1],
+                                        len(times), args.runs))
+        else:
+            log('{0:<5} every run failed'.format(mode))
+    return 0 if all(None not in results[mode] for mode in MODES) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""Tests of the chunked image export and import, without docker.
+
+    cd cloudify_docker_image && python -m pytest test_export_image.py
+"""
+import io
+import hashlib
+import tarfile
+import tempfile
+import threading
+import shutil
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import export_image
+from export_image import ChunkStore, Codec, export, stream_chunks
+
+# Long enough for any of these to finish, short of hanging the suite
+DEADLINE = 10
+
+
+def _tar(members=8, size=export_image.LARGE_MEMBER):
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode='w') as archive:
+        for number in range(members):
+            data = bytes(bytearray([number])) * size
+            info = tarfile.TarInfo('layer{0}.tar'.format(number))
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return stream.getvalue()
+
+
+def _docker_save(data):
+    save = mock.Mock(returncode=0)
+    save.stdout = io.BytesIO(data)
+    save.wait.return_value = 0
+    return save
+
+
+class FailingStore(ChunkStore):
+    """Fails on the `fail_at`th chunk stored or fetched."""
+
+    def __init__(self, path, fail_at):
+        super(FailingStore, self).__init__(path, Codec('gzip'))
+        self.fail_at = fail_at
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _fail(self, digest):
+        with self.lock:
+            self.calls += 1
+            if self.calls == self.fail_at:
+                raise IOError('Chunk {0} is corrupt'.format(digest))
+
+    def put(self, digest, data):
+        self._fail(digest)
+        return super(FailingStore, self).put(digest, data)
+
+    def get(self, digest):
+        self._fail(digest)
+        return b'', 0
+
+
+class ExportImageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    def _raises_in_time(self, call):
+        """Run `call` on a thread; return what it raised, failing if it
+        hangs."""
+        raised = []
+
+        def run():
+            try:
+                call()
+            except Exception as e:
+                raised.append(e)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(DEADLINE)
+        self.assertFalse(thread.is_alive(), 'hung instead of failing')
+        return raised
+
+    def test_export_round_trips(self):
+        data = _tar()
+        store = ChunkStore(self.workdir, Codec('gzip'))
+        manifest_path = '{0}/manifest.json'.format(self.workdir)
+        with mock.patch.object(export_image.subprocess, 'Popen',
+                               return_value=_docker_save(data)):
+            manifest = export(['image'], store, manifest_path, workers=2)
+
+        self.assertEqual(hashlib.sha256(data).hexdigest(), manifest['sha256'])
+        self.assertEqual(data, b''.join(stream_chunks(manifest, store, 2)))
+
+    def test_export_fails_on_a_chunk_it_cannot_store(self):
+        store = FailingStore(self.workdir, fail_at=3)
+        manifest_path = '{0}/manifest.json'.format(self.workdir)
+        save = _docker_save(_tar())
+        with mock.patch.object(export_image.subprocess, 'Popen',
+                               return_value=save):
+            raised = self._raises_in_time(
+                lambda: export(['image'], store, manifest_path, workers=1))
+
+        self.assertEqual(['Chunk'], [str(e).split()[0] for e in raised])
+        self.assertTrue(save.kill.called)
+
+    def test_import_fails_on_a_corrupt_chunk(self):
+        manifest = {
+            'sha256': '',
+            'chunks': [{'sha256': 'c{0}'.format(number), 'size': 0}
+                       for number in range(20)],
+        }
+        store = FailingStore(self.workdir, fail_at=4)
+
+        raised = self._raises_in_time(
+            lambda: list(stream_chunks(manifest, store, workers=1)))
+
+        self.assertEqual(['Chunk c3 is corrupt'], [str(e) for e in raised])
+
+    def test_import_stops_when_the_stream_is_abandoned(self):
+        manifest = {
+            'sha256': '',
+            'chunks': [{'sha256': 'c{0}'.format(number), 'size': 0}
+                       for number in range(20)],
+        }
+        store = FailingStore(self.workdir, fail_at=None)
+
+        def abandon():
+            chunks = stream_chunks(manifest, store, workers=1)
+            next(chunks)
+            chunks.close()
+
+        self.assertEqual([], self._raises_in_time(abandon))
+        self.assertLess(store.calls, 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+"""The Cloudify Manager image variants and their config.yaml."""
+
+# Stands in for the container's IP until the container that installs the
+# manager replaces it
+CONTAINER_IP_PLACEHOLDER = '@CONTAINER_IP@'
+
+CONFIG_HEADER = """
+manager:
+  private_ip: {ip}
+  public_ip: {ip}
+  set_manager_ip_on_boot: true
+  security:
+    admin_password: admin
+monitoring_install: &monitoring_install
+  skip_installation: false
+"""
+
+POSTGRESQL_SERVER = """postgresql_server:
+  enable_remote_connections: true
+  postgres_password: admin
+  ssl_enabled: true
+"""
+
+
+class Variant(object):
+    def __init__(self, name, pub_name, hub_name, services=None, extra='',
+                 full_install=False):
+        self.name = name
+        # Local name of the committed image, and its Docker Hub repository
+        self.pub_name = pub_name
+        self.hub_name = hub_name
+        self.services = services or []
+        self.extra = extra
+        # Only the all-in-one manager is fully installed at build time,
+        # the others only get their packages installed
+        self.full_install = full_install
+
+    def config(self, ip):
+        config = CONFIG_HEADER.format(ip=ip) + self.extra
+        if self.services:
+            config += 'services_to_install:\n' + ''.join(
+                "  - '{0}'\n".format(service) for service in self.services)
+        return config
+
+    @property
+    def install_command(self):
+        if self.full_install:
+            return 'cfy_manager install'
+        return 'cfy_manager install --only-install'
+
+
+VARIANTS = dict((variant.name, variant) for variant in [
+    Variant('manager-aio', 'docker-cfy-manager-aio', 'cloudify-manager-aio',
+            full_install=True),
+    Variant('postgresql', 'docker-cfy-postgresql', 'cloudify-postgresql',
+            services=['database_service'], extra=POSTGRESQL_SERVER),
+    Variant('rabbitmq', 'docker-cfy-rabbitmq', 'cloudify-rabbitmq',
+            services=['queue_service']),
+    Variant('manager-worker', 'docker-cfy-manager-worker',
+            'cloudify-manager-worker', services=['manager_service']),
+])
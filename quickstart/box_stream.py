@@ -0,0 +1,299 @@
+"""Build a Vagrant .box straight from a block device in a single pass.
+
+The device is read once; every non-zero 64K grain is deflated into a
+stream-optimized VMDK that is written directly into the .box tar archive,
+next to a generated OVF, Vagrantfile and metadata.json. Scratch space and
+run time therefore follow the amount of used data rather than the size of
+the volume. Any regular file (e.g. a loop image) works as the source too:
+
+    python box_stream.py /dev/xvdf /mnt/archive/cloudify.box
+"""
+from __future__ import print_function
+import io
+import os
+import sys
+import time
+import uuid
+import zlib
+import random
+import struct
+import tarfile
+import argparse
+from string import Template
+from multiprocessing.pool import ThreadPool
+
+SECTOR_SIZE = 512
+GRAIN_SECTORS = 128
+GRAIN_SIZE = GRAIN_SECTORS * SECTOR_SIZE
+GTES_PER_GT = 512
+GD_AT_END = 0xffffffffffffffff
+
+# Header flags: valid newline detection, compressed grains, markers
+VMDK_FLAGS = 0x1 | 0x10000 | 0x20000
+COMPRESSION_DEFLATE = 1
+
+MARKER_EOS = 0
+MARKER_GT = 1
+MARKER_GD = 2
+MARKER_FOOTER = 3
+
+# Grains handed to the compression workers per batch (4MB)
+BATCH_GRAINS = 64
+ZERO_GRAIN = b'\0' * GRAIN_SIZE
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'templates')
+DISK_FILE = 'box-disk1.vmdk'
+
+VMDK_DESCRIPTOR = """# Disk DescriptorFile
+version=1
+CID=${CID}
+parentCID=ffffffff
+createType="streamOptimized"
+
+# Extent description
+RW ${CAPACITY} SPARSE "${DISK_FILE}"
+
+# The Disk Data Base
+#DDB
+
+ddb.virtualHWVersion = "4"
+ddb.adapterType = "ide"
+ddb.geometry.cylinders = "${CYLINDERS}"
+ddb.geometry.heads = "16"
+ddb.geometry.sectors = "63"
+ddb.uuid.image = "${DISK_UUID}"
+"""
+
+
+def _sectors(size):
+    return (size + SECTOR_SIZE - 1) // SECTOR_SIZE
+
+
+def _pad(size):
+    return b'\0' * (_sectors(size) * SECTOR_SIZE - size)
+
+
+def _marker(value, marker_type):
+    return struct.pack('<QII', value, 0, marker_type).ljust(SECTOR_SIZE,
+                                                            b'\0')
+
+
+def _header(capacity, descriptor_size, gd_offset, overhead):
+    header = struct.pack('<4sIIQQQQIQQQB4sH',
+                         b'KDMV',
+                         3,
+                         VMDK_FLAGS,
+                         capacity,
+                         GRAIN_SECTORS,
+                         1,
+                         descriptor_size,
+                         GTES_PER_GT,
+                         0,
+                         gd_offset,
+                         overhead,
+                         0,
+                         b'\n \r\n',
+                         COMPRESSION_DEFLATE)
+    return header.ljust(SECTOR_SIZE, b'\0')
+
+
+def device_size(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+
+class StreamVMDKWriter(object):
+    """Write a stream-optimized VMDK to a sequential file object.
+
+    Grains are emitted in order, each grain table right after the last grain
+    it covers and the grain directory and footer at the end, so the output
+    never needs to be seeked.
+    """
+
+    def __init__(self, out, capacity_bytes, disk_uuid, level=6):
+        self.out = out
+        self.level = level
+        self.capacity = _sectors(capacity_bytes)
+        self.grains = (self.capacity + GRAIN_SECTORS - 1) // GRAIN_SECTORS
+        self.gd = [0] * ((self.grains + GTES_PER_GT - 1) // GTES_PER_GT)
+        self.gt = [0] * GTES_PER_GT
+        self.gt_index = 0
+        self.position = 0
+        self.data_grains = 0
+
+        descriptor = Template(VMDK_DESCRIPTOR).substitute(
+            CID='%08x' % random.getrandbits(32),
+            CAPACITY=self.capacity,
+            DISK_FILE=DISK_FILE,
+            CYLINDERS=min(self.capacity // (16 * 63), 16383),
+            DISK_UUID=disk_uuid,
+        ).encode('ascii')
+        descriptor_size = _sectors(len(descriptor))
+        self.overhead = ((1 + descriptor_size + GRAIN_SECTORS - 1) //
+                         GRAIN_SECTORS * GRAIN_SECTORS)
+        self.descriptor_size = descriptor_size
+
+        self._write(_header(self.capacity, descriptor_size, GD_AT_END,
+                            self.overhead))
+        self._write(descriptor)
+        self._write(b'\0' * ((self.overhead - 1) * SECTOR_SIZE -
+                             len(descriptor)))
+
+    def _write(self, data):
+        self.out.write(data)
+        self.position += len(data)
+
+    def compress(self, grain):
+        if grain == ZERO_GRAIN:
+            return None
+        return zlib.compress(grain, self.level)
+
+    def add_grain(self, index, compressed):
+        table = index // GTES_PER_GT
+        while table > self.gt_index:
+            self._flush_gt()
+        if compressed is None:
+            return
+        self.gt[index % GTES_PER_GT] = self.position // SECTOR_SIZE
+        self._write(struct.pack('<QI', index * GRAIN_SECTORS,
+                                len(compressed)))
+        self._write(compressed)
+        self._write(_pad(12 + len(compressed)))
+        self.data_grains += 1
+
+    def _flush_gt(self):
+        if any(self.gt):
+            self._write(_marker(GTES_PER_GT * 4 // SECTOR_SIZE, MARKER_GT))
+            self.gd[self.gt_index] = self.position // SECTOR_SIZE
+            self._write(struct.pack('<%dI' % GTES_PER_GT, *self.gt))
+            self.gt = [0] * GTES_PER_GT
+        self.gt_index += 1
+
+    def close(self):
+        while self.gt_index < len(self.gd):
+            self._flush_gt()
+        gd = struct.pack('<%dI' % len(self.gd), *self.gd)
+        self._write(_marker(_sectors(len(gd)), MARKER_GD))
+        gd_offset = self.position // SECTOR_SIZE
+        self._write(gd)
+        self._write(_pad(len(gd)))
+        self._write(_marker(1, MARKER_FOOTER))
+        self._write(_header(self.capacity, self.descriptor_size, gd_offset,
+                            self.overhead))
+        self._write(_marker(0, MARKER_EOS))
+
+
+def read_grains(source, size):
+    with io.open(source, 'rb', buffering=BATCH_GRAINS * GRAIN_SIZE) as dev:
+        remaining = size
+        index = 0
+        while remaining > 0:
+            batch = []
+            while len(batch) < BATCH_GRAINS and remaining > 0:
+                grain = dev.read(min(GRAIN_SIZE, remaining))
+                if not grain:
+                    raise IOError('{} ended after {} bytes'.format(
+                        source, size - remaining))
+                remaining -= len(grain)
+                batch.append(grain.ljust(GRAIN_SIZE, b'\0'))
+            yield index, batch
+            index += len(batch)
+
+
+def random_mac():
+    # VirtualBox OUI
+    return '080027' + ''.join('%02X' % random.randint(0, 255)
+                              for _ in range(3))
+
+
+def _render(template_name, **values):
+    with open(os.path.join(TEMPLATES_DIR, template_name)) as f:
+        return Template(f.read()).substitute(**values).encode('utf-8')
+
+
+def _tar_header(name, size, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0o644
+    return info.tobuf(format=tarfile.GNU_FORMAT)
+
+
+def _add_file(box, name, data, mtime):
+    box.write(_tar_header(name, len(data), mtime))
+    box.write(data)
+    box.write(b'\0' * (-len(data) % tarfile.BLOCKSIZE))
+
+
+def build_box(source, destination, workers=2, level=6,
+              memory=2048, cpus=2):
+    size = device_size(source)
+    mtime = int(time.time())
+    disk_uuid = str(uuid.uuid4())
+    mac = random_mac()
+    print('Building {} from {} ({} bytes)'.format(destination, source, size))
+    start = time.time()
+
+    with io.open(destination, 'wb') as box:
+        _add_file(box, './box.ovf', _render(
+            'box.ovf.template',
+            DISK_FILE=DISK_FILE,
+            DISK_CAPACITY=size,
+            DISK_UUID=disk_uuid,
+            MACHINE_MAC=mac,
+            MEMORY=memory,
+            CPUS=cpus), mtime)
+        _add_file(box, './Vagrantfile', _render(
+            'box_Vagrantfile.template', MACHINE_MAC=mac), mtime)
+        _add_file(box, './metadata.json', b'{ "provider": "virtualbox" }\n',
+                  mtime)
+
+        # The disk member's size is only known once it has been written,
+        # so its header is reserved now and filled in afterwards.
+        header_offset = box.tell()
+        box.write(b'\0' * tarfile.BLOCKSIZE)
+        writer = StreamVMDKWriter(box, size, disk_uuid, level=level)
+        pool = ThreadPool(workers)
+        try:
+            for index, batch in read_grains(source, size):
+                for offset, compressed in enumerate(
+                        pool.map(writer.compress, batch)):
+                    writer.add_grain(index + offset, compressed)
+        finally:
+            pool.close()
+            pool.join()
+        writer.close()
+        box.write(b'\0' * (-writer.position % tarfile.BLOCKSIZE))
+        box.write(b'\0' * tarfile.BLOCKSIZE * 2)
+        end = box.tell()
+        box.seek(header_offset)
+        box.write(_tar_header('./' + DISK_FILE, writer.position, mtime))
+        box.seek(end)
+
+    elapsed = time.time() - start
+    print('Wrote {} ({} bytes, {}/{} grains used) in {:.1f}s, '
+          '{:.1f} MB/s read'.format(destination, end, writer.data_grains,
+                                    writer.grains, elapsed,
+                                    size / (elapsed or 1) / 1024 / 1024))
+    return destination
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('source', help='block device or raw disk image')
+    parser.add_argument('destination', help='path of the .box to write')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='compression threads')
+    parser.add_argument('--level', type=int, default=6,
+                        help='deflate level for the disk grains')
+    args = parser.parse_args(argv)
+    build_box(args.source, args.destination,
+              workers=args.workers, level=args.level)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
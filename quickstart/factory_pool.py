@@ -0,0 +1,361 @@
+"""A pool of warm factory instances, reused across nightly builds.
+
+Factory instances are stopped, not terminated, after a build and started
+again by the next one, so a nightly waits for an instance start rather than
+for a launch and minutes of package installation. Instances are found by
+their tags:
+
+- `bakery-role`: marks an instance as part of the pool,
+- `bakery-key`: fingerprint of the key pair it was launched with; instances
+  launched with a key pair we no longer hold the private key of are retired,
+- `bakery-setup`: version of the setup that was run on it; the setup is run
+  again when it changes.
+
+A build leases an instance before using it. The lease is a security group
+named after the instance: EC2 refuses to create a second group of the same
+name, which makes creating it an atomic test-and-set, so two builds never
+share an instance. The group's description holds the lease's expiry, after
+which the lease of a build that died without releasing it may be broken.
+Launching is leased the same way, pool-wide: the instances are counted again
+and the new one is tagged under the `vagrant-nightly-lease-pool` group, so
+builds starting together never launch past the pool's size.
+
+A leased instance is health checked before it is handed out: its EC2 status
+checks must not be impaired and the `check` callable (e.g. an SSH probe) must
+not raise. Unhealthy instances are terminated and replaced.
+
+The pool is driven only through the EC2 connection it is given, so it can be
+exercised against a mocked EC2 (e.g. moto's).
+"""
+from __future__ import print_function
+import os
+import re
+import time
+import base64
+import socket
+import hashlib
+
+from boto.ec2 import blockdevicemapping as bdm
+from boto.exception import EC2ResponseError
+
+from waiters import InstanceWaiter, wait_for
+
+ROLE_TAG = 'bakery-role'
+KEY_TAG = 'bakery-key'
+SETUP_TAG = 'bakery-setup'
+ROLE = 'nightly-factory'
+INSTANCE_NAME = 'vagrant-nightly-factory'
+SECURITY_GROUP = 'vagrant-nightly-factory'
+LEASE_PREFIX = 'vagrant-nightly-lease-'
+POOL_LEASE = LEASE_PREFIX + 'pool'
+# How long a build may take to launch and tag an instance
+LAUNCH_LEASE = 10 * 60
+# States of the instances that are still part of the pool; stopped ones
+# first, they are the ones nobody is using
+POOL_STATES = ['stopped', 'stopping', 'pending', 'running']
+# How long to wait for another build to release an instance of a full pool
+WAIT_FOR_INSTANCE = 30 * 60
+# DER of the AlgorithmIdentifier of rsaEncryption, with its NULL parameters
+RSA_ALGORITHM = b'\x30\x0d\x06\x09\x2a\x86\x48\x86\xf7\x0d\x01\x01\x01\x05\x00'
+
+
+class FactoryUnhealthy(RuntimeError):
+    pass
+
+
+def _der(tag, content):
+    length = len(content)
+    if length < 0x80:
+        header = bytearray([tag, length])
+    else:
+        octets = bytearray()
+        while length:
+            octets.insert(0, length & 0xff)
+            length >>= 8
+        header = bytearray([tag, 0x80 | len(octets)]) + octets
+    return bytes(header) + content
+
+
+def key_fingerprint(key_file):
+    """The fingerprint EC2 gives a key pair it created, computed from its
+    private key: the SHA1 of the key in PKCS#8 DER form."""
+    with open(key_file) as pem:
+        lines = pem.read().strip().splitlines()
+    der = base64.b64decode(''.join(lines[1:-1]))
+    if 'RSA PRIVATE KEY' in lines[0]:
+        # PKCS#1, as EC2 hands it out; wrapped into PKCS#8
+        der = _der(0x30, _der(0x02, b'\x00') + RSA_ALGORITHM +
+                   _der(0x04, der))
+    digest = hashlib.sha1(der).hexdigest()
+    return ':'.join(digest[i:i + 2] for i in range(0, len(digest), 2))
+
+
+def _delete_group(group):
+    """Delete `group` by its id: outside a VPC `group.delete()` goes by
+    name, and would take a newer lease of the same name with it."""
+    try:
+        group.connection.delete_security_group(group_id=group.id)
+    except EC2ResponseError as e:
+        # Broken as stale by another build meanwhile
+        if e.error_code != 'InvalidGroup.NotFound':
+            raise
+
+
+class Lease(object):
+    """The exclusive use of a factory instance by this build."""
+
+    def __init__(self, instance, group):
+        self.instance = instance
+        self.group = group
+        self.released = False
+
+    def release(self, healthy=True):
+        """Stop the instance for the next build, or terminate it.
+
+        The lease is dropped once the instance is on its way down, so the
+        next build starts it only after it stopped.
+        """
+        if self.released:
+            return
+        if healthy:
+            self.instance.stop()
+            print('{} stopped for reuse'.format(self.instance))
+        else:
+            self.instance.terminate()
+            print('{} terminated'.format(self.instance))
+        _delete_group(self.group)
+        self.released = True
+
+    def __str__(self):
+        return 'lease of {}'.format(self.instance)
+
+
+class FactoryPool(object):
+    """Leases warm factory instances out of a pool of up to
+    `settings['factory_pool_size']`, launching new ones as needed.
+
+    `setup(instance)` installs the tools the build needs on an instance;
+    it runs on new instances and whenever `setup_version` changes.
+    `check(instance)` raises if a running instance is not fit for a build.
+    """
+
+    def __init__(self, conn, settings, setup, setup_version, check):
+        self.conn = conn
+        self.settings = settings
+        self.setup = setup
+        self.setup_version = setup_version
+        self.check = check
+        self.size = settings['factory_pool_size']
+        self.lease_seconds = settings['factory_lease_hours'] * 60 * 60
+        self.key_name = settings['factory_key_name']
+        self.key_file = os.path.join(
+            os.path.expanduser(settings['factory_key_dir']),
+            '{}.pem'.format(self.key_name))
+        self.holder = '{}@{}'.format(os.getpid(), socket.gethostname())
+        self._key_fingerprint = None
+
+    def acquire(self, deadline=WAIT_FOR_INSTANCE):
+        """Lease a running, healthy and set up instance."""
+        self._key_fingerprint = self._key_pair().fingerprint
+        return wait_for(self._try_acquire, 'a free factory instance',
+                        deadline=deadline, initial=10.0, maximum=60.0)
+
+    def _try_acquire(self):
+        live = self._instances()
+        for instance in list(live):
+            lease = self._try_lease(instance)
+            if lease is None:
+                continue
+            if instance.tags.get(KEY_TAG) != self._key_fingerprint:
+                print('Retiring {}: launched with another key pair'.format(
+                    instance))
+                lease.release(healthy=False)
+                live.remove(instance)
+                continue
+            try:
+                self._resume(instance)
+                self._prepare(instance)
+            except Exception as e:
+                print('Retiring {}: {}'.format(instance, e))
+                lease.release(healthy=False)
+                live.remove(instance)
+                continue
+            print('Reusing factory instance {}'.format(instance))
+            return lease
+        if len(live) < self.size:
+            return self._launch()
+        print('All {} factory instances are leased, waiting..'.format(
+            len(live)))
+        return None
+
+    def _instances(self):
+        instances = self.conn.get_only_instances(filters={
+            'tag:{}'.format(ROLE_TAG): ROLE,
+            'instance-state-name': POOL_STATES,
+        })
+        return sorted(instances, key=lambda i: POOL_STATES.index(i.state))
+
+    def _lease_name(self, instance):
+        return LEASE_PREFIX + instance.id
+
+    def _try_lease(self, instance, break_stale=True):
+        group = self._take_lease(self._lease_name(instance),
+                                 self.lease_seconds, break_stale)
+        return None if group is None else Lease(instance, group)
+
+    def _take_lease(self, name, seconds, break_stale=True):
+        """Create the lease group `name`, or return None if it is held."""
+        description = 'leased by {} until {}'.format(
+            self.holder, int(time.time() + seconds))
+        try:
+            return self.conn.create_security_group(name, description)
+        except EC2ResponseError as e:
+            if e.error_code != 'InvalidGroup.Duplicate':
+                raise
+            if break_stale and self._break_stale_lease(name):
+                return self._take_lease(name, seconds, break_stale=False)
+            return None
+
+    def _break_stale_lease(self, name):
+        groups = self.conn.get_all_security_groups(
+            filters={'group-name': name})
+        if not groups:
+            # Released meanwhile
+            return True
+        expiry = re.search(r'until (\d+)', groups[0].description)
+        if expiry and int(expiry.group(1)) > time.time():
+            return False
+        print('Breaking the stale lease {}: {}'.format(
+            name, groups[0].description))
+        _delete_group(groups[0])
+        return True
+
+    def _resume(self, instance):
+        waiter = InstanceWaiter(self.conn)
+        if instance.state == 'stopping':
+            waiter.wait([instance], 'stopped')
+        if instance.state == 'stopped':
+            print('Starting {}..'.format(instance))
+            instance.start()
+        waiter.wait([instance], 'running')
+
+    def _prepare(self, instance):
+        """Health check the running instance, then set it up if needed."""
+        for status in self.conn.get_all_instance_status(
+                instance_ids=[instance.id]):
+            impaired = [name for name, check in (
+                ('system', status.system_status),
+                ('instance', status.instance_status))
+                if check.status == 'impaired']
+            if impaired:
+                raise FactoryUnhealthy('{} status check impaired'.format(
+                    ' and '.join(impaired)))
+        self.check(instance)
+        if instance.tags.get(SETUP_TAG) != self.setup_version:
+            print('Setting up {} ({})..'.format(instance, self.setup_version))
+            self.setup(instance)
+            instance.add_tag(SETUP_TAG, self.setup_version)
+
+    def _launch(self):
+        """Launch and lease an instance, unless the pool filled up since it
+        was counted."""
+        pool_lease = self._take_lease(POOL_LEASE, LAUNCH_LEASE)
+        if pool_lease is None:
+            print('Another build is launching a factory instance, waiting..')
+            return None
+        try:
+            if len(self._instances()) >= self.size:
+                return None
+            lease = self._run_instance()
+        finally:
+            _delete_group(pool_lease)
+        try:
+            print('Launched factory instance {}'.format(lease.instance))
+            InstanceWaiter(self.conn).wait([lease.instance], 'running')
+            self._prepare(lease.instance)
+        except Exception:
+            lease.release(healthy=False)
+            raise
+        return lease
+
+    def _run_instance(self):
+        """Run a new instance and lease it; tagged, it counts as pooled."""
+        mapping = bdm.BlockDeviceMapping()
+        mapping['/dev/sda1'] = bdm.BlockDeviceType(size=30,
+                                                   volume_type='gp2',
+                                                   delete_on_termination=True)
+        reserv = self.conn.run_instances(
+            image_id=self.settings['factory_ami'],
+            key_name=self.key_name,
+            instance_type=self.settings['instance_type'],
+            security_groups=[self._security_group()],
+            block_device_map=mapping,
+            instance_profile_name=self.settings['aws_iam_group'])
+        instance = reserv.instances[0]
+        # Nobody else can know of the instance before it is tagged, so the
+        # lease cannot be taken
+        lease = self._try_lease(instance, break_stale=False)
+        try:
+            wait_for(lambda: self._tag(instance),
+                     'tags on {}'.format(instance), deadline=60)
+        except Exception:
+            lease.release(healthy=False)
+            raise
+        return lease
+
+    def _tag(self, instance):
+        try:
+            self.conn.create_tags([instance.id], {
+                'Name': INSTANCE_NAME,
+                ROLE_TAG: ROLE,
+                KEY_TAG: self._key_fingerprint,
+            })
+        except EC2ResponseError as e:
+            # Freshly launched instances may not be visible yet
+            if e.error_code != 'InvalidInstanceID.NotFound':
+                raise
+            return False
+        instance.tags.update({ROLE_TAG: ROLE, KEY_TAG: self._key_fingerprint})
+        return True
+
+    def _key_pair(self):
+        """The pool's key pair, replaced unless its private key is here.
+
+        Another build host may have replaced the key pair since this one
+        saved its private key, so the key is checked against the pair.
+        """
+        key_pair = self.conn.get_key_pair(self.key_name)
+        local = os.path.exists(self.key_file)
+        if (key_pair is not None and local and
+                key_fingerprint(self.key_file) == key_pair.fingerprint):
+            return key_pair
+        if key_pair is not None:
+            print('The private key of {} is not in {}, replacing it'.format(
+                self.key_name, self.key_file))
+            key_pair.delete()
+        if local:
+            os.remove(self.key_file)
+        key_pair = self.conn.create_key_pair(self.key_name)
+        key_pair.save(os.path.dirname(self.key_file))
+        print('Keypair created: {}'.format(self.key_name))
+        return key_pair
+
+    def _security_group(self):
+        groups = self.conn.get_all_security_groups(
+            filters={'group-name': SECURITY_GROUP})
+        if groups:
+            return groups[0]
+        try:
+            group = self.conn.create_security_group(SECURITY_GROUP,
+                                                    'vagrant nightly')
+        except EC2ResponseError as e:
+            # Created by another build meanwhile
+            if e.error_code != 'InvalidGroup.Duplicate':
+                raise
+            return self._security_group()
+        group.authorize(ip_protocol='tcp',
+                        from_port=22,
+                        to_port=22,
+                        cidr_ip='0.0.0.0/0')
+        print('Security Group created: {}'.format(SECURITY_GROUP))
+        return group
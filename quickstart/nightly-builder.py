@@ -1,21 +1,29 @@
 from __future__ import print_function
 import os
-import re
-import string
-import random
-from time import sleep, strftime
+import hashlib
+from time import strftime
 from string import Template
-from tempfile import gettempdir
 from StringIO import StringIO
-from subprocess import Popen, PIPE
 
 import boto.ec2
-from boto.ec2 import blockdevicemapping as bdm
 from fabric.api import env, run, sudo, execute, put
 
+import packer_events
 from settings import settings
-
-RESOURCES = []
+from waiters import wait_for
+from resources import ResourceRegistry
+from factory_pool import FactoryPool, FactoryUnhealthy
+
+RESOURCES = ResourceRegistry()
+# Run once on each factory instance, and again whenever this list changes.
+# Each command is a no-op when the factory AMI already has what it installs.
+FACTORY_SETUP = [
+    'command -v pip || curl --silent --show-error --retry 5 '
+    'https://bootstrap.pypa.io/get-pip.py | python -',
+    'python -c "import boto" || pip install boto',
+]
+FACTORY_MIN_FREE_KB = 4 * 1024 * 1024
+PACKER_LOG = 'packer-build.log'
 
 
 def main():
@@ -26,181 +34,115 @@ def main():
     conn = boto.ec2.connect_to_region(settings['region'],
                                       aws_access_key_id=access_key,
                                       aws_secret_access_key=secret_key)
-    RESOURCES.append(conn)
+    RESOURCES.add(conn)
 
     print('Running Packer..')
     baked_ami_id = run_packer()
     baked_ami = conn.get_image(baked_ami_id)
-    RESOURCES.append(baked_ami)
+    RESOURCES.add(baked_ami)
 
     baked_snap = baked_ami.block_device_mapping['/dev/sda1'].snapshot_id
 
-    print('Launching worker machine..')
-    mapping = bdm.BlockDeviceMapping()
-    mapping['/dev/sda1'] = bdm.BlockDeviceType(size=30,
-                                               volume_type='gp2',
-                                               delete_on_termination=True)
-    mapping['/dev/sdf'] = bdm.BlockDeviceType(snapshot_id=baked_snap,
-                                              volume_type='gp2',
-                                              delete_on_termination=True)
-
-    kp_name = random_generator()
-    kp = conn.create_key_pair(kp_name)
-    kp.save(gettempdir())
-    print('Keypair created: {}'.format(kp_name))
-
-    sg_name = random_generator()
-    sg = conn.create_security_group(sg_name, 'vagrant nightly')
-    sg.authorize(ip_protocol='tcp',
-                 from_port=22,
-                 to_port=22,
-                 cidr_ip='0.0.0.0/0')
-    print('Security Group created: {}'.format(sg_name))
-
-    reserv = conn.run_instances(image_id=settings['factory_ami'],
-                                key_name=kp_name,
-                                instance_type=settings['instance_type'],
-                                security_groups=[sg],
-                                block_device_map=mapping,
-                                instance_profile_name=settings['aws_iam_group'])
-
-    factory_instance = reserv.instances[0]
-    RESOURCES.append(factory_instance)
-    RESOURCES.append(kp)
-    RESOURCES.append(sg)
-
-    env.key_filename = os.path.join(gettempdir(), '{}.pem'.format(kp_name))
+    print('Leasing factory machine..')
     env.timeout = 10
     env.connection_attempts = 12
-
-    while factory_instance.state != 'running':
-        sleep(5)
-        factory_instance.update()
-        print('machine state: {}'.format(factory_instance.state))
+    # Failed health checks and setups raise instead of exiting
+    env.abort_exception = RuntimeError
+    pool = FactoryPool(conn, settings,
+                       setup=lambda i: on_factory(setup_factory, i),
+                       setup_version=hashlib.sha1(
+                           '\n'.join(FACTORY_SETUP)).hexdigest()[:12],
+                       check=lambda i: on_factory(check_factory, i))
+    env.key_filename = pool.key_file
+    lease = RESOURCES.add(pool.acquire())
+    factory_instance = lease.instance
+
+    volume = conn.create_volume(None, factory_instance.placement,
+                                snapshot=baked_snap,
+                                volume_type='gp2')
+    RESOURCES.add(volume, depends_on=[lease])
+    wait_for(lambda: volume.update() == 'available',
+             '{} to be created'.format(volume))
+    volume.attach(factory_instance.id, '/dev/sdf')
+    print('Baked volume {} attached'.format(volume.id))
 
     print('Executing script..')
-    execute(do_work, host='{}@{}'.format(settings['username'],
-                                         factory_instance.ip_address))
+    on_factory(do_work, factory_instance)
 
 
-def random_generator(size=8, chars=string.ascii_uppercase + string.digits):
-    return ''.join(random.choice(chars) for _ in range(size))
+def on_factory(task, instance):
+    return execute(task, host='{}@{}'.format(settings['username'],
+                                             instance.ip_address))
 
 
 def run_packer():
+    builder = 'nightly_virtualbox_build'
     packer_cmd = 'packer build ' \
                  '-machine-readable ' \
-                 '-only=nightly_virtualbox_build ' \
+                 '-only={} ' \
                  '-var-file={} ' \
-                 'packerfile.json'.format(settings['packer_var_file'])
-    p = Popen(packer_cmd.split(), stdout=PIPE, stderr=PIPE)
+                 'packerfile.json'.format(builder, settings['packer_var_file'])
+    returncode, packer_run = packer_events.run_packer(packer_cmd.split(),
+                                                      log_path=PACKER_LOG)
+    print(packer_run.summary())
+    if returncode != 0:
+        raise RuntimeError('packer failed with exit code {}: {}'.format(
+            returncode, packer_run.errors))
+    artifact_ids = packer_run.artifact_ids(builder)
+    if not artifact_ids:
+        raise RuntimeError('packer recorded no artifact for {}, see {}'.format(
+            builder, os.path.abspath(PACKER_LOG)))
+    return artifact_ids[-1].split(':')[-1]
 
-    packer_output = ''
-    while True:
-        line = p.stdout.readline()
-        if line == '':
-            break
-        else:
-            print(line, end="")
-            if re.match('^.+artifact.+id', line):
-                packer_output = line
-    return packer_output.split(':')[-1].rstrip()
 
+def setup_factory():
+    for command in FACTORY_SETUP:
+        sudo(command)
 
-def do_work():
-    sudo('echo "deb http://download.virtualbox.org/virtualbox/debian trusty contrib" > /etc/apt/sources.list.d/virtualbox.list') # noqa
-    sudo('wget -q https://www.virtualbox.org/download/oracle_vbox.asc -O- | apt-key add -')
-    sudo('apt-get update')
 
-    sudo('curl --silent --show-error --retry 5 https://bootstrap.pypa.io/get-pip.py | python -')
-    sudo('apt-get install -y virtualbox-4.3')
+def check_factory():
+    sudo('true')
+    free_kb = int(run("df -Pk / | awk 'NR == 2 {print $4}'"))
+    if free_kb < FACTORY_MIN_FREE_KB:
+        raise FactoryUnhealthy('only {}MB free on /'.format(free_kb // 1024))
 
-    sudo('pip install awscli')
 
-    sudo('mkdir -p /mnt/image')
+def do_work():
+    run('timeout 300 sh -c "until [ -b /dev/xvdf ]; do sleep 1; done"')
+    run('mkdir -p bakery/templates')
+    put('box_stream.py', 'bakery/')
+    put('s3_upload.py', 'bakery/')
+    put('templates/box*.template', 'bakery/templates/')
+
+    # Left over by a previous build on this instance, if it failed
+    sudo('rm -rf /mnt/archive')
     sudo('mkdir -p /mnt/archive')
-
-    sudo('dd if=/dev/xvdf of=/mnt/archive/disk.raw bs=1M')
-
-    sudo('VBoxManage convertfromraw --format vmdk /mnt/archive/disk.raw /mnt/archive/disk.vmdk')
-    sudo('chown ubuntu:ubuntu /mnt/archive/disk.vmdk')
-
-    run('mkdir output')
-    run('VBoxManage createvm --name cloudify --ostype RedHat_64 --register')
-    run('VBoxManage storagectl cloudify '
-        '--name SATA '
-        '--add sata '
-        '--portcount 1 '
-        '--hostiocache on '
-        '--bootable on')
-    run('VBoxManage storageattach cloudify '
-        '--storagectl SATA '
-        '--port 0 '
-        '--type hdd '
-        '--medium /mnt/archive/disk.vmdk')
-    run('VBoxManage modifyvm cloudify '
-        '--memory 2048 '
-        '--cpus 2 '
-        '--vram 12 '
-        '--ioapic on '
-        '--rtcuseutc on '
-        '--pae off '
-        '--boot1 disk '
-        '--boot2 none '
-        '--boot3 none '
-        '--boot4 none ')
-    run('VBoxManage export cloudify --output output/box.ovf')
-
-    run('echo "Vagrant::Config.run do |config|" > output/Vagrantfile')
-    run('echo "  config.vm.base_mac = `VBoxManage showvminfo cloudify '
-        '--machinereadable | grep  macaddress1 | cut -d"=" -f2`"'
-        ' >> output/Vagrantfile')
-    run('echo -e "end\n\n" >> output/Vagrantfile')
-    run('echo \'include_vagrantfile = File.expand_path'
-        '("../include/_Vagrantfile", __FILE__)\' >> output/Vagrantfile')
-    run('echo "load include_vagrantfile if File.exist?'
-        '(include_vagrantfile)" >> output/Vagrantfile')
-    run('echo \'{ "provider": "virtualbox" }\' > output/metadata.json')
-    run('tar -cvf cloudify.box -C output/ .')
+    sudo('python bakery/box_stream.py /dev/xvdf /mnt/archive/cloudify.box')
 
     box_name = 'cloudify_{}'.format(strftime('%y%m%d-%H%M'))
     box_url = 'https://s3-{0}.amazonaws.com/{1}/{2}.box'.format(
         settings['region'], settings['aws_s3_bucket'], box_name
     )
-    run('aws s3 cp '
-        'cloudify.box s3://{}/{}.box'.format(settings['aws_s3_bucket'],
-                                             box_name))
+    # Retries resume the multipart upload of the same key; the ones left
+    # behind by killed builds are cancelled first
+    sudo('python bakery/s3_upload.py '
+         '--part-size-mb {} --workers {} --sweep-prefix cloudify_ '
+         '/mnt/archive/cloudify.box {} {}.box'.format(
+             settings['s3_part_size_mb'], settings['s3_upload_workers'],
+             settings['aws_s3_bucket'], box_name))
     with open('templates/publish_Vagrantfile.template') as f:
         template = Template(f.read())
     vfile = StringIO()
     vfile.write(template.substitute(BOX_NAME=box_name,
                                     BOX_URL=box_url))
     put(vfile, 'publish_Vagrantfile')
-    run('aws s3 cp publish_Vagrantfile s3://{}/{}'.format(
+    run('python bakery/s3_upload.py publish_Vagrantfile {} {}'.format(
         settings['aws_s3_bucket'], 'Vagrantfile'))
 
 
 def cleanup():
     print('cleaning up..')
-    for item in RESOURCES:
-        if type(item) == boto.ec2.image.Image:
-            item.deregister()
-            print('{} deregistered'.format(item))
-        elif type(item) == boto.ec2.instance.Instance:
-            item.terminate()
-            while item.state != 'terminated':
-                sleep(5)
-                item.update()
-            print('{} terminated'.format(item))
-        elif type(item) == boto.ec2.connection.EC2Connection:
-            item.close()
-            print('{} closed'.format(item))
-        elif (type(item) == boto.ec2.securitygroup.SecurityGroup or
-              type(item) == boto.ec2.keypair.KeyPair):
-            item.delete()
-            print('{} deleted'.format(item))
-        else:
-            print('{} not cleared'.format(item))
+    RESOURCES.cleanup()
 
 
 try:
@@ -0,0 +1,211 @@
+"""Incremental parser for `packer build -machine-readable` output.
+
+Every machine-readable line is `timestamp,target,type,data...` with commas
+inside the data escaped as `%!(PACKER_COMMA)`. The parser turns lines into
+events and keeps, per builder, the artifacts it produced and the time spent
+in each of its steps (the `==> builder: ...` UI messages), which includes
+one step per provisioner. Recorded transcripts can be replayed with:
+
+    python packer_events.py packer-build.log
+"""
+from __future__ import print_function
+import sys
+import threading
+from collections import namedtuple, OrderedDict
+from subprocess import Popen, PIPE
+
+PACKER_COMMA = '%!(PACKER_COMMA)'
+PROVISIONER_PREFIX = 'Provisioning with '
+
+
+class PackerEvent(namedtuple('PackerEvent', 'timestamp target type data')):
+    __slots__ = ()
+
+    @property
+    def message(self):
+        # ui events are `ui,<say|message|error>,<text>`
+        if self.type == 'ui' and len(self.data) > 1:
+            return self.data[1]
+        return None
+
+
+class Stage(namedtuple('Stage', 'target name start end')):
+    __slots__ = ()
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    @property
+    def provisioner(self):
+        if self.name.startswith(PROVISIONER_PREFIX):
+            return self.name[len(PROVISIONER_PREFIX):]
+        return None
+
+
+def _unescape(field):
+    return field.replace(PACKER_COMMA, ',').replace('\\n', '\n').replace(
+        '\\r', '\r')
+
+
+def parse_line(line):
+    """Return the PackerEvent for `line`, or None if it isn't one."""
+    fields = line.rstrip('\r\n').split(',')
+    if len(fields) < 3:
+        return None
+    try:
+        timestamp = int(fields[0])
+    except ValueError:
+        return None
+    return PackerEvent(timestamp,
+                       fields[1],
+                       fields[2],
+                       tuple(_unescape(field) for field in fields[3:]))
+
+
+class PackerRun(object):
+    """Accumulated state of one packer build, fed one event at a time."""
+
+    def __init__(self):
+        self.events = []
+        self.artifacts = OrderedDict()
+        self.errors = []
+        self.stderr = ''
+        self._stages = OrderedDict()
+        self._end = None
+
+    def feed(self, event):
+        self.events.append(event)
+        self._end = event.timestamp
+        if event.type == 'artifact' and len(event.data) >= 3:
+            index, key, value = event.data[0], event.data[1], event.data[2]
+            builder = self.artifacts.setdefault(event.target, OrderedDict())
+            builder.setdefault(index, OrderedDict())[key] = value
+        elif event.type == 'error' and event.data:
+            self.errors.append((event.target, event.data[0]))
+        elif event.type == 'ui':
+            message = event.message or ''
+            if event.data[0] == 'error':
+                self.errors.append((event.target, message))
+            # Builder steps are announced as "==> <builder>: <step>"
+            if event.data[0] == 'say' and message.startswith('==> '):
+                target, _, name = message[4:].partition(': ')
+                if name:
+                    self._start_stage(target, name, event.timestamp)
+
+    def feed_line(self, line):
+        event = parse_line(line)
+        if event is not None:
+            self.feed(event)
+        return event
+
+    def _start_stage(self, target, name, timestamp):
+        stages = self._stages.setdefault(target, [])
+        if stages and stages[-1].end is None:
+            stages[-1] = stages[-1]._replace(end=timestamp)
+        stages.append(Stage(target, name, timestamp, None))
+
+    def finish(self):
+        """Close the last open step of every builder."""
+        for stages in self._stages.values():
+            if stages and stages[-1].end is None:
+                stages[-1] = stages[-1]._replace(end=self._end)
+
+    def artifact_ids(self, builder=None):
+        """Artifact ids, e.g. `eu-west-1:ami-123`, keyed by builder."""
+        ids = OrderedDict(
+            (target, [a['id'] for a in artifacts.values() if 'id' in a])
+            for target, artifacts in self.artifacts.items())
+        if builder is not None:
+            return ids.get(builder, [])
+        return ids
+
+    def stages(self, target=None):
+        if target is not None:
+            return list(self._stages.get(target, []))
+        return [stage for stages in self._stages.values()
+                for stage in stages]
+
+    def provisioner_durations(self, target=None):
+        return [(stage.target, stage.provisioner, stage.duration)
+                for stage in self.stages(target)
+                if stage.provisioner is not None]
+
+    def summary(self):
+        lines = []
+        for target, stages in self._stages.items():
+            total = sum(stage.duration or 0 for stage in stages)
+            lines.append('{}: {}s'.format(target, total))
+            for stage in stages:
+                lines.append('  {:>6}s  {}'.format(stage.duration, stage.name))
+        for target, ids in self.artifact_ids().items():
+            lines.append('{} artifacts: {}'.format(target, ', '.join(ids)))
+        return '\n'.join(lines)
+
+
+def parse_transcript(lines):
+    run = PackerRun()
+    for line in lines:
+        run.feed_line(line)
+    run.finish()
+    return run
+
+
+def _drain(stream, sink, echo):
+    for line in iter(stream.readline, b''):
+        if not isinstance(line, str):
+            line = line.decode('utf-8', 'replace')
+        if echo:
+            echo.write(line)
+        sink.append(line)
+    stream.close()
+
+
+def run_packer(command, cwd=None, echo=True, log_path=None):
+    """Run a machine-readable packer command, returning (returncode, run).
+
+    stderr is drained on its own thread so a chatty build can never block
+    on a full pipe while stdout is being parsed. With `log_path`, stdout is
+    also kept there, as a transcript `main` can replay.
+    """
+    process = Popen(command, cwd=cwd, stdout=PIPE, stderr=PIPE)
+    stderr_lines = []
+    stderr_thread = threading.Thread(
+        target=_drain,
+        args=(process.stderr, stderr_lines, sys.stderr if echo else None))
+    stderr_thread.daemon = True
+    stderr_thread.start()
+
+    run = PackerRun()
+    log = open(log_path, 'w') if log_path else None
+    try:
+        for line in iter(process.stdout.readline, b''):
+            if not isinstance(line, str):
+                line = line.decode('utf-8', 'replace')
+            if echo:
+                print(line, end='')
+            if log:
+                log.write(line)
+            run.feed_line(line)
+    finally:
+        if log:
+            log.close()
+    process.stdout.close()
+    returncode = process.wait()
+    stderr_thread.join()
+    run.finish()
+    run.stderr = ''.join(stderr_lines)
+    return returncode, run
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    for path in argv:
+        with open(path) as f:
+            print(parse_transcript(f).summary())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+"""Registry of the AWS resources created by a build, torn down as a DAG.
+
+Every resource is registered together with the resources it depends on
+(an instance depends on the security group it was launched in, a volume on
+the leased factory instance it is attached to). Cleanup
+releases a resource as soon as everything that depends on it is gone, so
+independent resources are released concurrently while e.g. a security group
+still waits for its instances to terminate. Connections are implicitly
+depended on by everything and are closed last.
+"""
+from __future__ import print_function
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+
+import boto.ec2
+
+from factory_pool import Lease
+from waiters import InstanceWaiter, backoff, wait_for
+
+
+class Resource(object):
+    attempts = 3
+
+    def __init__(self, item, depends_on=()):
+        self.item = item
+        self.depends_on = list(depends_on)
+        self.dependents = []
+        self.released = False
+        self.error = None
+        self.duration = None
+
+    def release(self):
+        raise NotImplementedError()
+
+    def release_with_retry(self):
+        start = time.time()
+        delays = backoff(initial=2.0, maximum=30.0)
+        for attempt in range(1, self.attempts + 1):
+            try:
+                self.release()
+                self.released = True
+                break
+            except Exception as e:
+                self.error = e
+                print('{} failed on attempt {}/{}: {}'.format(
+                    self, attempt, self.attempts, e))
+                if attempt < self.attempts:
+                    time.sleep(next(delays))
+        self.duration = time.time() - start
+        return self
+
+    def __str__(self):
+        return str(self.item)
+
+
+class ConnectionResource(Resource):
+
+    def release(self):
+        self.item.close()
+        print('{} closed'.format(self))
+
+
+class InstanceResource(Resource):
+
+    def release(self):
+        self.item.terminate()
+        InstanceWaiter(self.item.connection).wait([self.item], 'terminated')
+        print('{} terminated'.format(self))
+
+
+class ImageResource(Resource):
+
+    def release(self):
+        self.item.deregister()
+        print('{} deregistered'.format(self))
+
+
+class VolumeResource(Resource):
+
+    def release(self):
+        volume = self.item
+        if volume.update() == 'in-use':
+            volume.detach()
+        wait_for(lambda: volume.update() == 'available',
+                 '{} to be detached'.format(volume))
+        volume.delete()
+        print('{} deleted'.format(self))
+
+
+class LeaseResource(Resource):
+    """Factory instances are stopped for the next build, not terminated."""
+
+    def release(self):
+        self.item.release()
+
+
+class DeletableResource(Resource):
+    """Key pairs and security groups."""
+
+    def release(self):
+        self.item.delete()
+        print('{} deleted'.format(self))
+
+
+RESOURCE_TYPES = {
+    boto.ec2.connection.EC2Connection: ConnectionResource,
+    boto.ec2.instance.Instance: InstanceResource,
+    boto.ec2.image.Image: ImageResource,
+    boto.ec2.volume.Volume: VolumeResource,
+    Lease: LeaseResource,
+    boto.ec2.keypair.KeyPair: DeletableResource,
+    boto.ec2.securitygroup.SecurityGroup: DeletableResource,
+}
+
+
+class ResourceRegistry(object):
+
+    def __init__(self, workers=8):
+        self.workers = workers
+        self.resources = []
+        self._by_item = {}
+
+    def add(self, item, depends_on=()):
+        """Track `item`, which must be released before any of `depends_on`.
+        """
+        resource_type = RESOURCE_TYPES.get(type(item))
+        if resource_type is None:
+            raise TypeError('Unsupported resource: {}'.format(item))
+        dependencies = [self._by_item[id(dep)] for dep in depends_on]
+        if resource_type is not ConnectionResource:
+            dependencies.extend(
+                r for r in self.resources
+                if isinstance(r, ConnectionResource))
+        resource = resource_type(item, dependencies)
+        for dependency in dependencies:
+            dependency.dependents.append(resource)
+        self.resources.append(resource)
+        self._by_item[id(item)] = resource
+        return item
+
+    def cleanup(self):
+        """Release everything, returning the resources that were leaked."""
+        start = time.time()
+        lock = threading.Condition()
+        pending = set(self.resources)
+        running = set()
+        pool = ThreadPool(self.workers)
+
+        def release(resource):
+            # Python 2's apply_async has no error callback: whatever
+            # happens, the resource is recorded and the loop is woken up
+            try:
+                resource.release_with_retry()
+            except BaseException as e:
+                resource.error = e
+                print('{} failed: {!r}'.format(resource, e))
+            finally:
+                with lock:
+                    running.discard(resource)
+                    lock.notify()
+
+        def blocked(resource):
+            return any(not d.released for d in resource.dependents)
+
+        try:
+            with lock:
+                while pending or running:
+                    for resource in list(pending):
+                        if any(d in pending or d in running
+                               for d in resource.dependents):
+                            continue
+                        pending.discard(resource)
+                        if (blocked(resource) and
+                                not isinstance(resource, ConnectionResource)):
+                            # Something depending on it failed to go away
+                            continue
+                        running.add(resource)
+                        pool.apply_async(release, (resource,))
+                    if running:
+                        lock.wait(1)
+        finally:
+            pool.close()
+            pool.join()
+
+        leaked = [r for r in self.resources if not r.released]
+        print('Cleanup finished in {:.1f}s'.format(time.time() - start))
+        for resource in self.resources:
+            if resource.released:
+                print('  {}: {:.1f}s'.format(resource, resource.duration))
+        if leaked:
+            print('Leaked resources:')
+            for resource in leaked:
+                if resource.error is not None:
+                    reason = resource.error
+                else:
+                    reason = 'blocked by {}'.format(', '.join(
+                        str(d) for d in resource.dependents
+                        if not d.released))
+                print('  {} ({})'.format(resource, reason))
+        return leaked
@@ -0,0 +1,340 @@
+"""Parallel, resumable multipart upload of a file to S3.
+
+Parts are uploaded by a pool of workers, each with its own connection. Every
+finished part is recorded with its MD5/SHA256 in a JSON manifest next to the
+file, so when an attempt fails the next one resumes the same multipart
+upload and only sends the parts that are missing or no longer match. Once
+the attempts are used up, the multipart upload is cancelled rather than
+left behind (S3 bills the parts of unfinished uploads):
+
+    python s3_upload.py /mnt/archive/cloudify.box my-bucket cloudify.box
+
+With --sweep-prefix, multipart uploads under that prefix that are older
+than --sweep-hours (left behind by uploads that were killed) are cancelled
+first.
+
+Use --endpoint to point at a local S3-compatible server.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import calendar
+import base64
+import hashlib
+import argparse
+import threading
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+
+import boto
+from boto.s3.connection import OrdinaryCallingFormat
+from boto.s3.multipart import MultiPartUpload
+
+MB = 1024 * 1024
+DEFAULT_PART_SIZE = 64 * MB
+DEFAULT_WORKERS = 8
+PART_ATTEMPTS = 5
+DEFAULT_ATTEMPTS = 3
+DEFAULT_SWEEP_HOURS = 24
+# S3 rejects parts smaller than this, except for the last one
+MIN_PART_SIZE = 5 * MB
+
+
+def connect(endpoint=None):
+    if endpoint is None:
+        return boto.connect_s3()
+    secure = not endpoint.startswith('http://')
+    host = endpoint.split('://')[-1].rstrip('/')
+    port = None
+    if ':' in host:
+        host, port = host.rsplit(':', 1)
+        port = int(port)
+    return boto.connect_s3(host=host,
+                           port=port,
+                           is_secure=secure,
+                           calling_format=OrdinaryCallingFormat())
+
+
+def manifest_path_for(path):
+    return '{}.upload.json'.format(path)
+
+
+class Manifest(object):
+    """Progress of one multipart upload, saved after every part."""
+
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, bucket, key, size, part_size):
+        data = None
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            expected = (bucket, key, size, part_size)
+            found = (data.get('bucket'), data.get('key'),
+                     data.get('size'), data.get('part_size'))
+            if found != expected:
+                print('Ignoring manifest {} for a different upload'.format(
+                    path))
+                data = None
+        if data is None:
+            data = {'bucket': bucket,
+                    'key': key,
+                    'size': size,
+                    'part_size': part_size,
+                    'upload_id': None,
+                    'parts': {}}
+        return cls(path, data)
+
+    @property
+    def upload_id(self):
+        return self.data['upload_id']
+
+    @upload_id.setter
+    def upload_id(self, value):
+        self.data['upload_id'] = value
+        self.save()
+
+    def part(self, number):
+        return self.data['parts'].get(str(number))
+
+    def record(self, number, info):
+        with self._lock:
+            self.data['parts'][str(number)] = info
+            self.save()
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+
+def _read_part(path, number, part_size):
+    with open(path, 'rb') as f:
+        f.seek((number - 1) * part_size)
+        return f.read(part_size)
+
+
+def _digests(data):
+    md5 = hashlib.md5(data)
+    return {'md5': md5.hexdigest(),
+            'md5_b64': base64.b64encode(md5.digest()).decode('ascii'),
+            'sha256': hashlib.sha256(data).hexdigest()}
+
+
+class Uploader(object):
+
+    def __init__(self, path, bucket_name, key_name,
+                 part_size=DEFAULT_PART_SIZE,
+                 workers=DEFAULT_WORKERS,
+                 endpoint=None,
+                 manifest_path=None):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError('Part size must be at least {} bytes'.format(
+                MIN_PART_SIZE))
+        self.path = path
+        self.bucket_name = bucket_name
+        self.key_name = key_name
+        self.part_size = part_size
+        self.workers = workers
+        self.endpoint = endpoint
+        self.size = os.path.getsize(path)
+        self.parts = max(1, (self.size + part_size - 1) // part_size)
+        self.manifest = Manifest.load(
+            manifest_path or manifest_path_for(path),
+            bucket_name, key_name, self.size, part_size)
+        self._local = threading.local()
+        self._remote_etags = {}
+
+    def _bucket(self):
+        # boto connections are not thread safe, so each worker gets its own
+        if not hasattr(self._local, 'bucket'):
+            conn = connect(self.endpoint)
+            self._local.bucket = conn.get_bucket(self.bucket_name,
+                                                 validate=False)
+        return self._local.bucket
+
+    def _multipart(self):
+        mp = MultiPartUpload(self._bucket())
+        mp.key_name = self.key_name
+        mp.id = self.manifest.upload_id
+        return mp
+
+    def _existing_upload(self):
+        if self.manifest.upload_id is None:
+            return None
+        for mp in self._bucket().list_multipart_uploads():
+            if (mp.id == self.manifest.upload_id and
+                    mp.key_name == self.key_name):
+                return mp
+        print('Multipart upload {} is gone, starting over'.format(
+            self.manifest.upload_id))
+        return None
+
+    def _uploaded_parts(self, mp):
+        return dict((part.part_number, part.etag.strip('"'))
+                    for part in mp)
+
+    def upload_part(self, number):
+        data = _read_part(self.path, number, self.part_size)
+        digests = _digests(data)
+        recorded = self.manifest.part(number)
+        if (recorded is not None and
+                recorded['md5'] == digests['md5'] and
+                self._remote_etags.get(number) == digests['md5']):
+            print('Part {}/{} already uploaded'.format(number, self.parts))
+            return 0, 0
+
+        for attempt in range(1, PART_ATTEMPTS + 1):
+            start = time.time()
+            try:
+                self._multipart().upload_part_from_file(
+                    BytesIO(data), number,
+                    md5=(digests['md5'], digests['md5_b64']),
+                    size=len(data))
+                break
+            except Exception as e:
+                if attempt == PART_ATTEMPTS:
+                    raise
+                print('Part {} failed ({}), retrying'.format(number, e))
+                time.sleep(2 ** attempt)
+        elapsed = time.time() - start
+
+        self.manifest.record(number, {'size': len(data),
+                                      'md5': digests['md5'],
+                                      'sha256': digests['sha256'],
+                                      'seconds': round(elapsed, 3)})
+        print('Part {}/{}: {:.1f} MB in {:.1f}s ({:.1f} MB/s)'.format(
+            number, self.parts, len(data) / float(MB), elapsed,
+            len(data) / float(MB) / (elapsed or 1)))
+        return len(data), elapsed
+
+    def upload(self, attempts=DEFAULT_ATTEMPTS):
+        """Upload, resuming up to `attempts` times; cancel if all fail."""
+        for attempt in range(1, attempts + 1):
+            try:
+                return self._upload()
+            except Exception as e:
+                if attempt == attempts:
+                    self.cancel()
+                    raise
+                print('Upload attempt {}/{} failed ({}), resuming'.format(
+                    attempt, attempts, e))
+                time.sleep(2 ** attempt)
+
+    def cancel(self):
+        if self.manifest.upload_id is not None:
+            try:
+                self._multipart().cancel_upload()
+                print('Cancelled multipart upload {}'.format(
+                    self.manifest.upload_id))
+            except Exception as e:
+                print('Could not cancel multipart upload {}: {}'.format(
+                    self.manifest.upload_id, e))
+        if os.path.exists(self.manifest.path):
+            os.remove(self.manifest.path)
+
+    def _upload(self):
+        start = time.time()
+        mp = self._existing_upload()
+        if mp is None:
+            mp = self._bucket().initiate_multipart_upload(self.key_name)
+            self.manifest.data['parts'] = {}
+            self.manifest.upload_id = mp.id
+        else:
+            print('Resuming multipart upload {}'.format(mp.id))
+            self._remote_etags = self._uploaded_parts(mp)
+
+        pool = ThreadPool(self.workers)
+        try:
+            results = pool.map(self.upload_part, range(1, self.parts + 1),
+                               chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        self._multipart().complete_upload()
+
+        sent = sum(size for size, _ in results)
+        elapsed = time.time() - start
+        print('Uploaded s3://{}/{} ({} bytes, {} sent) in {:.1f}s, '
+              '{:.1f} MB/s'.format(self.bucket_name, self.key_name,
+                                   self.size, sent, elapsed,
+                                   sent / float(MB) / (elapsed or 1)))
+        os.remove(self.manifest.path)
+
+
+def _initiated(mp):
+    # e.g. 2016-05-04T10:11:12.000Z
+    return calendar.timegm(time.strptime(mp.initiated[:19],
+                                         '%Y-%m-%dT%H:%M:%S'))
+
+
+def sweep_stale_uploads(bucket, prefix, max_age_hours=DEFAULT_SWEEP_HOURS,
+                        endpoint=None):
+    """Cancel the multipart uploads under `prefix` older than the maximum
+    age, returning how many were cancelled."""
+    cutoff = time.time() - max_age_hours * 60 * 60
+    cancelled = 0
+    for mp in connect(endpoint).get_bucket(
+            bucket, validate=False).get_all_multipart_uploads(prefix=prefix):
+        if _initiated(mp) < cutoff:
+            mp.cancel_upload()
+            cancelled += 1
+            print('Cancelled stale multipart upload of {} from {}'.format(
+                mp.key_name, mp.initiated))
+    return cancelled
+
+
+def upload(path, bucket, key, part_size=DEFAULT_PART_SIZE,
+           workers=DEFAULT_WORKERS, endpoint=None,
+           attempts=DEFAULT_ATTEMPTS):
+    size = os.path.getsize(path)
+    if size <= part_size:
+        conn = connect(endpoint)
+        k = conn.get_bucket(bucket, validate=False).new_key(key)
+        k.set_contents_from_filename(path)
+        print('Uploaded s3://{}/{} ({} bytes)'.format(bucket, key, size))
+        return
+    Uploader(path, bucket, key, part_size=part_size, workers=workers,
+             endpoint=endpoint).upload(attempts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    parser.add_argument('bucket')
+    parser.add_argument('key')
+    parser.add_argument('--part-size-mb', type=int,
+                        default=DEFAULT_PART_SIZE // MB)
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--attempts', type=int, default=DEFAULT_ATTEMPTS,
+                        help='Times to try the upload, each resuming the '
+                             'previous one')
+    parser.add_argument('--sweep-prefix',
+                        help='Cancel stale multipart uploads of keys with '
+                             'this prefix first')
+    parser.add_argument('--sweep-hours', type=int,
+                        default=DEFAULT_SWEEP_HOURS,
+                        help='Age after which a multipart upload is stale')
+    parser.add_argument('--endpoint',
+                        help='URL of an S3-compatible server to use instead '
+                             'of AWS, e.g. http://localhost:9000')
+    args = parser.parse_args(argv)
+    if args.sweep_prefix is not None:
+        sweep_stale_uploads(args.bucket, args.sweep_prefix, args.sweep_hours,
+                            endpoint=args.endpoint)
+    upload(args.path, args.bucket, args.key,
+           part_size=args.part_size_mb * MB,
+           workers=args.workers,
+           endpoint=args.endpoint,
+           attempts=args.attempts)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,5 +5,11 @@ settings = {
     "aws_iam_group": "nightly-vagrant-build",
     "factory_ami": "ami-6ca1011b",
     "instance_type": "m3.large",
-    "packer_var_file": "packer_inputs.json"
+    "factory_pool_size": 2,
+    "factory_lease_hours": 6,
+    "factory_key_name": "vagrant-nightly-factory",
+    "factory_key_dir": "~/.ssh",
+    "packer_var_file": "packer_inputs.json",
+    "s3_part_size_mb": 64,
+    "s3_upload_workers": 8
 }
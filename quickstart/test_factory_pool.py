@@ -0,0 +1,344 @@
+"""Tests of the factory pool against a mocked EC2 connection.
+
+    cd quickstart && python -m pytest test_factory_pool.py
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from boto.exception import EC2ResponseError
+
+import factory_pool
+from factory_pool import (FactoryPool, FactoryUnhealthy, KEY_TAG, POOL_LEASE,
+                          ROLE, ROLE_TAG, SETUP_TAG)
+
+KEY_NAME = 'factory-key'
+# Any private key will do; this is the one vagrant boxes are built with
+KEY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'keys', 'insecure_private_key')
+# As `openssl pkcs8 -topk8 -nocrypt -outform DER | openssl sha1 -c` has it
+FINGERPRINT = '5d:99:ea:98:ae:f6:05:49:fc:93:e5:57:1e:cb:35:87:4a:d5:bd:47'
+
+
+def _error(code):
+    error = EC2ResponseError(400, 'Bad Request')
+    error.error_code = code
+    return error
+
+
+class FakeGroup(object):
+
+    def __init__(self, conn, name, description):
+        self.connection = conn
+        self.id = 'sg-{0}'.format(id(self))
+        self.name = name
+        self.description = description
+
+    def authorize(self, **kwargs):
+        pass
+
+
+class FakeInstance(object):
+
+    def __init__(self, instance_id, state='running', tags=None):
+        self.id = instance_id
+        self.state = state
+        self.tags = dict(tags or {})
+
+    def start(self):
+        self.state = 'running'
+
+    def stop(self):
+        self.state = 'stopped'
+
+    def terminate(self):
+        self.state = 'terminated'
+
+    def add_tag(self, key, value):
+        self.tags[key] = value
+
+    def _update(self, fresh):
+        self.__dict__.update(fresh.__dict__)
+
+    def __str__(self):
+        return 'Instance:{}'.format(self.id)
+
+
+class FakeStatus(object):
+
+    def __init__(self, system='ok', instance='ok'):
+        self.system_status = mock.Mock(status=system)
+        self.instance_status = mock.Mock(status=instance)
+
+
+class FakeEC2(object):
+    """Just enough of boto's EC2Connection for the pool."""
+
+    def __init__(self):
+        self.groups = {}
+        self.instances = []
+        self.statuses = {}
+        self.launched = []
+        self.key_pair = mock.Mock(fingerprint=FINGERPRINT)
+
+    def create_security_group(self, name, description):
+        if name in self.groups:
+            raise _error('InvalidGroup.Duplicate')
+        self.groups[name] = FakeGroup(self, name, description)
+        return self.groups[name]
+
+    def delete_security_group(self, group_id):
+        for name, group in list(self.groups.items()):
+            if group.id == group_id:
+                del self.groups[name]
+                return True
+        raise _error('InvalidGroup.NotFound')
+
+    def get_all_security_groups(self, filters):
+        name = filters['group-name']
+        return [self.groups[name]] if name in self.groups else []
+
+    def get_only_instances(self, instance_ids=None, filters=None):
+        if instance_ids is not None:
+            return [i for i in self.instances if i.id in instance_ids]
+        role = filters['tag:{}'.format(ROLE_TAG)]
+        return [i for i in self.instances
+                if i.tags.get(ROLE_TAG) == role and
+                i.state in filters['instance-state-name']]
+
+    def run_instances(self, **kwargs):
+        instance = FakeInstance('i-{}'.format(len(self.instances)),
+                                state='pending')
+        self.instances.append(instance)
+        self.launched.append(instance)
+        # Running by the time anyone looks again
+        instance.state = 'running'
+        return mock.Mock(instances=[instance])
+
+    def create_tags(self, ids, tags):
+        for instance in self.instances:
+            if instance.id in ids:
+                instance.tags.update(tags)
+
+    def get_all_instance_status(self, instance_ids):
+        return [self.statuses.get(i, FakeStatus()) for i in instance_ids]
+
+    def get_key_pair(self, name):
+        return self.key_pair
+
+    def create_key_pair(self, name):
+        def save(directory):
+            with open(os.path.join(directory, name + '.pem'), 'w') as pem:
+                pem.write('new key')
+        self.key_pair = mock.Mock(fingerprint='new', save=save)
+        return self.key_pair
+
+    def pooled(self, state='stopped', setup='v1', **tags):
+        tags.setdefault(ROLE_TAG, ROLE)
+        tags.setdefault(KEY_TAG, FINGERPRINT)
+        tags.setdefault(SETUP_TAG, setup)
+        instance = FakeInstance('i-{}'.format(len(self.instances)),
+                                state=state, tags=tags)
+        self.instances.append(instance)
+        return instance
+
+    def lease_group(self, name, expiry):
+        self.groups[name] = FakeGroup(
+            self, name, 'leased by 1@elsewhere until {}'.format(int(expiry)))
+        return self.groups[name]
+
+
+class FactoryPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.key_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.key_dir)
+        self.key_file = os.path.join(self.key_dir, KEY_NAME + '.pem')
+        shutil.copy(KEY_FILE, self.key_file)
+        self.conn = FakeEC2()
+        self.setup = mock.Mock()
+        self.check = mock.Mock()
+        patcher = mock.patch.object(factory_pool.InstanceWaiter, 'wait')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _pool(self, size=1):
+        settings = {
+            'factory_pool_size': size,
+            'factory_lease_hours': 1,
+            'factory_key_name': KEY_NAME,
+            'factory_key_dir': self.key_dir,
+            'factory_ami': 'ami-1',
+            'instance_type': 'm3.medium',
+            'aws_iam_group': 'bakery',
+        }
+        pool = FactoryPool(self.conn, settings, self.setup, 'v1', self.check)
+        pool._key_fingerprint = FINGERPRINT
+        return pool
+
+    def _leased(self, instance):
+        return factory_pool.LEASE_PREFIX + instance.id in self.conn.groups
+
+    def test_launches_into_an_empty_pool(self):
+        lease = self._pool().acquire(deadline=1)
+
+        self.assertEqual([lease.instance], self.conn.launched)
+        self.assertEqual(ROLE, lease.instance.tags[ROLE_TAG])
+        self.assertEqual(FINGERPRINT, lease.instance.tags[KEY_TAG])
+        self.assertEqual('v1', lease.instance.tags[SETUP_TAG])
+        self.setup.assert_called_once_with(lease.instance)
+        self.assertTrue(self._leased(lease.instance))
+        self.assertNotIn(POOL_LEASE, self.conn.groups)
+
+    def test_reuses_a_stopped_instance(self):
+        instance = self.conn.pooled()
+
+        lease = self._pool().acquire(deadline=1)
+
+        self.assertIs(instance, lease.instance)
+        self.assertEqual('running', instance.state)
+        self.assertEqual([], self.conn.launched)
+        self.assertFalse(self.setup.called)
+        self.check.assert_called_once_with(instance)
+
+    def test_sets_up_again_for_a_new_setup_version(self):
+        instance = self.conn.pooled(setup='v0')
+
+        self._pool().acquire(deadline=1)
+
+        self.setup.assert_called_once_with(instance)
+        self.assertEqual('v1', instance.tags[SETUP_TAG])
+
+    def test_does_not_share_a_leased_instance(self):
+        instance = self.conn.pooled(state='running')
+        self.conn.lease_group(factory_pool.LEASE_PREFIX + instance.id,
+                              time.time() + 60)
+
+        self.assertIsNone(self._pool()._try_acquire())
+        self.assertEqual([], self.conn.launched)
+
+    def test_breaks_an_expired_lease(self):
+        instance = self.conn.pooled(state='running')
+        self.conn.lease_group(factory_pool.LEASE_PREFIX + instance.id,
+                              time.time() - 60)
+
+        lease = self._pool()._try_acquire()
+
+        self.assertIs(instance, lease.instance)
+        group = self.conn.groups[factory_pool.LEASE_PREFIX + instance.id]
+        self.assertIs(lease.group, group)
+        self.assertNotIn('elsewhere', group.description)
+
+    def test_breaks_a_stale_lease_only_once(self):
+        instance = self.conn.pooled(state='running')
+        stale = self.conn.lease_group(
+            factory_pool.LEASE_PREFIX + instance.id, time.time() - 60)
+        lease = self._pool()._try_acquire()
+
+        # Another build that also saw the lease stale, before it was broken
+        with mock.patch.object(self.conn, 'get_all_security_groups',
+                               return_value=[stale]):
+            self.assertIsNone(self._pool()._try_acquire())
+
+        self.assertTrue(self._leased(lease.instance))
+        self.assertIs(lease.group, self.conn.groups[
+            factory_pool.LEASE_PREFIX + instance.id])
+
+    def test_keeps_a_key_pair_matching_the_local_key(self):
+        key_pair = self.conn.key_pair
+
+        self.assertIs(key_pair, self._pool()._key_pair())
+        self.assertFalse(key_pair.delete.called)
+
+    def test_replaces_a_key_pair_replaced_by_another_host(self):
+        replaced = self.conn.key_pair = mock.Mock(fingerprint='11:22')
+
+        key_pair = self._pool()._key_pair()
+
+        self.assertTrue(replaced.delete.called)
+        self.assertEqual('new', key_pair.fingerprint)
+        with open(self.key_file) as pem:
+            self.assertEqual('new key', pem.read())
+
+    def test_replaces_a_key_pair_without_a_local_key(self):
+        os.remove(self.key_file)
+        missing = self.conn.key_pair
+
+        key_pair = self._pool()._key_pair()
+
+        self.assertTrue(missing.delete.called)
+        self.assertEqual('new', key_pair.fingerprint)
+
+    def test_release_stops_the_instance_and_drops_the_lease(self):
+        lease = self._pool().acquire(deadline=1)
+
+        lease.release()
+
+        self.assertEqual('stopped', lease.instance.state)
+        self.assertFalse(self._leased(lease.instance))
+
+    def test_release_tolerates_a_broken_lease(self):
+        lease = self._pool().acquire(deadline=1)
+        self.conn.delete_security_group(group_id=lease.group.id)
+
+        lease.release(healthy=False)
+
+        self.assertEqual('terminated', lease.instance.state)
+        self.assertTrue(lease.released)
+
+    def test_replaces_an_instance_failing_its_check(self):
+        unhealthy = self.conn.pooled()
+        self.check.side_effect = [FactoryUnhealthy('no ssh'), None]
+
+        lease = self._pool().acquire(deadline=1)
+
+        self.assertEqual('terminated', unhealthy.state)
+        self.assertFalse(self._leased(unhealthy))
+        self.assertEqual([lease.instance], self.conn.launched)
+
+    def test_replaces_an_impaired_instance(self):
+        impaired = self.conn.pooled()
+        self.conn.statuses[impaired.id] = FakeStatus(system='impaired')
+
+        lease = self._pool().acquire(deadline=1)
+
+        self.assertEqual('terminated', impaired.state)
+        self.assertNotIn(mock.call(impaired), self.check.call_args_list)
+        self.assertEqual([lease.instance], self.conn.launched)
+
+    def test_terminates_a_new_instance_failing_its_check(self):
+        self.check.side_effect = FactoryUnhealthy('no ssh')
+
+        self.assertRaises(FactoryUnhealthy, self._pool()._try_acquire)
+
+        instance, = self.conn.launched
+        self.assertEqual('terminated', instance.state)
+        self.assertFalse(self._leased(instance))
+
+    def test_waits_while_another_build_launches(self):
+        self.conn.lease_group(POOL_LEASE, time.time() + 60)
+
+        self.assertIsNone(self._pool()._try_acquire())
+        self.assertEqual([], self.conn.launched)
+
+    def test_does_not_launch_past_the_pool_size(self):
+        pool = self._pool()
+        other = FakeInstance('i-other', tags={ROLE_TAG: ROLE})
+        # Another build launched one between the count and the pool lease
+        with mock.patch.object(pool, '_instances',
+                               side_effect=[[], [other]]):
+            self.assertIsNone(pool._try_acquire())
+
+        self.assertEqual([], self.conn.launched)
+        self.assertNotIn(POOL_LEASE, self.conn.groups)
+
+
+if __name__ == '__main__':
+    unittest.main()
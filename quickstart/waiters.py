@@ -0,0 +1,95 @@
+"""Batched EC2 waiters with jittered exponential backoff."""
+from __future__ import print_function
+import time
+import random
+
+from boto.exception import EC2ResponseError
+
+# How long an instance may take to reach each state, in seconds
+STATE_DEADLINES = {
+    'running': 10 * 60,
+    'stopped': 10 * 60,
+    'terminated': 10 * 60,
+}
+DEFAULT_DEADLINE = 10 * 60
+
+
+class WaiterTimeout(RuntimeError):
+    pass
+
+
+def backoff(initial=1.0, maximum=20.0, factor=2.0):
+    """Yield "full jitter" delays: random up to an exponentially growing cap.
+    """
+    cap = initial
+    while True:
+        yield random.uniform(initial / 2, cap)
+        cap = min(cap * factor, maximum)
+
+
+def wait_for(check, description, deadline=DEFAULT_DEADLINE,
+             initial=1.0, maximum=20.0):
+    """Call `check` until it returns something truthy, or raise on deadline.
+    """
+    end = time.time() + deadline
+    delays = backoff(initial, maximum)
+    while True:
+        result = check()
+        if result:
+            return result
+        remaining = end - time.time()
+        if remaining <= 0:
+            raise WaiterTimeout('Timed out after {}s waiting for {}'.format(
+                deadline, description))
+        time.sleep(min(next(delays), remaining))
+
+
+class InstanceWaiter(object):
+    """Wait on many instances with one describe_instances call per poll."""
+
+    def __init__(self, conn, initial=1.0, maximum=20.0):
+        self.conn = conn
+        self.initial = initial
+        self.maximum = maximum
+
+    def refresh(self, instances):
+        by_id = dict((instance.id, instance) for instance in instances)
+        try:
+            found = self.conn.get_only_instances(instance_ids=list(by_id))
+        except EC2ResponseError as e:
+            # Freshly launched instances may not be visible yet
+            if e.error_code != 'InvalidInstanceID.NotFound':
+                raise
+            return
+        for fresh in found:
+            # Same as Instance.update(), just for the whole batch at once
+            by_id[fresh.id]._update(fresh)
+
+    def wait(self, instances, state, deadline=None):
+        instances = list(instances)
+        if not instances:
+            return
+        if deadline is None:
+            deadline = STATE_DEADLINES.get(state, DEFAULT_DEADLINE)
+        start = time.time()
+        pending = list(instances)
+
+        def reached():
+            self.refresh(pending)
+            for instance in list(pending):
+                if instance.state == state:
+                    print('{} {} after {:.0f}s'.format(
+                        instance, state, time.time() - start))
+                    pending.remove(instance)
+            return not pending
+
+        try:
+            wait_for(reached,
+                     '{} instance(s) to be {}'.format(len(instances), state),
+                     deadline=deadline,
+                     initial=self.initial,
+                     maximum=self.maximum)
+        except WaiterTimeout:
+            raise WaiterTimeout('{} not {} after {}s: {}'.format(
+                len(pending), state, deadline,
+                ', '.join('{} ({})'.format(i.id, i.state) for i in pending)))
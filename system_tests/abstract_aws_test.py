@@ -13,12 +13,19 @@
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
 import os
+import time
+from multiprocessing.pool import ThreadPool
 
 from cloudify.workflows import local
 from cloudify_cli import constants as cli_constants
 import boto.ec2
+from boto.ec2.regioninfo import RegionInfo
 
 from .abstract_packer_test import AbstractPackerTest
+from .client_pool import get_pool
+from .image_index import ImageIndex, ec2_lister
+
+SG_REVOKE_WORKERS = 4
 
 
 class AbstractAwsTest(AbstractPackerTest):
@@ -42,12 +49,36 @@ class AbstractAwsTest(AbstractPackerTest):
             'vpc_subnet_id': self.conf['aws_subnet_id'],
         }
 
+        self.clients = get_pool('aws', {
+            'access_key': self.conf['aws_access_key'],
+            'secret_key': self.conf['aws_secret_key'],
+            'endpoint': self.conf.get('aws_ec2_endpoint'),
+        }, self._get_conn)
+
+        self.image_index = ImageIndex(
+            ec2_lister(self.clients),
+            logger=self.logger,
+        )
+
     def _get_conn(self):
+        """New EC2 connection; use `self.clients` rather than this."""
+        kwargs = {}
+        endpoint = self.env.cloudify_config.get('aws_ec2_endpoint')
+        if endpoint:
+            # e.g. http://localhost:5000 for a local fake EC2
+            scheme, _, address = endpoint.partition('://')
+            host, _, port = address.rstrip('/').partition(':')
+            kwargs.update(
+                region=RegionInfo(name='custom', endpoint=host),
+                is_secure=scheme == 'https',
+                port=int(port) if port else None,
+            )
         return boto.ec2.EC2Connection(
             aws_access_key_id=self.env.cloudify_config[
                 'aws_access_key'],
             aws_secret_access_key=self.env.cloudify_config[
                 'aws_secret_key'],
+            **kwargs
         )
 
     def deploy_image(self):
@@ -89,64 +120,78 @@ class AbstractAwsTest(AbstractPackerTest):
 
         self.addCleanup(self._undeploy_image)
 
-    def _find_image(self):
-        conn = self._get_conn()
-
-        image_id = None
-
-        images = conn.get_all_images(owners='self')
-
-        for image in images:
-            if image.name.startswith(self.name_prefix):
-                image_id = image.id
-                break
-
-        return image_id
+    def _tag_image(self, image_id, tags):
+        with self.clients.client() as conn:
+            conn.create_tags([image_id], tags)
+        self.image_index.invalidate()
 
     def _delete_image(self, image_id):
-        conn = self._get_conn()
-        image = conn.get_all_images(image_ids=[image_id])[0]
-        image.deregister()
+        with self.clients.client() as conn:
+            image = conn.get_all_images(image_ids=[image_id])[0]
+            image.deregister()
+        self.image_index.invalidate()
 
     def _delete_agents_keypair(self):
-        conn = self._get_conn()
-        conn.delete_key_pair(key_name=self.agents_keypair)
+        with self.clients.client() as conn:
+            conn.delete_key_pair(key_name=self.agents_keypair)
 
     def _delete_agents_secgroup(self):
-        conn = self._get_conn()
-        sgs = conn.get_all_security_groups()
-        candidate_sgs = [
-            sg for sg in sgs
-            if sg.name == self.agents_secgroup and
-            # 'and' is on previous line due to PEP8
-            sg.vpc_id == self.env.cloudify_config['aws_vpc_id']
-        ]
-        if len(candidate_sgs) != 1:
-            raise RuntimeError('Could not clean up agents security group')
-        else:
+        start = time.time()
+        vpc_id = self.env.cloudify_config['aws_vpc_id']
+        with self.clients.client() as conn:
+            candidate_sgs = conn.get_all_security_groups(filters={
+                'vpc-id': vpc_id,
+                'group-name': self.agents_secgroup,
+            })
+            if len(candidate_sgs) != 1:
+                raise RuntimeError('Could not clean up agents security group')
             sg_id = candidate_sgs[0].id
-            for sg in sgs:
-                for rule in sg.rules:
-                    groups = [grant.group_id for grant in rule.grants]
-                    if sg_id in groups:
-                        self._delete_sg_rule_reference(
-                            security_group=sg,
-                            proto=rule.ip_protocol,
-                            from_port=rule.from_port,
-                            to_port=rule.to_port,
-                            source_sg=candidate_sgs[0],
-                        )
-            candidate_sgs[0].delete()
-
-    def _delete_sg_rule_reference(self,
-                                  security_group,
-                                  from_port,
-                                  to_port,
-                                  source_sg,
-                                  proto='tcp'):
-        security_group.revoke(
-            ip_protocol=proto,
-            from_port=from_port,
-            to_port=to_port,
-            src_group=source_sg,
-        )
+            # Only the groups with a rule granting access to the agents
+            # group, however many groups the account has
+            referencing = conn.get_all_security_groups(filters={
+                'vpc-id': vpc_id,
+                'ip-permission.group-id': sg_id,
+            })
+
+        revoked = 0
+        if referencing:
+            pool = ThreadPool(min(len(referencing), SG_REVOKE_WORKERS))
+            try:
+                revoked = sum(pool.map(
+                    lambda sg: self._revoke_sg_references(sg, sg_id),
+                    referencing,
+                ))
+            finally:
+                pool.close()
+                pool.join()
+
+        with self.clients.client() as conn:
+            conn.delete_security_group(group_id=sg_id)
+        self.logger.info(
+            'Revoked {0} rule(s) referencing {1} in {2} group(s) and '
+            'deleted it in {3:.1f}s'.format(
+                revoked, sg_id, len(referencing), time.time() - start))
+
+    def _revoke_sg_references(self, security_group, source_sg_id):
+        """Revoke all of a group's rules granting access to
+        `source_sg_id` with a single API call."""
+        params = {'GroupId': security_group.id}
+        count = 0
+        for rule in security_group.rules:
+            if not any(grant.group_id == source_sg_id
+                       for grant in rule.grants):
+                continue
+            count += 1
+            prefix = 'IpPermissions.{0}.'.format(count)
+            params[prefix + 'IpProtocol'] = rule.ip_protocol
+            # Rules for all protocols (-1) have no ports
+            if rule.from_port is not None:
+                params[prefix + 'FromPort'] = rule.from_port
+            if rule.to_port is not None:
+                params[prefix + 'ToPort'] = rule.to_port
+            params[prefix + 'Groups.1.GroupId'] = source_sg_id
+        if count:
+            with self.clients.client() as conn:
+                conn.get_status('RevokeSecurityGroupIngress', params,
+                                verb='POST')
+        return count
@@ -20,6 +20,8 @@ from cloudify_cli import constants as cli_constants
 from novaclient.v2 import client as novaclient
 
 from .abstract_packer_test import AbstractPackerTest
+from .client_pool import get_pool
+from .image_index import ImageIndex, glance_lister
 
 
 class AbstractOpenstackTest(AbstractPackerTest):
@@ -53,7 +55,21 @@ class AbstractOpenstackTest(AbstractPackerTest):
             'flavor': self.env.flavor_name
         }
 
+        self.clients = get_pool('openstack', {
+            'username': self.conf['keystone_username'],
+            'password': self.conf['keystone_password'],
+            'auth_url': self.conf['keystone_url'],
+            'tenant': self.conf['keystone_tenant_name'],
+            'region': self.conf['region'],
+        }, self._get_conn)
+
+        self.image_index = ImageIndex(
+            glance_lister(self.clients, region=self.conf['region']),
+            logger=self.logger,
+        )
+
     def _get_conn(self):
+        """New Nova client; use `self.clients` rather than this."""
         return novaclient.Client(
             username=self.env.cloudify_config['keystone_username'],
             api_key=self.env.cloudify_config['keystone_password'],
@@ -62,44 +78,6 @@ class AbstractOpenstackTest(AbstractPackerTest):
             region=self.env.cloudify_config['region'],
         )
 
-    def _find_image(self):
-        conn = self._get_conn()
-
-        image_id = None
-
-        # Tenant ID does not appear to be populated until another action has
-        # been taken, so we will make a call to cause it to be populated.
-        # We use floating IPs as this shouldn't be a huge amount of data.
-        # We could try making a call that will return nothing, but those may
-        # raise exceptions so we will trust that list should not do so.
-        conn.floating_ips.list()
-        my_tenant_id = conn.client.tenant_id
-
-        images = conn.images.list()
-        self.logger.info('Images from platform: %s' % images)
-        images = [image.to_dict() for image in images]
-        self.logger.info('Tenant ID: %s' % my_tenant_id)
-        for image in images:
-            self.logger.info(image['metadata'])
-        # Get just the images belonging to this tenant
-        images = [
-            image for image in images
-            if 'owner_id' in image['metadata'].keys() and
-            # 'and' on previous line due to PEP8
-            image['metadata']['owner_id'] == my_tenant_id
-        ]
-        self.logger.info('All images: %s' % images)
-        self.logger.info('Searching by prefix: %s' % self.name_prefix)
-        # Filter for the prefix
-        for image in images:
-            self.logger.info('Checking %s...' % image['name'])
-            if image['name'].startswith(self.name_prefix):
-                self.logger.info('Correct image, with ID: %s' % image['id'])
-                image_id = image['id']
-                break
-
-        return image_id
-
     def deploy_image(self):
         blueprint_path = self.copy_blueprint('openstack-start-vm')
         self.openstack_blueprint_yaml = os.path.join(
@@ -146,19 +124,25 @@ class AbstractOpenstackTest(AbstractPackerTest):
 
         self.addCleanup(self._undeploy_image)
 
+    def _tag_image(self, image_id, tags):
+        with self.clients.client() as conn:
+            conn.images.set_meta(image_id, tags)
+        self.image_index.invalidate()
+
     def _delete_image(self, image_id):
-        conn = self._get_conn()
-        image = conn.images.find(id=image_id)
-        image.delete()
+        with self.clients.client() as conn:
+            image = conn.images.find(id=image_id)
+            image.delete()
+        self.image_index.invalidate()
 
     def _delete_agents_keypair(self):
-        conn = self._get_conn()
-        keypair = conn.keypairs.find(name=self.agents_keypair)
-        keypair.delete()
+        with self.clients.client() as conn:
+            keypair = conn.keypairs.find(name=self.agents_keypair)
+            keypair.delete()
 
     def _delete_agents_secgroup(self):
-        conn = self._get_conn()
-        secgroup = conn.security_groups.find(
-            name=self.agents_secgroup
-        )
-        secgroup.delete()
+        with self.clients.client() as conn:
+            secgroup = conn.security_groups.find(
+                name=self.agents_secgroup
+            )
+            secgroup.delete()
@@ -13,10 +13,7 @@
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
 
-import re
 import os
-import ssl
-import json
 import time
 import shutil
 import socket
@@ -24,16 +21,27 @@ import paramiko
 import tempfile
 import subprocess
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
 
 from retrying import retry
 from requests import ConnectionError
 
 from cloudify_cli import constants
-from cloudify_rest_client.exceptions import CloudifyClientError
 
-from cosmo_tester.framework import git_helper as git
 from cosmo_tester.framework.util import create_rest_client, get_cfy
 
+from . import artifact_cache, bake_scheduler, probes, timeline, tls_inspect
+from .execution_watcher import ExecutionWatcher
+from .fingerprint import (
+    DEFAULT_MANAGER_REPO_URL,
+    FINGERPRINT_TAG,
+    LAST_USED_TAG,
+    bake_fingerprint,
+    resolve_version,
+)
+from .image_index import expired_images
+from .suite_runner import RESOURCE_SUFFIX_ENV
+
 DEFAULT_IMAGE_BAKERY_REPO_URL = 'https://github.com/' \
                                 'cloudify-cosmo/cloudify-image-bakery.git'
 DEFAULT_PACKER_URL = 'https://releases.hashicorp.com/packer/' \
@@ -43,6 +51,10 @@ DEFAULT_CLOUDIFY_VERSION = 'master'
 DEFAULT_AMI = "ami-91feb7fb"
 DEFAULT_AWS_REGION = "us-east-1"
 DEFAULT_AWS_INSTANCE_TYPE = 'm3.large'
+# Fingerprinted images are deleted once unused for this many days, and
+# beyond this many per cloud
+DEFAULT_IMAGE_RETENTION_DAYS = 14
+DEFAULT_IMAGES_KEPT = 5
 SUPPORTED_ENVS = [
     'aws',
     'openstack',
@@ -66,46 +78,7 @@ def get_ssh_host_key(host):
 
 # Expect addr in tuple form (str-host, int-port)
 def get_ssl_cert(addr):
-    # '   Subject: C=US, ST=State, L=Ex Mple, O=Ex mpl, CN=example.com'
-    # Must have one match group to work with remaining logic
-    cn_finder = re.compile('\sCN=([^\s]+)')
-    cert = ssl.get_server_certificate(addr)
-    cert_details_process = subprocess.Popen(
-        [
-            'openssl',
-            'x509',
-            '-noout',
-            '-text',
-        ],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    cert_details = cert_details_process.communicate(cert)
-    if cert_details_process.returncode != 0:
-        raise RuntimeError('openssl failed with error: %s' % cert_details[1])
-    else:
-        cert_details = cert_details[0].splitlines()
-    cert_cn = None
-    subject_altnames_line = ''
-    for index in range(0, len(cert_details)):
-        line = cert_details[index]
-        if 'Subject: ' in line:
-            cert_cn = cn_finder.findall(line)[0]
-        elif 'X509v3 Subject Alternative Name:' in line:
-            # This is always expected to be safe if the openssl command ran
-            # successfully
-            subject_altnames_line = cert_details[index + 1]
-    subject_altnames_line = subject_altnames_line.strip()
-    subject_altnames = [
-        altname.strip()
-        for altname in subject_altnames_line.split(',')
-    ]
-    return {
-        'cert': cert,
-        'cn': cert_cn,
-        'subject_altnames': subject_altnames,
-    }
+    return tls_inspect.inspect(addr)
 
 
 class AbstractPackerTest(object):
@@ -118,7 +91,7 @@ class AbstractPackerTest(object):
         pass
 
     @abstractmethod
-    def _find_image(self):
+    def _tag_image(self, image_id, tags):
         pass
 
     @abstractmethod
@@ -145,66 +118,102 @@ class AbstractPackerTest(object):
         self.agents_keypair = self.conf.get(
             'system-tests-keypair-name',
             'marketplace-system-tests-keypair')
+        # Test classes run concurrently by the suite runner each need their
+        # own agents keypair and security group
+        suffix = os.environ.get(RESOURCE_SUFFIX_ENV)
+        if suffix:
+            self.agents_secgroup += '-' + suffix
+            self.agents_keypair += '-' + suffix
+
+        self.timeline = timeline.get_timeline(
+            path=self.conf.get(
+                'marketplace_timeline_file',
+                timeline.DEFAULT_TIMELINE_FILE
+            ),
+            logger=self.logger,
+        )
+        self.addCleanup(self.timeline.write)
+
+    def _span(self, name, **kwargs):
+        """Time `name` on this test class's track of the timeline."""
+        return self.timeline.span(name, track=type(self).__name__, **kwargs)
+
+    def _find_image(self, fingerprint=None):
+        if fingerprint is not None:
+            images = self.image_index.find(
+                tag=(FINGERPRINT_TAG, fingerprint))
+        else:
+            images = self.image_index.find(name_prefix=self.name_prefix)
+        return images[0]['id'] if images else None
 
     def _find_images(self):
         for environment in self.images.keys():
-            self.images[environment] = self._find_image()
+            self.images[environment] = self._find_image(
+                fingerprint=self.fingerprints.get(environment))
 
     def delete_images(self):
         for environment in self.images.keys():
             self._delete_image(self.images[environment])
 
-    def _get_packer(self, destination):
+    def _get_artifact_cache(self):
+        return artifact_cache.ArtifactCache(
+            root=self.env.cloudify_config.get(
+                'artifact_cache_dir',
+                artifact_cache.DEFAULT_CACHE_DIR
+            ),
+            max_size=self.env.cloudify_config.get(
+                'artifact_cache_max_size',
+                artifact_cache.DEFAULT_MAX_SIZE
+            ),
+            logger=self.logger,
+        )
+
+    def _get_packer(self, cache):
         packer_url = self.env.cloudify_config.get(
             'packer_url',
             DEFAULT_PACKER_URL
         )
-        wget_command = [
-            'wget',
-            packer_url
-        ]
-        wget_status = subprocess.call(
-            wget_command,
-            cwd=destination,
-        )
-        assert wget_status == 0
-
-        unzip_command = [
-            'unzip',
-            os.path.split(packer_url)[1],
-        ]
-        unzip_status = subprocess.call(
-            unzip_command,
-            cwd=destination,
+        return cache.fetch_packer(
+            url=packer_url,
+            sha256=self.env.cloudify_config.get('packer_sha256'),
         )
-        assert unzip_status == 0
-
-        return os.path.join(destination, 'packer')
-
-    def _get_marketplace_image_bakery_repo(self):
-        self.base_temp_dir = tempfile.mkdtemp()
 
+    def _get_marketplace_image_bakery_repo(self, cache):
         url = self.env.cloudify_config.get(
             'image_bakery_url',
             DEFAULT_IMAGE_BAKERY_REPO_URL
         )
 
-        git.clone(
+        return cache.checkout(
             url=url,
-            basedir=self.base_temp_dir,
-            branch=self.env.cloudify_config.get('image_bakery_branch'),
+            ref=self.env.cloudify_config.get('image_bakery_branch'),
         )
 
-        self.addCleanup(self.clean_temp_dir)
+    @contextmanager
+    def _bake_locks(self, fingerprints):
+        if not fingerprints:
+            yield
+            return
+        with self._get_artifact_cache().lock('bake-' + fingerprints[0]):
+            with self._bake_locks(fingerprints[1:]):
+                yield
+
+    def _prepare_bake(self, workdir):
+        cache = self._get_artifact_cache()
+        with self._span('image bakery checkout', category='prepare'):
+            image_bakery_repo_path = self._get_marketplace_image_bakery_repo(
+                cache)
 
-        repo_path = os.path.join(
-            self.base_temp_dir,
-            'git',
-            'cloudify-image-bakery',
+        marketplace_path = os.path.join(
+            image_bakery_repo_path,
+            'cloudify_marketplace',
         )
-        return repo_path
 
-    def _build_inputs(self, destination_path, name_prefix):
+        with self._span('packer fetch', category='prepare'):
+            packer_bin = self._get_packer(cache)
+        return marketplace_path, packer_bin
+
+    def _build_inputs(self, name_prefix):
         openstack_url = self.env.cloudify_config.get('keystone_url')
         if openstack_url is not None:
             # TODO: Do a join on this if the URL doesn't have 2.0 already
@@ -283,64 +292,194 @@ class AbstractPackerTest(object):
             "cloudify_manager_security_enabled":
                 'true' if self.secure else 'false',
         }
-        inputs = json.dumps(self.build_inputs)
-        with open(destination_path, 'w') as inputs_handle:
-            inputs_handle.write(inputs)
+        return self.build_inputs
 
     def build_with_packer(self,
-                          name_prefix='marketplace-system-tests',
+                          name_prefix=None,
                           only=None,
                           ):
+        if name_prefix is None:
+            name_prefix = 'marketplace-system-tests'
+            # Test classes run concurrently by the suite runner must not
+            # take each other's images for their own
+            suffix = os.environ.get(RESOURCE_SUFFIX_ENV)
+            if suffix:
+                name_prefix += '-' + suffix
         self.name_prefix = name_prefix
         if only is None:
-            self.images = {environment: None for environment in SUPPORTED_ENVS}
+            builders = SUPPORTED_ENVS
         else:
-            self.images = {only: None}
-
-        self._check_for_images(should_exist=False)
-
-        image_bakery_repo_path = self._get_marketplace_image_bakery_repo()
-
-        marketplace_path = os.path.join(
-            image_bakery_repo_path,
-            'cloudify_marketplace',
-        )
+            builders = [only]
+        self.images = {environment: None for environment in builders}
+        self.fingerprints = {}
 
-        packer_bin = self._get_packer(marketplace_path)
+        self.base_temp_dir = tempfile.mkdtemp()
+        self.addCleanup(self.clean_temp_dir)
 
-        inputs_file_name = 'system-test-inputs.json'
-        self._build_inputs(
-            destination_path=os.path.join(
-                marketplace_path,
-                inputs_file_name
+        scheduler = bake_scheduler.get_scheduler(
+            prepare=self._prepare_bake,
+            packer_file=self.env.cloudify_config.get(
+                'packer_file',
+                DEFAULT_PACKER_FILE
             ),
-            name_prefix=name_prefix,
+            logger=self.logger,
         )
+        self._build_inputs(name_prefix=name_prefix)
 
-        # Build the packer command
-        command = [
-            packer_bin,
-            'build',
-            '--var-file={inputs}'.format(inputs=inputs_file_name),
-        ]
-        if only is not None:
-            command.append('--only={only}'.format(only=only))
-        command.append(self.env.cloudify_config.get(
-            'packer_file',
-            DEFAULT_PACKER_FILE
-        ))
-
-        # Run packer
-        self.logger.info(command)
-        build_status = subprocess.call(
-            command,
-            cwd=marketplace_path,
+        # Images are stamped with a digest of everything that went into
+        # them, so an unchanged bake can be skipped by reusing its image
+        reuse_images = self.env.cloudify_config.get(
+            'marketplace_reuse_images',
+            False
         )
-        assert build_status == 0
-
-        self._check_for_images()
-
-        self.addCleanup(self.delete_images)
+        version_id = None
+        if reuse_images:
+            version_id = self._cloudify_version_id()
+            if version_id is None:
+                reuse_images = False
+        fingerprints = dict(
+            (builder, bake_fingerprint(
+                template_path=scheduler.marketplace_path,
+                builder=builder,
+                build_inputs=self.build_inputs,
+                packer_url=self.env.cloudify_config.get(
+                    'packer_url',
+                    DEFAULT_PACKER_URL
+                ),
+                version_id=version_id,
+            ))
+            for builder in builders
+        )
+        to_bake = []
+        for builder in builders:
+            image_id = None
+            if reuse_images:
+                image_id = self._find_image(fingerprint=fingerprints[builder])
+            if image_id is None:
+                to_bake.append(builder)
+            else:
+                self.logger.info(
+                    'Reusing {0} image {1} with fingerprint {2}'.format(
+                        builder, image_id, fingerprints[builder]))
+
+        # A bake started earlier on behalf of this test class may already
+        # have produced its image, so only insist on a clean slate when
+        # nothing was started yet. Reused images are kept around, so there
+        # is no clean slate to insist on then.
+        if not reuse_images and not any(
+                scheduler.started(builder, self.build_inputs)
+                for builder in builders):
+            self._check_for_images(should_exist=False)
+
+        # Other test processes (see suite_runner) may need the very same
+        # image, so each fingerprint is only baked under its lock. Locks
+        # are taken in a fixed order so two processes cannot deadlock.
+        with self._bake_locks(sorted(fingerprints[builder]
+                                     for builder in to_bake)):
+            if reuse_images and to_bake:
+                self.image_index.invalidate()
+                to_bake = [
+                    builder for builder in to_bake
+                    if self._find_image(
+                        fingerprint=fingerprints[builder]) is None
+                ]
+
+            # Bake everything else this session is configured to need in
+            # the background, so later test classes find their images ready
+            for builder in to_bake + self.env.cloudify_config.get(
+                    'marketplace_bake_builders', []):
+                scheduler.start(builder, self.build_inputs)
+
+            for builder in to_bake:
+                bake = scheduler.wait(builder, self.build_inputs)
+                self._add_bake_spans(bake)
+                with self._span('{0} image visibility'.format(builder),
+                                category='bake'):
+                    for artifact_id in bake.artifact_ids():
+                        self._stamp_image(artifact_id.split(':')[-1],
+                                          fingerprints[builder])
+
+        self.fingerprints = fingerprints
+        with self._span('image lookup', category='bake'):
+            self._check_for_images()
+
+        if not reuse_images:
+            self.addCleanup(self.delete_images)
+            return
+        for image_id in self.images.values():
+            self._tag_image(image_id, {LAST_USED_TAG: str(int(time.time()))})
+        with self._span('image retention', category='bake'):
+            self._expire_images()
+
+    def _cloudify_version_id(self):
+        """What `cloudify_version` currently stands for, or None if that
+        cannot be told (and so images cannot safely be reused)."""
+        version_id = self.env.cloudify_config.get(
+            'marketplace_cloudify_version_id')
+        if version_id:
+            return version_id
+        version = self.build_inputs['cloudify_version']
+        try:
+            version_id = resolve_version(
+                version,
+                self.env.cloudify_config.get(
+                    'marketplace_cloudify_repo_url',
+                    DEFAULT_MANAGER_REPO_URL
+                ),
+            )
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            self.logger.warn(
+                'Not reusing images, cannot resolve cloudify version '
+                '{0}: {1}'.format(version, e))
+            return None
+        self.logger.info('Cloudify version {0} is {1}'.format(
+            version, version_id))
+        return version_id
+
+    def _expire_images(self):
+        """Delete the fingerprinted images that are no longer worth keeping.
+        """
+        self.image_index.invalidate()
+        expired = expired_images(
+            self.image_index.find(tag=(FINGERPRINT_TAG, None)),
+            max_age_days=self.env.cloudify_config.get(
+                'marketplace_image_retention_days',
+                DEFAULT_IMAGE_RETENTION_DAYS
+            ),
+            keep=self.env.cloudify_config.get(
+                'marketplace_images_kept',
+                DEFAULT_IMAGES_KEPT
+            ),
+            exclude=set(self.images.values()),
+        )
+        for image in expired:
+            self.logger.info('Deleting expired image {0} ({1})'.format(
+                image['id'], image['name']))
+            try:
+                self._delete_image(image['id'])
+            except Exception as e:
+                # e.g. deleted by a concurrent test process meanwhile
+                self.logger.warn('Could not delete image {0}: {1}'.format(
+                    image['id'], e))
+
+    def _add_bake_spans(self, bake):
+        track = 'packer {0}'.format(bake.builder)
+        # The build VM lives for about as long as the whole bake
+        self.timeline.add('{0} bake'.format(bake.builder), track,
+                          bake.started, bake.finished, category='bake',
+                          instances=1)
+        for name, start, end in bake.stages():
+            self.timeline.add(name, track, start, end, category='packer')
+
+    # Freshly created images take a while to be visible to every API call
+    @retry(stop_max_delay=5 * 60 * 1000, wait_exponential_multiplier=1000)
+    def _stamp_image(self, image_id, fingerprint):
+        self.logger.info('Tagging image {0} with fingerprint {1}'.format(
+            image_id, fingerprint))
+        self._tag_image(image_id, {
+            FINGERPRINT_TAG: fingerprint,
+            LAST_USED_TAG: str(int(time.time())),
+        })
 
     # TODO: change stop_max_delay to something reasonable. It's ridiculous
     # right now because of openstack host problems
@@ -379,7 +518,14 @@ class AbstractPackerTest(object):
 
     def _deploy_manager(self):
         self.build_with_packer(only=self.packer_build_only)
-        self.deploy_image()
+
+        # Cleanups run last in first out, so the manager VM's span ends
+        # once deploy_image's own cleanup has uninstalled it
+        manager_vm = self.timeline.begin('manager vm', type(self).__name__,
+                                         category='vm', instances=1)
+        self.addCleanup(self.timeline.end, manager_vm)
+        with self._span('vm install', category='deploy'):
+            self.deploy_image()
 
         os.environ[constants.CLOUDIFY_USERNAME_ENV] = 'cloudify'
         os.environ[constants.CLOUDIFY_PASSWORD_ENV] = 'cloudify'
@@ -390,23 +536,11 @@ class AbstractPackerTest(object):
             trust_all=self.secure,
         )
 
-        response = {'status': None}
-        attempt = 0
-        max_attempts = 80
-        while response['status'] != 'running':
-            attempt += 1
-            if attempt >= max_attempts:
-                raise RuntimeError('Manager did not start in time')
-            else:
-                time.sleep(3)
-            try:
-                response = self.client.manager.get_status()
-            except CloudifyClientError:
-                # Manager not fully ready
-                pass
-            except ConnectionError:
-                # Timeout
-                pass
+        with self._span('manager rest service', category='deploy'):
+            probes.wait_for_all(
+                [probes.rest_status_probe(self.client)],
+                logger=self.logger,
+            )
 
         if self.secure:
             self.template_key = get_ssh_host_key(self.manager_public_ip)
@@ -434,63 +568,51 @@ class AbstractPackerTest(object):
                 'manager_names_and_ips': self.manager_public_ip,
             })
 
-        # Arbitrary sleep to wait for manager to actually finish starting as
-        # otherwise we suffer timeouts in the next section
-        # TODO: This would be better if it actually had some way of checking
-        # the manager was fully up and we had a reasonable upper bound on how
-        # long we should expect to wait for that
-        time.sleep(90)
-
-        # We have to retry this a few times, as even after the manager is
-        # accessible we still see failures trying to create deployments
-        deployment_created = False
-        attempt = 0
-        max_attempts = 40
-        while not deployment_created:
-            attempt += 1
-            if attempt >= max_attempts:
-                raise RuntimeError('Manager not created in time')
-            else:
-                time.sleep(3)
-            try:
-                self.client.deployments.create(
+        # The REST service answers well before everything behind it is up,
+        # so wait for every service and for the settings blueprint too
+        with self._span('manager ready', category='deploy'):
+            probes.wait_for_all(
+                probes.manager_ready_probes(
+                    self.client,
                     blueprint_id='CloudifySettings',
-                    deployment_id='config',
-                    inputs=self.config_inputs,
-                )
-                self.addCleanup(self._delete_agents_secgroup)
-                self.addCleanup(self._delete_agents_keypair)
-                deployment_created = True
-            except Exception as err:
-                if attempt >= max_attempts:
-                    raise err
-                else:
-                    self.logger.warn(
-                        'Saw error {}. Retrying.'.format(str(err))
-                    )
-
-        attempt = 0
-        max_attempts = 40
-        execution_started = False
-        while not execution_started:
-            attempt += 1
-            if attempt >= max_attempts:
-                raise RuntimeError('Manager did not start in time')
-            else:
-                time.sleep(3)
-            try:
-                self.client.executions.start(
-                    deployment_id='config',
-                    workflow_id='install',
-                )
-                execution_started = True
-            except Exception as err:
-                if attempt >= max_attempts:
-                    raise err
-                else:
-                    self.logger.warn(
-                        'Saw error {}. Retrying.'.format(str(err))
-                    )
+                ),
+                logger=self.logger,
+            )
+
+        def create_config_deployment():
+            return self.client.deployments.create(
+                blueprint_id='CloudifySettings',
+                deployment_id='config',
+                inputs=self.config_inputs,
+            )
+
+        def start_config_install():
+            return self.client.executions.start(
+                deployment_id='config',
+                workflow_id='install',
+            )
+
+        # Even with every service running, deployment creation and
+        # workflow execution can fail until the workers have settled
+        probes.wait_for_all(
+            [probes.action_probe('config deployment creation',
+                                 create_config_deployment)],
+            logger=self.logger,
+        )
+        self.addCleanup(self._delete_agents_secgroup)
+        self.addCleanup(self._delete_agents_keypair)
+        self.config_execution = probes.wait_for_all(
+            [probes.action_probe('config install execution',
+                                 start_config_install)],
+            logger=self.logger,
+        )
+
+    def _wait_for_manager(self):
+        with self._span('manager ready after config', category='deploy'):
+            probes.wait_for_all(
+                probes.manager_ready_probes(self.client),
+                logger=self.logger,
+            )
 
     def _undeploy_image(self):
         # Private method as it is used for cleanup
@@ -499,30 +621,16 @@ class AbstractPackerTest(object):
                                  task_retry_interval=30)
 
     def wait_for_config_to_finish(self, client, timeout=600):
-        current_time = 0
-        finished = False
-        while not finished and current_time < timeout:
-            try:
-                executions = client.executions.list().items
-            except ConnectionError:
-                if self.secure:
-                    self.logger.debug(
-                        'Connection to rest server lost, waiting for restart')
-                    return
-                raise
-            for execution in executions:
-                if (
-                    execution['deployment_id'] == 'config' and
-                    execution['workflow_id'] == 'install' and
-                    execution['status'] == 'terminated'
-                ):
-                    return
-            time.sleep(3)
-            current_time += 3
-        raise RuntimeError(
-            'config deployment install workflow did not finish in '
-            '{timeout} seconds.'.format(timeout=timeout)
-        )
+        watcher = ExecutionWatcher(client, self.logger)
+        try:
+            with self._span('config workflow', category='deploy'):
+                watcher.watch([self.config_execution.id], timeout=timeout)
+        except ConnectionError:
+            if self.secure:
+                self.logger.debug(
+                    'Connection to rest server lost, waiting for restart')
+                return
+            raise
 
     def test_hello_world(self):
         self._deploy_manager()
@@ -538,13 +646,15 @@ class AbstractPackerTest(object):
         # the rest client too:
         self.client = create_rest_client(self.manager_public_ip)
 
-        time.sleep(120)
+        self._wait_for_manager()
 
-        self._run(
-            blueprint_file=self.hello_world_blueprint_file,
-            inputs=self.hello_world_inputs,
-            influx_host_ip=self.manager_public_ip,
-        )
+        # The hello world blueprint starts one VM of its own
+        with self._span('hello world', category='test', instances=1):
+            self._run(
+                blueprint_file=self.hello_world_blueprint_file,
+                inputs=self.hello_world_inputs,
+                influx_host_ip=self.manager_public_ip,
+            )
 
 
 class AbstractSecureTest(AbstractPackerTest):
@@ -592,7 +702,13 @@ class AbstractSecureTest(AbstractPackerTest):
             self.template_key, post_config_key,
             'SSH host key did not change when configuration blueprint ran.')
 
-        post_config_cert = get_ssl_cert((self.manager_public_ip, 443))
+        post_config_cert = probes.wait_for_all(
+            [probes.cert_rotation_probe(
+                (self.manager_public_ip, 443),
+                self.template_ssl_cert['fingerprint'],
+            )],
+            logger=self.logger,
+        )
         self.logger.info(
             'Template was reconfigured with SSL cert: {key}'.format(
                 key=post_config_cert,
@@ -600,7 +716,8 @@ class AbstractSecureTest(AbstractPackerTest):
         )
 
         self.assertNotEqual(
-            self.template_ssl_cert, post_config_cert,
+            self.template_ssl_cert['fingerprint'],
+            post_config_cert['fingerprint'],
             'SSL certificate did not change when configuration blueprint ran.')
 
         self.assertIn(
@@ -630,10 +747,12 @@ class AbstractSecureTest(AbstractPackerTest):
         self.cfy = get_cfy()
         self.cfy.use(self.manager_public_ip, rest_port=443)
 
-        time.sleep(120)
+        self._wait_for_manager()
 
-        self._run(
-            blueprint_file=self.hello_world_blueprint_file,
-            inputs=self.hello_world_inputs,
-            influx_host_ip=self.manager_public_ip,
-        )
+        # The hello world blueprint starts one VM of its own
+        with self._span('hello world', category='test', instances=1):
+            self._run(
+                blueprint_file=self.hello_world_blueprint_file,
+                inputs=self.hello_world_inputs,
+                influx_host_ip=self.manager_public_ip,
+            )
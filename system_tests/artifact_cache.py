@@ -0,0 +1,192 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import os
+import time
+import fcntl
+import shutil
+import hashlib
+import zipfile
+import tempfile
+import subprocess
+from contextlib import contextmanager
+
+import requests
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'cloudify-image-bakery')
+DEFAULT_MAX_SIZE = 5 * 1024 ** 3
+# Entries used more recently than this are never evicted, as another test
+# process may still be working with them
+MIN_EVICTION_AGE = 6 * 60 * 60
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _key(*parts):
+    return hashlib.sha1(
+        '\0'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def _tree_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class ArtifactCache(object):
+    """Persistent cache of packer releases and image bakery checkouts.
+
+    Packer zips are keyed by URL and expected SHA256, checkouts by repository
+    URL and resolved commit. Checkouts are git worktrees of one shallow bare
+    mirror per repository, so a new commit only costs a shallow fetch. All
+    changes to the cache happen under an exclusive file lock, which lets
+    concurrent test processes share it; the least recently used entries are
+    evicted once the cache grows past `max_size` bytes.
+    """
+
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE,
+                 logger=None):
+        self.root = root
+        self.max_size = max_size
+        self.logger = logger
+        for directory in ('tools', 'repos', 'worktrees'):
+            path = os.path.join(root, directory)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def _log(self, message):
+        if self.logger is not None:
+            self.logger.info(message)
+
+    @contextmanager
+    def lock(self, name=''):
+        """Exclusive lock on the whole cache, or on just `name` if given."""
+        lock_path = os.path.join(self.root, '.lock')
+        if name:
+            lock_path = os.path.join(self.root, '.{0}.lock'.format(name))
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _touch(path):
+        os.utime(path, None)
+
+    def fetch_packer(self, url, sha256=None):
+        """Return the path of the packer binary from the zip at `url`."""
+        entry = os.path.join(self.root, 'tools', _key(url, sha256))
+        packer_bin = os.path.join(entry, 'packer')
+        with self.lock():
+            if os.path.exists(packer_bin):
+                self._log('Using cached packer from {0}'.format(entry))
+            else:
+                self._download_packer(url, sha256, entry)
+            self._touch(entry)
+            self.evict(keep=entry)
+        return packer_bin
+
+    def _download_packer(self, url, sha256, entry):
+        self._log('Downloading {0}'.format(url))
+        staging = tempfile.mkdtemp(dir=os.path.join(self.root, 'tools'))
+        try:
+            zip_path = os.path.join(staging, os.path.basename(url))
+            digest = hashlib.sha256()
+            response = requests.get(url, stream=True)
+            response.raise_for_status()
+            with open(zip_path, 'wb') as zip_handle:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    digest.update(chunk)
+                    zip_handle.write(chunk)
+            if sha256 is not None and digest.hexdigest() != sha256.lower():
+                raise RuntimeError(
+                    'SHA256 of {0} is {1}, expected {2}'.format(
+                        url, digest.hexdigest(), sha256))
+            with zipfile.ZipFile(zip_path) as archive:
+                archive.extract('packer', staging)
+            os.remove(zip_path)
+            os.chmod(os.path.join(staging, 'packer'), 0o755)
+            os.rename(staging, entry)
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+    def _git(self, *args, **kwargs):
+        subprocess.check_call(('git',) + args, **kwargs)
+
+    def _git_output(self, *args):
+        return subprocess.check_output(('git',) + args).decode(
+            'utf-8').strip()
+
+    def checkout(self, url, ref=None):
+        """Return a worktree of `ref` (default branch if None) of `url`."""
+        mirror = os.path.join(self.root, 'repos', _key(url) + '.git')
+        with self.lock():
+            if not os.path.isdir(mirror):
+                self._git('init', '--quiet', '--bare', mirror)
+            self._log('Fetching {0} {1}'.format(url, ref or 'HEAD'))
+            self._git('--git-dir', mirror, 'fetch', '--quiet', '--depth', '1',
+                      url, ref or 'HEAD')
+            commit = self._git_output('--git-dir', mirror, 'rev-parse',
+                                      'FETCH_HEAD')
+            worktree = os.path.join(self.root, 'worktrees',
+                                    _key(url, commit))
+            if os.path.isdir(worktree):
+                self._log('Reusing checkout of {0} at {1}'.format(
+                    commit, worktree))
+            else:
+                self._git('--git-dir', mirror, 'worktree', 'prune')
+                self._git('--git-dir', mirror, 'worktree', 'add', '--quiet',
+                          '--detach', worktree, commit)
+            self._touch(worktree)
+            self.evict(keep=worktree)
+        return worktree
+
+    def _entries(self):
+        for directory in ('tools', 'worktrees'):
+            parent = os.path.join(self.root, directory)
+            for name in os.listdir(parent):
+                path = os.path.join(parent, name)
+                if os.path.isdir(path):
+                    yield path
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until under `max_size`.
+
+        Must be called with the lock held.
+        """
+        entries = [(os.path.getmtime(path), _tree_size(path), path)
+                   for path in self._entries()]
+        total = sum(size for _, size, _ in entries)
+        cutoff = time.time() - MIN_EVICTION_AGE
+        for last_used, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path == keep or last_used > cutoff:
+                continue
+            self._log('Evicting {0} ({1} bytes) from the cache'.format(
+                path, size))
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+        for mirror in os.listdir(os.path.join(self.root, 'repos')):
+            self._git('--git-dir', os.path.join(self.root, 'repos', mirror),
+                      'worktree', 'prune')
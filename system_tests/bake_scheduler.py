@@ -0,0 +1,207 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import os
+import sys
+import glob
+import json
+import time
+import atexit
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+
+# The packer output parser lives with the nightly builder
+_QUICKSTART = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'quickstart')
+if _QUICKSTART not in sys.path:
+    sys.path.append(_QUICKSTART)
+import packer_events  # noqa: E402
+
+LOG_TAIL_LINES = 50
+STAGE_NAME_LENGTH = 80
+
+# One scheduler per test session, shared by every test class
+_session = {'scheduler': None}
+_session_lock = threading.Lock()
+
+
+class Bake(object):
+    """A single `packer build --only=<builder>` running in the background."""
+
+    def __init__(self, builder, command, cwd, log_path, inputs_path):
+        self.builder = builder
+        self.command = command
+        self.log_path = log_path
+        self.inputs_path = inputs_path
+        self.started = time.time()
+        self.finished = None
+        self._log = open(log_path, 'w')
+        self.process = subprocess.Popen(
+            command,
+            cwd=cwd,
+            stdout=self._log,
+            stderr=subprocess.STDOUT,
+        )
+
+    @property
+    def done(self):
+        return self.process.poll() is not None
+
+    @property
+    def duration(self):
+        return (self.finished or time.time()) - self.started
+
+    def wait(self):
+        returncode = self.process.wait()
+        if self.finished is None:
+            self.finished = time.time()
+            self._log.close()
+            # The inputs hold cloud credentials: keep them only while needed
+            if os.path.exists(self.inputs_path):
+                os.remove(self.inputs_path)
+        return returncode
+
+    def _parse_log(self):
+        with open(self.log_path) as log:
+            return packer_events.parse_transcript(log)
+
+    def artifact_ids(self):
+        """Ids of the images the build produced, e.g. `us-east-1:ami-1`."""
+        return [artifact_id
+                for ids in self._parse_log().artifact_ids().values()
+                for artifact_id in ids]
+
+    def stages(self):
+        """(name, start, end) of each step packer announced while baking.
+
+        Steps, provisioners included, are the `==> builder: ...` messages;
+        packer timestamps them to the second. The last one lasts until the
+        build finished.
+        """
+        stages = [[stage.name[:STAGE_NAME_LENGTH], stage.start, stage.end]
+                  for stage in self._parse_log().stages()]
+        if stages:
+            stages[-1][2] = self.finished or time.time()
+        return [tuple(stage) for stage in stages]
+
+    def log_tail(self, lines=LOG_TAIL_LINES):
+        with open(self.log_path) as log:
+            return ''.join(log.readlines()[-lines:])
+
+
+class BakeScheduler(object):
+    """Runs one packer build per builder, concurrently.
+
+    All builds share a single image bakery checkout and packer binary, and
+    each writes to its own log. Identical requests (same builder and same
+    inputs) are only baked once per session.
+    """
+
+    def __init__(self, workdir, marketplace_path, packer_bin, packer_file,
+                 logger):
+        self.workdir = workdir
+        self.marketplace_path = marketplace_path
+        self.packer_bin = packer_bin
+        self.packer_file = packer_file
+        self.logger = logger
+        self._bakes = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(builder, inputs):
+        digest = hashlib.sha1(
+            json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+        return builder, digest
+
+    def started(self, builder, inputs):
+        return self._key(builder, inputs) in self._bakes
+
+    def start(self, builder, inputs):
+        key = self._key(builder, inputs)
+        with self._lock:
+            if key in self._bakes:
+                return self._bakes[key]
+            name = '{0}-{1}'.format(builder, key[1][:8])
+            # Not in the bakery checkout, which is shared and kept across
+            # sessions: the inputs hold cloud credentials
+            inputs_file = os.path.join(
+                self.workdir, 'system-test-inputs-{0}.json'.format(name))
+            fd = os.open(inputs_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+            with os.fdopen(fd, 'w') as inputs_handle:
+                inputs_handle.write(json.dumps(inputs))
+            command = [
+                self.packer_bin,
+                'build',
+                '-machine-readable',
+                '--var-file={inputs}'.format(inputs=inputs_file),
+                '--only={only}'.format(only=builder),
+                self.packer_file,
+            ]
+            log_path = os.path.join(self.workdir,
+                                    'packer-{0}.log'.format(name))
+            self.logger.info('Starting {0} bake, logging to {1}: {2}'.format(
+                builder, log_path, command))
+            bake = Bake(builder, command, self.marketplace_path, log_path,
+                        inputs_file)
+            self._bakes[key] = bake
+            return bake
+
+    def wait(self, builder, inputs):
+        """Start the bake if needed and block until just that one is done."""
+        bake = self.start(builder, inputs)
+        returncode = bake.wait()
+        self.logger.info('{0} bake finished with {1} after {2:.0f}s'.format(
+            builder, returncode, bake.duration))
+        if returncode != 0:
+            raise AssertionError(
+                'packer build for {0} failed with {1}, see {2}:\n{3}'.format(
+                    builder, returncode, bake.log_path, bake.log_tail()))
+        return bake
+
+    def shutdown(self):
+        for bake in self._bakes.values():
+            if not bake.done:
+                self.logger.warn('Killing unfinished {0} bake'.format(
+                    bake.builder))
+                bake.process.kill()
+            bake.wait()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def get_scheduler(prepare, packer_file, logger):
+    """Return the session's scheduler, creating it on first use.
+
+    `prepare(workdir)` must provide the bakery checkout and packer and return
+    `(marketplace_path, packer_bin)`; `workdir` is a scratch directory for
+    the session that is removed when it ends. It is only called once.
+    """
+    with _session_lock:
+        if _session['scheduler'] is None:
+            workdir = tempfile.mkdtemp(prefix='image-bakery-')
+            marketplace_path, packer_bin = prepare(workdir)
+            # Left in the shared checkout by sessions that wrote the inputs
+            # next to the packer file
+            for stale in glob.glob(os.path.join(
+                    marketplace_path, 'system-test-inputs-*.json')):
+                os.remove(stale)
+            scheduler = BakeScheduler(workdir, marketplace_path, packer_bin,
+                                      packer_file, logger)
+            atexit.register(scheduler.shutdown)
+            _session['scheduler'] = scheduler
+        return _session['scheduler']
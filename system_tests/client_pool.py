@@ -0,0 +1,79 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import hashlib
+import threading
+from contextlib import contextmanager
+
+DEFAULT_POOL_SIZE = 4
+
+# Pools live for the whole test session, keyed by cloud and credentials
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ClientPool(object):
+    """Thread-safe pool of reusable cloud API clients.
+
+    Clients are created on demand, up to `max_size`, and handed out to one
+    user at a time. Reusing them means an OpenStack client authenticates
+    once and keeps its token, and both OpenStack and EC2 clients keep
+    their HTTP(S) connections alive between calls.
+    """
+
+    def __init__(self, factory, max_size=DEFAULT_POOL_SIZE):
+        self.factory = factory
+        self.max_size = max_size
+        self.created = 0
+        self._idle = []
+        self._available = threading.Condition(threading.Lock())
+
+    def _checkout(self):
+        with self._available:
+            while not self._idle and self.created >= self.max_size:
+                self._available.wait()
+            if self._idle:
+                return self._idle.pop()
+            self.created += 1
+        try:
+            return self.factory()
+        except Exception:
+            with self._available:
+                self.created -= 1
+                self._available.notify()
+            raise
+
+    def _checkin(self, client):
+        with self._available:
+            self._idle.append(client)
+            self._available.notify()
+
+    @contextmanager
+    def client(self):
+        client = self._checkout()
+        try:
+            yield client
+        finally:
+            self._checkin(client)
+
+
+def get_pool(cloud, credentials, factory, max_size=DEFAULT_POOL_SIZE):
+    """Return the session's pool for `cloud` and `credentials`."""
+    key = (cloud, hashlib.sha1(
+        repr(sorted(credentials.items())).encode('utf-8')).hexdigest())
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ClientPool(factory, max_size=max_size)
+        return _pools[key]
@@ -0,0 +1,97 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import time
+
+SUCCEEDED = 'terminated'
+FAILED = ('failed', 'cancelled')
+
+
+class ExecutionFailed(RuntimeError):
+    pass
+
+
+class ExecutionWatcher(object):
+    """Follow specific executions by id until they all end.
+
+    Each poll fetches just the watched executions and only the events
+    added since the previous poll, which are logged as progress. A failed
+    or cancelled execution raises immediately rather than when the timeout
+    runs out.
+    """
+
+    def __init__(self, client, logger, poll_interval=3, events_batch=100):
+        self.client = client
+        self.logger = logger
+        self.poll_interval = poll_interval
+        self.events_batch = events_batch
+        self._event_offsets = {}
+
+    def _log_new_events(self, execution_id):
+        offset = self._event_offsets.get(execution_id, 0)
+        while True:
+            events, total = self.client.events.get(
+                execution_id,
+                from_event=offset,
+                batch_size=self.events_batch,
+            )
+            for event in events:
+                context = event.get('context', {})
+                self.logger.info('[{0}] {1} {2}: {3}'.format(
+                    execution_id,
+                    event.get('event_type'),
+                    context.get('node_id') or context.get('workflow_id', ''),
+                    event.get('message', {}).get('text', ''),
+                ))
+            offset += len(events)
+            if not events or offset >= total:
+                break
+        self._event_offsets[execution_id] = offset
+
+    def watch(self, execution_ids, timeout=600):
+        """Return the finished executions, keyed by id."""
+        pending = list(execution_ids)
+        finished = {}
+        deadline = time.time() + timeout
+        while pending:
+            for execution_id in list(pending):
+                execution = self.client.executions.get(execution_id)
+                self._log_new_events(execution_id)
+                if execution.status in FAILED:
+                    raise ExecutionFailed(
+                        'Execution {0} of {1} on {2} {3}: {4}'.format(
+                            execution_id,
+                            execution.workflow_id,
+                            execution.deployment_id,
+                            execution.status,
+                            execution.error,
+                        ))
+                if execution.status == SUCCEEDED:
+                    self.logger.info(
+                        'Execution {0} of {1} on {2} finished'.format(
+                            execution_id,
+                            execution.workflow_id,
+                            execution.deployment_id,
+                        ))
+                    finished[execution_id] = execution
+                    pending.remove(execution_id)
+            if not pending:
+                break
+            if time.time() >= deadline:
+                raise RuntimeError(
+                    'Executions {0} did not finish in {1} seconds.'.format(
+                        ', '.join(pending), timeout))
+            time.sleep(self.poll_interval)
+        return finished
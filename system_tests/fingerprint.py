@@ -0,0 +1,90 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import re
+import json
+import hashlib
+import subprocess
+
+# Image tag (AWS) / metadata property (OpenStack) holding the fingerprint
+FINGERPRINT_TAG = 'bakery-fingerprint'
+# ... and the last time (epoch seconds) a test used the image
+LAST_USED_TAG = 'bakery-last-used'
+
+DEFAULT_MANAGER_REPO_URL = 'https://github.com/' \
+                           'cloudify-cosmo/cloudify-manager.git'
+
+# Inputs that do not change what ends up in the image
+EXCLUDED_INPUTS = (
+    'aws_access_key',
+    'aws_secret_key',
+    'openstack_username',
+    'openstack_password',
+)
+
+
+def tracked_files(path):
+    """`git ls-files -s` of `path`: mode, blob hash and name of each file.
+
+    Files the tests generate next to the template (inputs, packer cache)
+    are untracked and so do not affect the result.
+    """
+    return subprocess.check_output(
+        ['git', 'ls-files', '--stage', '--', '.'],
+        cwd=path,
+    ).decode('utf-8')
+
+
+def resolve_version(version, repo_url=DEFAULT_MANAGER_REPO_URL):
+    """The commit the `version` branch or tag of the manager points at.
+
+    `cloudify_version` is usually a moving ref such as `master`, so it says
+    nothing about what a bake installs; the commit it resolves to does.
+    """
+    if re.match(r'^[0-9a-f]{40}$', version):
+        return version
+    output = subprocess.check_output(
+        ['git', 'ls-remote', repo_url,
+         'refs/heads/' + version, 'refs/tags/' + version,
+         'refs/tags/' + version + '^{}'],
+    ).decode('utf-8')
+    refs = dict(reversed(line.split('\t', 1))
+                for line in output.splitlines() if '\t' in line)
+    # The commit an annotated tag points at, rather than the tag object
+    for ref in ('refs/tags/' + version + '^{}', 'refs/tags/' + version,
+                'refs/heads/' + version):
+        if ref in refs:
+            return refs[ref]
+    raise ValueError('No branch or tag {0} in {1}'.format(version, repo_url))
+
+
+def bake_fingerprint(template_path, builder, build_inputs, packer_url,
+                     version_id):
+    """Digest of everything that determines the image a bake produces.
+
+    `version_id` pins the `cloudify_version` input down to something that
+    cannot move, e.g. the commit resolve_version() returns.
+    """
+    inputs = dict((key, value) for key, value in build_inputs.items()
+                  if key not in EXCLUDED_INPUTS)
+    digest = hashlib.sha256()
+    for part in (builder,
+                 packer_url,
+                 json.dumps(inputs, sort_keys=True),
+                 version_id or '',
+                 tracked_files(template_path)):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
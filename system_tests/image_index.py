@@ -0,0 +1,190 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import time
+import calendar
+import threading
+
+import requests
+
+from .fingerprint import LAST_USED_TAG
+
+DEFAULT_TTL = 10
+GLANCE_PAGE_SIZE = 100
+
+# One keep-alive HTTP session per thread for the Glance calls
+_local = threading.local()
+
+
+class ImageIndex(object):
+    """Image lookups by name prefix and/or tag, cached for a short while.
+
+    `list_images(name_prefix, tag)` must yield dicts with at least `id`,
+    `name`, `created` and `last_used`, doing as much of the filtering server
+    side as the cloud allows; a tag of `(key, None)` matches any value.
+    Results are kept for `ttl` seconds so that the several lookups made
+    within one retry attempt only hit the API once, and newest images come
+    first.
+    """
+
+    def __init__(self, list_images, ttl=DEFAULT_TTL, logger=None):
+        self.list_images = list_images
+        self.ttl = ttl
+        self.logger = logger
+        self._cache = {}
+
+    def find(self, name_prefix=None, tag=None):
+        key = (name_prefix, tag)
+        cached = self._cache.get(key)
+        if cached is not None and time.time() - cached[0] < self.ttl:
+            return cached[1]
+
+        start = time.time()
+        images = sorted(self.list_images(name_prefix=name_prefix, tag=tag),
+                        key=lambda image: image['created'] or '',
+                        reverse=True)
+        self._cache[key] = (time.time(), images)
+        if self.logger is not None:
+            self.logger.info(
+                'Found {0} image(s) with prefix {1} and tag {2} in '
+                '{3:.1f}s: {4}'.format(
+                    len(images), name_prefix, tag, time.time() - start,
+                    ', '.join(image['id'] for image in images[:5])))
+        return images
+
+    def invalidate(self):
+        self._cache.clear()
+
+
+def _last_used(image):
+    """When the image was last used, or else created, in epoch seconds."""
+    if image.get('last_used'):
+        return int(image['last_used'])
+    if image.get('created'):
+        # e.g. 2016-05-04T10:11:12.000Z (EC2) or 2016-05-04T10:11:12Z (Glance)
+        return calendar.timegm(time.strptime(image['created'][:19],
+                                             '%Y-%m-%dT%H:%M:%S'))
+    return 0
+
+
+def expired_images(images, max_age_days, keep, exclude=()):
+    """The images to delete: those not used for `max_age_days`, and all
+    but the `keep` most recently used ones. `exclude` are never deleted."""
+    cutoff = time.time() - max_age_days * 24 * 60 * 60
+    ordered = sorted(images, key=_last_used, reverse=True)
+    return [image for position, image in enumerate(ordered)
+            if image['id'] not in exclude and
+            (position >= keep or _last_used(image) < cutoff)]
+
+
+def ec2_lister(clients):
+    def list_images(name_prefix=None, tag=None):
+        filters = {}
+        if name_prefix is not None:
+            filters['name'] = name_prefix + '*'
+        if tag is not None and tag[1] is None:
+            filters['tag-key'] = tag[0]
+        elif tag is not None:
+            filters['tag:' + tag[0]] = tag[1]
+        with clients.client() as conn:
+            images = conn.get_all_images(owners=['self'], filters=filters)
+        for image in images:
+            yield {
+                'id': image.id,
+                'name': image.name,
+                'created': getattr(image, 'creationDate', None),
+                'last_used': image.tags.get(LAST_USED_TAG),
+            }
+    return list_images
+
+
+def _glance_endpoint(client, region):
+    endpoint = client.service_catalog.url_for(
+        attr='region',
+        filter_value=region,
+        service_type='image',
+        endpoint_type='publicURL',
+    ).rstrip('/')
+    for version in ('/v1', '/v2'):
+        if endpoint.endswith(version):
+            endpoint = endpoint[:-len(version)]
+    return endpoint
+
+
+def _glance_get(client, url, params):
+    """GET with the pooled client's token, re-authenticating once if the
+    cached token has expired meanwhile."""
+    if getattr(_local, 'session', None) is None:
+        _local.session = requests.Session()
+    for attempt in range(2):
+        if client.auth_token is None:
+            client.authenticate()
+        response = _local.session.get(
+            url,
+            params=params,
+            headers={'X-Auth-Token': client.auth_token},
+        )
+        if response.status_code != 401 or attempt:
+            break
+        client.auth_token = None
+    response.raise_for_status()
+    return response.json()
+
+
+def glance_lister(clients, region, page_size=GLANCE_PAGE_SIZE):
+    """List the tenant's own images through the Glance v2 API.
+
+    Nova's image API can filter neither by owner nor by property, Glance
+    can; it cannot filter by name prefix though, so that part stays local.
+    """
+    def list_images(name_prefix=None, tag=None):
+        with clients.client() as conn:
+            images = list(_list_glance_images(
+                conn.client, region, page_size, name_prefix, tag))
+        return images
+    return list_images
+
+
+def _list_glance_images(client, region, page_size, name_prefix, tag):
+    if client.auth_token is None:
+        client.authenticate()
+    endpoint = _glance_endpoint(client, region)
+    url = endpoint + '/v2/images'
+    params = {
+        'owner': client.tenant_id,
+        'limit': page_size,
+        'sort_key': 'created_at',
+        'sort_dir': 'desc',
+    }
+    # Glance filters on property values, not on their presence
+    if tag is not None and tag[1] is not None:
+        params[tag[0]] = tag[1]
+    while url is not None:
+        body = _glance_get(client, url, params)
+        for image in body['images']:
+            name = image.get('name') or ''
+            if name_prefix is not None and not name.startswith(name_prefix):
+                continue
+            if tag is not None and tag[0] not in image:
+                continue
+            yield {
+                'id': image['id'],
+                'name': name,
+                'created': image.get('created_at'),
+                'last_used': image.get(LAST_USED_TAG),
+            }
+        # The next page link already carries the query
+        url = endpoint + body['next'] if body.get('next') else None
+        params = None
@@ -0,0 +1,208 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import time
+import random
+
+from . import tls_inspect
+
+# Upper bounds (ms) of the latency histogram buckets
+LATENCY_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class NotReady(Exception):
+    """Raised by a check to say why it is not ready yet."""
+
+
+class ProbeTimeout(RuntimeError):
+    pass
+
+
+class Probe(object):
+    """One readiness condition, polled with jittered exponential backoff.
+
+    `check()` returns a truthy value once ready; anything it raises (or a
+    falsy result) counts as not ready yet. Every call's latency is recorded
+    so slow endpoints show up in the summary even when they do succeed.
+    """
+
+    def __init__(self, name, check, deadline=300, initial=1.0, maximum=15.0):
+        self.name = name
+        self.check = check
+        self.deadline = deadline
+        self.initial = initial
+        self.maximum = maximum
+        self.latencies = []
+        self.last_error = None
+        self.waited = None
+
+    def _attempt(self):
+        start = time.time()
+        try:
+            return self.check()
+        except Exception as err:
+            self.last_error = err
+            return None
+        finally:
+            self.latencies.append(time.time() - start)
+
+    def wait(self):
+        start = time.time()
+        end = start + self.deadline
+        cap = self.initial
+        while True:
+            result = self._attempt()
+            if result:
+                self.waited = time.time() - start
+                return result
+            remaining = end - time.time()
+            if remaining <= 0:
+                raise ProbeTimeout(
+                    '{0} not ready after {1}s ({2} attempts): {3}'.format(
+                        self.name, self.deadline, len(self.latencies),
+                        self.last_error))
+            time.sleep(min(random.uniform(self.initial / 2, cap), remaining))
+            cap = min(cap * 2, self.maximum)
+
+    def histogram(self):
+        counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        for latency in self.latencies:
+            ms = latency * 1000
+            index = len(LATENCY_BUCKETS)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if ms <= bound:
+                    index = i
+                    break
+            counts[index] += 1
+        labels = ['<={0}ms'.format(b) for b in LATENCY_BUCKETS] + ['more']
+        return [(label, count) for label, count in zip(labels, counts)
+                if count]
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return '{0}: never checked'.format(self.name)
+        return ('{0}: ready after {1:.1f}s, {2} attempts, latency '
+                'p50={3:.0f}ms max={4:.0f}ms {5}'.format(
+                    self.name,
+                    self.waited or 0,
+                    len(latencies),
+                    latencies[len(latencies) // 2] * 1000,
+                    latencies[-1] * 1000,
+                    ' '.join('{0}:{1}'.format(label, count)
+                             for label, count in self.histogram())))
+
+
+def wait_for_all(probes, logger):
+    """Wait for each probe in turn, returning the result of the last one."""
+    result = None
+    try:
+        for probe in probes:
+            logger.info('Waiting for {0}...'.format(probe.name))
+            result = probe.wait()
+    finally:
+        for probe in probes:
+            if probe.latencies:
+                logger.info(probe.summary())
+    return result
+
+
+def rest_status_probe(client, deadline=240):
+    def check():
+        status = client.manager.get_status()
+        if status['status'] != 'running':
+            raise NotReady('manager status is {0}'.format(status['status']))
+        return status
+    return Probe('REST service', check, deadline=deadline)
+
+
+class ServicesProbe(Probe):
+    """Every service in the manager status must have all instances running.
+
+    Remembers when each service was first seen running, which tells which
+    service held the manager up.
+    """
+
+    def __init__(self, client, deadline=300):
+        self.client = client
+        self.ready_after = {}
+        self.started = None
+        super(ServicesProbe, self).__init__('manager services', self._check,
+                                            deadline=deadline)
+
+    def _check(self):
+        if self.started is None:
+            self.started = time.time()
+        services = self.client.manager.get_status()['services']
+        pending = []
+        for service in services:
+            name = service.get('display_name', str(service))
+            instances = service.get('instances') or []
+            if instances and all(instance.get('SubState') == 'running'
+                                 for instance in instances):
+                self.ready_after.setdefault(name,
+                                            time.time() - self.started)
+            else:
+                pending.append(name)
+        if pending:
+            raise NotReady('services not running: {0}'.format(
+                ', '.join(sorted(pending))))
+        return services
+
+    def wait(self):
+        self.started = None
+        return super(ServicesProbe, self).wait()
+
+    def summary(self):
+        slowest = sorted(self.ready_after.items(),
+                         key=lambda item: item[1], reverse=True)[:3]
+        return '{0}; slowest services: {1}'.format(
+            super(ServicesProbe, self).summary(),
+            ', '.join('{0} ({1:.0f}s)'.format(name, seconds)
+                      for name, seconds in slowest))
+
+
+def blueprint_probe(client, blueprint_id, deadline=300):
+    return Probe('blueprint {0}'.format(blueprint_id),
+                 lambda: client.blueprints.get(blueprint_id),
+                 deadline=deadline)
+
+
+def action_probe(name, action, deadline=120):
+    """Retry `action` until it succeeds, e.g. while workers still start."""
+    def check():
+        return action() or True
+    return Probe(name, check, deadline=deadline)
+
+
+def cert_rotation_probe(addr, old_fingerprint, deadline=120):
+    """Sample the TLS certificate at `addr` until it is a different one,
+    served by a server that answers HTTP on the same connection."""
+    def check():
+        cert, connection = tls_inspect.connect(addr)
+        if cert['fingerprint'] == old_fingerprint:
+            connection.close()
+            raise NotReady('certificate {0} not rotated yet'.format(
+                old_fingerprint))
+        cert['http_status'] = tls_inspect.http_status(connection, addr[0])
+        return cert
+    return Probe('SSL certificate rotation', check, deadline=deadline)
+
+
+def manager_ready_probes(client, blueprint_id=None):
+    probes = [rest_status_probe(client), ServicesProbe(client)]
+    if blueprint_id is not None:
+        probes.append(blueprint_probe(client, blueprint_id))
+    return probes
@@ -0,0 +1,146 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+"""Run the marketplace test classes concurrently, one process each.
+
+Every class gets its own manager, working directory (so `cfy use` state
+does not clash), agents keypair and security group, and log. Images are
+shared through their fingerprints: whichever process first needs an input
+set bakes it under a lock while the others wait and then reuse the image,
+so each distinct input set is baked once.
+
+    python -m system_tests.suite_runner --log-dir /tmp/marketplace-logs
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+import threading
+
+# Appended to the agents keypair, security group and image name prefix of a
+# test class
+RESOURCE_SUFFIX_ENV = 'MARKETPLACE_TEST_SUFFIX'
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CLASSES = [
+    'aws_packer_hello_world_tests.py:AWSHelloWorldTest',
+    'aws_packer_hello_world_tests.py:AWSHelloWorldSecureTest',
+    'openstack_packer_hello_world_tests.py:OpenstackHelloWorldTest',
+    'openstack_packer_hello_world_tests.py:OpenstackHelloWorldSecureTest',
+]
+# Environment variables holding paths, which must survive the change of
+# working directory
+PATH_ENVS = ('HANDLER_CONFIGURATION',)
+
+
+class ClassRun(object):
+    """One test class running in its own nosetests process."""
+
+    def __init__(self, test, log_dir, runner='nosetests'):
+        self.test = test
+        self.name = test.split(':')[-1]
+        self.workdir = os.path.join(log_dir, self.name)
+        if not os.path.isdir(self.workdir):
+            os.makedirs(self.workdir)
+        self.log_path = os.path.join(self.workdir, 'output.log')
+        self.report_path = os.path.join(self.workdir, 'nosetests.xml')
+        self.command = [
+            runner,
+            '--verbose',
+            '--nologcapture',
+            '--with-xunit',
+            '--xunit-file={0}'.format(self.report_path),
+            os.path.join(TESTS_DIR, test),
+        ]
+        self.returncode = None
+        self.started = None
+        self.finished = None
+
+    def _environment(self):
+        env = dict(os.environ)
+        for key in PATH_ENVS:
+            if env.get(key):
+                env[key] = os.path.abspath(env[key])
+        env[RESOURCE_SUFFIX_ENV] = self.name.lower()
+        return env
+
+    def run(self):
+        self.started = time.time()
+        with open(self.log_path, 'w') as log:
+            self.returncode = subprocess.call(
+                self.command,
+                cwd=self.workdir,
+                env=self._environment(),
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+        self.finished = time.time()
+        return self.returncode
+
+    @property
+    def duration(self):
+        return (self.finished or time.time()) - (self.started or time.time())
+
+    @property
+    def passed(self):
+        return self.returncode == 0
+
+
+def run_suite(tests, log_dir, runner='nosetests', out=sys.stdout):
+    """Run every test class at once and return their ClassRuns."""
+    runs = [ClassRun(test, log_dir, runner=runner) for test in tests]
+    threads = [threading.Thread(target=run.run, name=run.name)
+               for run in runs]
+    start = time.time()
+    for run, thread in zip(runs, threads):
+        out.write('Starting {0}, logging to {1}\n'.format(
+            run.name, run.log_path))
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    for run in runs:
+        out.write('{0:<40} {1:<6} {2:>7.0f}s  {3}\n'.format(
+            run.name,
+            'passed' if run.passed else 'FAILED',
+            run.duration,
+            run.report_path if run.passed else run.log_path,
+        ))
+    out.write('Ran {0} classes in {1:.0f}s ({2:.0f}s if run one after '
+              'another)\n'.format(len(runs), elapsed,
+                                  sum(run.duration for run in runs)))
+    return runs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run marketplace system test classes concurrently.')
+    parser.add_argument('tests', nargs='*', default=DEFAULT_CLASSES,
+                        help='<file>:<class> relative to system_tests')
+    parser.add_argument('--log-dir', default='marketplace-test-logs',
+                        help='Per class working directories and logs')
+    parser.add_argument('--runner', default='nosetests',
+                        help='nosetests compatible test runner')
+    args = parser.parse_args(argv)
+
+    runs = run_suite(args.tests, os.path.abspath(args.log_dir),
+                     runner=args.runner)
+    return 0 if all(run.passed for run in runs) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import os
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+
+DEFAULT_TIMELINE_FILE = 'marketplace-timeline.json'
+
+# One timeline per test session, shared by every test class
+_session = {'timeline': None}
+_session_lock = threading.Lock()
+
+
+class Span(object):
+    """A named stretch of time on one track of the timeline.
+
+    `instances` is how many cloud instances exist only for the span's
+    duration (the packer build VM, the manager VM, ...). Every span is
+    charged for the instances of its own track alive while it runs, so
+    instance-hours add up per stage, and classes (or bakes) running
+    concurrently are not charged for each other's instances.
+    """
+
+    def __init__(self, name, track, category, start, end=None, instances=0,
+                 args=None):
+        self.name = name
+        self.track = track
+        self.category = category
+        self.start = start
+        self.end = end
+        self.instances = instances
+        self.args = args or {}
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+
+class Timeline(object):
+    """Spans of the bake and deploy lifecycle, saved as a trace-event file.
+
+    The file is the JSON object format of the Trace Event spec, which
+    chrome://tracing and Perfetto load directly. Tracks are test classes
+    (or bakes), so concurrent classes show side by side.
+    """
+
+    def __init__(self, path=DEFAULT_TIMELINE_FILE, logger=None):
+        self.path = path
+        self.logger = logger
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def begin(self, name, track, category='test', instances=0, **args):
+        span = Span(name, track, category, time.time(),
+                    instances=instances, args=args)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def end(self, span):
+        span.end = time.time()
+        if self.logger is not None:
+            self.logger.info('{0}: {1} took {2:.1f}s ({3:.2f} '
+                             'instance-hours)'.format(
+                                 span.track, span.name, span.duration,
+                                 self.instance_hours(span)))
+
+    def add(self, name, track, start, end, category='test', instances=0,
+            **args):
+        """Record a span measured elsewhere, e.g. parsed from a log."""
+        span = Span(name, track, category, start, end,
+                    instances=instances, args=args)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name, track, category='test', instances=0, **args):
+        span = self.begin(name, track, category, instances, **args)
+        try:
+            yield span
+        finally:
+            self.end(span)
+
+    def instance_hours(self, span):
+        end = span.end or time.time()
+        seconds = 0
+        with self._lock:
+            spans = list(self.spans)
+        for other in spans:
+            if not other.instances or other.track != span.track:
+                continue
+            overlap = (min(end, other.end or time.time()) -
+                       max(span.start, other.start))
+            if overlap > 0:
+                seconds += overlap * other.instances
+        return seconds / 3600.0
+
+    def events(self):
+        with self._lock:
+            spans = list(self.spans)
+        tracks = {}
+        events = []
+        for span in spans:
+            if span.track not in tracks:
+                tracks[span.track] = len(tracks) + 1
+                events.append({
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': os.getpid(),
+                    'tid': tracks[span.track],
+                    'args': {'name': span.track},
+                })
+            args = dict(span.args)
+            args['instance_hours'] = round(self.instance_hours(span), 4)
+            if span.instances:
+                args['instances'] = span.instances
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': int(span.start * 1e6),
+                'dur': int(span.duration * 1e6),
+                'pid': os.getpid(),
+                'tid': tracks[span.track],
+                'args': args,
+            })
+        return events
+
+    def write(self):
+        with open(self.path, 'w') as timeline_file:
+            json.dump({
+                'traceEvents': self.events(),
+                'displayTimeUnit': 'ms',
+            }, timeline_file, indent=1)
+        if self.logger is not None:
+            total = sum(span.duration * span.instances / 3600.0
+                        for span in self.spans)
+            self.logger.info(
+                'Wrote timeline of {0} spans ({1:.2f} instance-hours) to '
+                '{2}'.format(len(self.spans), total, self.path))
+
+
+def get_timeline(path=DEFAULT_TIMELINE_FILE, logger=None):
+    """Return the session's timeline, written out when the session ends."""
+    with _session_lock:
+        if _session['timeline'] is None:
+            timeline = Timeline(os.path.abspath(path), logger)
+            atexit.register(timeline.write)
+            _session['timeline'] = timeline
+        return _session['timeline']
@@ -0,0 +1,259 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import ssl
+import time
+import socket
+import hashlib
+import datetime
+
+# Short names openssl uses for the usual subject attributes
+NAME_OIDS = {
+    '2.5.4.3': 'CN',
+    '2.5.4.6': 'C',
+    '2.5.4.7': 'L',
+    '2.5.4.8': 'ST',
+    '2.5.4.10': 'O',
+    '2.5.4.11': 'OU',
+    '1.2.840.113549.1.9.1': 'emailAddress',
+}
+SUBJECT_ALT_NAME_OID = '2.5.29.17'
+
+# DER tags
+SEQUENCE = 0x30
+SET = 0x31
+INTEGER = 0x02
+OCTET_STRING = 0x04
+OID = 0x06
+UTC_TIME = 0x17
+GENERALIZED_TIME = 0x18
+BMP_STRING = 0x1e
+VERSION = 0xa0
+EXTENSIONS = 0xa3
+
+# GeneralName tags, as openssl prints them
+GENERAL_NAMES = {
+    0x81: 'email',
+    0x82: 'DNS',
+    0x86: 'URI',
+    0x87: 'IP Address',
+}
+
+
+class CertificateError(ValueError):
+    pass
+
+
+def _read(data, offset):
+    """Return (tag, value, next offset) of the DER element at `offset`."""
+    try:
+        tag = data[offset]
+        length = data[offset + 1]
+        offset += 2
+        if length & 0x80:
+            size = length & 0x7f
+            length = 0
+            for byte in data[offset:offset + size]:
+                length = (length << 8) | byte
+            offset += size
+    except IndexError:
+        raise CertificateError('Truncated DER element')
+    end = offset + length
+    if end > len(data):
+        raise CertificateError('Truncated DER element')
+    return tag, data[offset:end], end
+
+
+def _elements(data):
+    offset = 0
+    while offset < len(data):
+        tag, value, offset = _read(data, offset)
+        yield tag, value
+
+
+def _expect(element, tag):
+    if element[0] != tag:
+        raise CertificateError('Expected DER tag {0:#x}, got {1:#x}'.format(
+            tag, element[0]))
+    return element[1]
+
+
+def _oid(value):
+    first = value[0]
+    parts = [min(first // 40, 2), first - 40 * min(first // 40, 2)]
+    number = 0
+    for byte in value[1:]:
+        number = (number << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            parts.append(number)
+            number = 0
+    return '.'.join(str(part) for part in parts)
+
+
+def _integer(value):
+    number = 0
+    for byte in value:
+        number = (number << 8) | byte
+    return number
+
+
+def _string(tag, value):
+    if tag == BMP_STRING:
+        return bytes(value).decode('utf-16-be')
+    return bytes(value).decode('utf-8', 'replace')
+
+
+def _time(tag, value):
+    text = bytes(value).decode('ascii').rstrip('Z')
+    if tag == UTC_TIME:
+        # Two digit years: 50-99 are 19xx (RFC 5280)
+        year = int(text[:2])
+        text = str(1900 + year if year >= 50 else 2000 + year) + text[2:]
+    return datetime.datetime.strptime(text[:14], '%Y%m%d%H%M%S')
+
+
+def _name(value):
+    """Name as a list of (attribute, value), in certificate order."""
+    attributes = []
+    for rdn in _elements(value):
+        for attribute in _elements(_expect(rdn, SET)):
+            oid, text = _elements(_expect(attribute, SEQUENCE))
+            oid = _oid(_expect(oid, OID))
+            attributes.append((NAME_OIDS.get(oid, oid),
+                               _string(*text)))
+    return attributes
+
+
+def _ip_address(value):
+    if len(value) == 4:
+        return '.'.join(str(byte) for byte in value)
+    # openssl prints IPv6 as eight uncompressed upper case groups
+    return ':'.join('{0:X}'.format((value[i] << 8) | value[i + 1])
+                    for i in range(0, len(value), 2))
+
+
+def _subject_altnames(value):
+    names = []
+    for tag, name in _elements(_expect(next(_elements(value)), SEQUENCE)):
+        if tag not in GENERAL_NAMES:
+            continue
+        if GENERAL_NAMES[tag] == 'IP Address':
+            text = _ip_address(name)
+        else:
+            text = bytes(name).decode('ascii', 'replace')
+        names.append('{0}:{1}'.format(GENERAL_NAMES[tag], text))
+    return names
+
+
+def parse_certificate(der):
+    """Subject, issuer, validity and SANs of a DER encoded certificate.
+
+    SANs are formatted the way `openssl x509 -text` prints them, e.g.
+    'DNS:example.com' or 'IP Address:10.0.0.1'.
+    """
+    data = bytearray(der)
+    certificate = _expect(next(_elements(data)), SEQUENCE)
+    tbs = list(_elements(_expect(next(_elements(certificate)), SEQUENCE)))
+    if tbs[0][0] == VERSION:
+        tbs = tbs[1:]
+    serial, _, issuer, validity, subject = tbs[:5]
+    not_before, not_after = _elements(_expect(validity, SEQUENCE))
+
+    subject_altnames = []
+    for tag, value in tbs[5:]:
+        if tag != EXTENSIONS:
+            continue
+        for extension in _elements(_expect(next(_elements(value)),
+                                           SEQUENCE)):
+            fields = list(_elements(_expect(extension, SEQUENCE)))
+            if _oid(_expect(fields[0], OID)) == SUBJECT_ALT_NAME_OID:
+                subject_altnames = _subject_altnames(
+                    _expect(fields[-1], OCTET_STRING))
+
+    subject = _name(_expect(subject, SEQUENCE))
+    cns = [text for attribute, text in subject if attribute == 'CN']
+    return {
+        'subject': ', '.join('{0}={1}'.format(*item) for item in subject),
+        'issuer': ', '.join('{0}={1}'.format(*item)
+                            for item in _name(_expect(issuer, SEQUENCE))),
+        'cn': cns[-1] if cns else None,
+        'subject_altnames': subject_altnames,
+        'serial': '{0:X}'.format(_integer(_expect(serial, INTEGER))),
+        'not_before': _time(*not_before),
+        'not_after': _time(*not_after),
+        'fingerprint': hashlib.sha256(bytes(data)).hexdigest(),
+    }
+
+
+def connect(addr, timeout=10):
+    """Handshake with the TLS server at `addr` (host, port) and describe it.
+
+    Returns `(details, connection)`, the connection still open so that
+    follow-up checks (e.g. http_status()) talk to the very server that
+    presented the certificate; the caller closes it. The certificate comes
+    from the same connection as the negotiated cipher and the handshake
+    latency, and is not verified: this is for looking at whatever the
+    server presents.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+
+    start = time.time()
+    sock = socket.create_connection(addr, timeout=timeout)
+    connected = time.time()
+    try:
+        tls = context.wrap_socket(sock)
+        handshake_done = time.time()
+        der = tls.getpeercert(binary_form=True)
+        cipher, protocol, bits = tls.cipher()
+        details = parse_certificate(der)
+    except Exception:
+        sock.close()
+        raise
+
+    details.update({
+        'cert': ssl.DER_cert_to_PEM_cert(der),
+        'cipher': cipher,
+        'protocol': protocol,
+        'cipher_bits': bits,
+        'connect_latency': connected - start,
+        'handshake_latency': handshake_done - connected,
+    })
+    return details, tls
+
+
+def inspect(addr, timeout=10):
+    """connect() for just the details."""
+    details, tls = connect(addr, timeout)
+    tls.close()
+    return details
+
+
+def http_status(connection, host):
+    """Status code of a `HEAD /` over an open connection, which it closes.
+    """
+    try:
+        connection.sendall(
+            'HEAD / HTTP/1.1\r\nHost: {0}\r\nConnection: close\r\n\r\n'
+            .format(host).encode('ascii'))
+        status_line = connection.makefile('rb').readline()
+    finally:
+        connection.close()
+    fields = status_line.decode('ascii', 'replace').split()
+    if len(fields) < 2 or not fields[0].startswith('HTTP/'):
+        raise IOError('No HTTP response from {0}: {1!r}'.format(
+            host, status_line))
+    return int(fields[1])